@@ -2853,7 +2853,9 @@ class downloadImageSlot(QProcessSlot):
                 self.progress.emit(100)
                 self.mLblRemain.setText('100% - 00:00(s) remaining')
                 self.mLblDownloadFlash.setText('')
-                self.mPick.update({'url': self.mFileUrl, 'flashed': True, 'bytes_written': int(self.mResults['bytes_written'])})
+                # the image stream hashed while flashing matched the published md5
+                hashmatch = ('stream_hash_match' in self.mResults and '{}'.format(self.mResults['stream_hash_match']) == 'True')
+                self.mPick.update({'url': self.mFileUrl, 'flashed': True, 'bytes_written': int(self.mResults['bytes_written']), 'hash_match': hashmatch})
                 _logger.debug('{}: successfully flashed to emmc and emit signal: {}'.format(self.objectName(), self.mPick))
                 self.success.emit(self.mPick)
                 self.sendError({'Show': False})
@@ -2992,6 +2994,24 @@ class postDownloadSlot(QProcessSlot):
                         self.mLblRemain.setText('{}% - {:02}:{:02}(s) remaining'.format(pcent, int(self.mRemaining / 60), int(self.mRemaining % 60)))
                         self.progress.emit(pcent)
 
+    def _checkTargetStorage(self):
+        # check for sdcard or emmc
+        # NOTE: on PC-version, need to know storage device path of the target board
+        _logger.info('{}: check whether target storage {} is emmc after flash/download'.format(self.objectName(), self.mPick['storage']))
+        if self._isTargetEMMC(self.mPick['storage']):
+            # 1. disable mmc boot partition 1 boot option
+            # {'cmd': 'config', 'subcmd': 'mmc', 'config_id': 'readonly', 'config_action': 'disable', 'boot_part_no': '1', 'target': self.mTgtStorage]}
+            _logger.warn('{}: issue command to enable emmc:{} boot partition with write access'.format(self.objectName(), self.mPick['storage']))
+            self.sendCommand({'cmd': 'config', 'subcmd': 'mmc', 'config_id': 'readonly', \
+                              'config_action': 'disable', 'boot_part_no': '1', 'send_ack':'1', 'target': self.mPick['storage']})
+        else:
+            if IsATargetBoard():
+                # if not emmc, don't do anything, but emit complete and reboot
+                self.sendError({'NoTgtEmmc': True, 'ask': 'reboot'})
+            else:
+                # if not emmc, on host pc, just emit complete and quit
+                self.sendError({'Complete': True, 'QRCode': self.mQRIcon, 'ask': 'quit'})
+
     def _recoverRescue(self):
         # copy back the backed up /tmp/rescue.img to target eMMC
         self._findChildWidget('wgtProgress').show()
@@ -3049,9 +3069,15 @@ class postDownloadSlot(QProcessSlot):
         # Get qrcode and display
         if results['cmd'] == 'qrcode' and results['msger_type'] == 'dbus' and results['status'] == 'success':
             self.mQRIcon = True if 'svg_buffer' in results else False
-            # do checksum
-            _logger.warn('{}: qrcode success: do checksum for mPick: {}'.format(self.objectName(), self.mPick))
-            self.sendCommand({'cmd': 'check', 'src_filename': '{}.md5.txt'.format(self.mPick['url'].rstrip('.xz')), 'tgt_filename': self.mPick['storage'], 'total_sectors': str(int(self.mPick['bytes_written']/512))})
+            if 'hash_match' in self.mPick and self.mPick['hash_match']:
+                # verified while flashing, no need to read the target back
+                _logger.warn('{}: qrcode success: checksum verified while flashing for mPick: {}'.format(self.objectName(), self.mPick))
+                self.mCheckSumFlag = True
+                self._checkTargetStorage()
+            else:
+                # do checksum
+                _logger.warn('{}: qrcode success: do checksum for mPick: {}'.format(self.objectName(), self.mPick))
+                self.sendCommand({'cmd': 'check', 'src_filename': '{}.md5.txt'.format(self.mPick['url'].rstrip('.xz')), 'tgt_filename': self.mPick['storage'], 'total_sectors': str(int(self.mPick['bytes_written']/512))})
 
         # for target board
         if results['cmd'] == 'check' and results['msger_type'] == 'dbus':
@@ -3074,22 +3100,8 @@ class postDownloadSlot(QProcessSlot):
                 #self.sendError({'NoChecksum': True, 'ask': 'continue'}) # 'ask': 'reboot' if IsATargetBoard() else 'quit'
 
             # check for sdcard or emmc
-            # NOTE: on PC-version, need to know storage device path of the target board
             if results['status'] == 'success' or results['status'] == 'failure':
-                _logger.info('{}: check whether target storage {} is emmc after flash/download'.format(self.objectName(), self.mPick['storage']))
-                if self._isTargetEMMC(self.mPick['storage']):
-                    # 1. disable mmc boot partition 1 boot option
-                    # {'cmd': 'config', 'subcmd': 'mmc', 'config_id': 'readonly', 'config_action': 'disable', 'boot_part_no': '1', 'target': self.mTgtStorage]}
-                    _logger.warn('{}: issue command to enable emmc:{} boot partition with write access'.format(self.objectName(), self.mPick['storage']))
-                    self.sendCommand({'cmd': 'config', 'subcmd': 'mmc', 'config_id': 'readonly', \
-                                      'config_action': 'disable', 'boot_part_no': '1', 'send_ack':'1', 'target': self.mPick['storage']})
-                else:
-                    if IsATargetBoard():
-                        # if not emmc, don't do anything, but emit complete and reboot
-                        self.sendError({'NoTgtEmmc': True, 'ask': 'reboot'})
-                    else:
-                        # if not emmc, on host pc, just emit complete and quit
-                        self.sendError({'Complete': True, 'QRCode': self.mQRIcon, 'ask': 'quit'})
+                self._checkTargetStorage()
 
         # target emmc has been set to writable
         if results['cmd'] == 'config' and results['subcmd'] == 'mmc' and results['config_id'] == 'readonly':
@@ -3099,7 +3111,7 @@ class postDownloadSlot(QProcessSlot):
                     self.sendCommand({'cmd': 'flash', 'src_filename': 'u-boot.imx', 'tgt_filename': '{}boot0'.format(self.mPick['storage']), 'chunk_size': '524288'})
                 else:
                     # 2. clear the mmc boot partition
-                    # {'cmd': 'flash', 'src_filename': '/dev/zero', 'tgt_filename': self.mPick['storage'] + 'boot0'}
+                    # {'cmd': 'erase', 'tgt_filename': self.mPick['storage'] + 'boot0'}
                     _logger.warn('issue command to clear {} boot partition'.format(self.mPick['storage']))
                     self._findChildWidget('wgtProgress').show()
                     self.mLblProgramming.setText("We are now clearing the eMMC boot partition for your evaluation kit\nPlease standby\n")
@@ -3108,14 +3120,14 @@ class postDownloadSlot(QProcessSlot):
                     self.mLblDownloadFlash.setText('Do not power off the device')
                     self.progress.emit(0)
                     self.mConnType = 'dbus'
-                    self.sendCommand({'cmd': 'flash', 'src_filename': '/dev/zero', 'tgt_filename': '{}boot0'.format(self.mPick['storage']), 'chunk_size': '524288'})
+                    self.sendCommand({'cmd': 'erase', 'tgt_filename': '{}boot0'.format(self.mPick['storage'])})
             elif results['status'] == 'failure':
                 if IsATargetBoard():
                     # failed to disable mmc write boot partition option
                     self.sendError({'NoEmmcWrite': True, 'ask': 'continue'})
 
-        # flashed either zero, rescue, or androidthing uboot.imx into emmc boot part
-        if results['cmd'] == 'flash':
+        # erased emmc boot part, or flashed either rescue, or androidthing uboot.imx into it
+        if results['cmd'] == 'flash' or results['cmd'] == 'erase':
             if results['status'] == 'processing':
                 _logger.warn('{}: start timer to update progressbar'.format(self.objectName()))
                 if self.mTimerId is None:
@@ -3136,7 +3148,7 @@ class postDownloadSlot(QProcessSlot):
                 self.mFlashFlag = False
 
                 # handling various image flashed in postDownloads.
-                if results['src_filename'] == '/tmp/rescue.img':
+                if results['cmd'] == 'flash' and results['src_filename'] == '/tmp/rescue.img':
                     # recover rescue system success or failure
                     if results['status'] == 'success':
                         # recover rescue system success
@@ -3145,8 +3157,8 @@ class postDownloadSlot(QProcessSlot):
                         # critical error, cannot recover the boot image and also failed to download and flash
                         self.sendError({'NoFlash': True, 'ask': 'halt' if IsATargetBoard() else 'quit'})
 
-                elif results['src_filename'] == '/dev/zero' or results['src_filename'] == 'u-boot.imx':
-                    # target emmc has been flashed with zeros or androidthings bootloader, so
+                elif results['cmd'] == 'erase' or results['src_filename'] == 'u-boot.imx':
+                    # target emmc has been erased or flashed with androidthings bootloader, so
                     # 3. set the mmc boot partition option no matter if emmc boot partition is cleared or not
                     # {'cmd': 'config', 'subcmd': 'mmc', 'config_id': 'bootpart', 'config_action': 'enable/disable', 'boot_part_no': '1', 'send_ack':'1', 'target': self.mTgtStorage}
                     _logger.debug('{}: issue command to {} emmc boot partition'.format(self.objectName(), 'enable' if 'androidthings' in self.mPick['os'] else 'disable'))
@@ -51,11 +51,27 @@
 import os
 import stat
 import fcntl
+import mmap
+import struct
+import errno
+import ctypes
+import ctypes.util
 import mimetypes
+import base64
 import urllib.request
 import urllib.response
 import urllib.error
+import urllib.parse
+import http.client
+import ssl
 import socket
+import threading
+import concurrent.futures
+import collections
+import bisect
+import hashlib
+import json
+import xml.etree.ElementTree as ElementTree
 import logging
 from io import IOBase
 
@@ -83,11 +99,19 @@ class CompressedFile (object):
     def isMagic(cls, fname):
         try:
             with open(fname, 'rb') as f:
-                f.seek(0)
-                return f.read(1024).startswith((cls.magic,))
+                return cls.isMagicData(f.read(FormatRegistry.SNIFF_SIZE))
         except Exception:
             raise
 
+    @classmethod
+    def isMagicData(cls, data):
+        return bytes(data[:len(cls.magic)]) == cls.magic
+
+    @classmethod
+    def peek(cls, header):
+        # uncompressed start of the header, for sniffing the nested format
+        return None
+
     @classmethod
     def isFileType(cls, ftype):
         try:
@@ -103,12 +127,22 @@ class CompressedFile (object):
     def getOriginalSize(self):
         pass
 
+    def calcRec(self, endmatter):
+        return 0
+
     def comp(self, data):
         pass
 
     def decomp(self, data):
         pass
 
+    def decompIter(self, data, maxlen=-1):
+        # bounded decompression, yields the decompressed data at most maxlen
+        # bytes at a time, unbounded unless overridden
+        ret = self.decomp(data)
+        if ret:
+            yield ret
+
     def flush(self):
         pass
 
@@ -131,6 +165,11 @@ class TARFile (CompressedFile):
             return False
         return ret
 
+    @classmethod
+    def isMagicData(cls, data):
+        # ustar magic of the posix tar header
+        return bytes(data[257:257 + len(cls.magic)]) == cls.magic
+
     def getFileHandle(self):
         return tarfile.TarFile(self.mFilename, self.mMode)
 
@@ -172,11 +211,43 @@ class XZFile (CompressedFile):
                       {'id': lzma.FILTER_LZMA2, 'preset': 9 | lzma.PRESET_EXTREME},]
         self.mDecompR = None
         self.mCompR = None
+        self.mParallel = None
+        self.mMemLimit = XZIndex.MEMLIMIT
 
     def getFileHandle(self):
         return lzma.LZMAFile(self.mFilename, self.mMode)
 
+    def setMemLimit(self, memlimit):
+        """
+        sets the memory limit of the decompressors created from now on
+        """
+        self.mMemLimit = memlimit
+
+    @classmethod
+    def peek(cls, header):
+        return lzma.LZMADecompressor().decompress(header, len(header))
+
+    def setParallel(self, index, workers, start=0, budget=0):
+        """
+        decodes the blocks of index on workers threads, for the raw data fed to
+        decomp() from compressed offset start, within budget bytes of blocks
+        held, returns False for single block files, which are left to the
+        incremental decompressor
+        """
+        if self.mParallel:
+            self.mParallel.close()
+            self.mParallel = None
+        if index is None or workers < 2 or len(index.getBlocks()) < 2:
+            return False
+        self.mParallel = XZParallelDecoder(index, workers, start, self.mMemLimit, budget)
+        return True
+
     def getOriginalSize(self):
+        try:
+            # full index of all the streams, falls back to the end matter
+            return self.getIndex().getUncompressedSize()
+        except Exception as ex:
+            _logger.warning('{} (XZFile) index exception: {}'.format(type(self).__name__, ex))
         try:
             with open(self.mFilename, 'rb', 0) as f:
                 # get end matter for uncompressed size parsing
@@ -222,6 +293,13 @@ class XZFile (CompressedFile):
                 ret += (b & 0x7f) << (i*7);
         return ret
 
+    def getIndex(self):
+        """
+        returns the XZIndex of all the blocks of the xz file
+        """
+        with open(self.mFilename, 'rb', 0) as f:
+            return XZIndex(lambda start, end: os.pread(f.fileno(), end - start, start), os.fstat(f.fileno()).st_size)
+
     def comp(self, data):
         # incremental XZ/LMZA compression
         try:
@@ -235,18 +313,41 @@ class XZFile (CompressedFile):
     def decomp(self, data):
         # incremental XZ/LMZA decompression
         # read raw compressed data from filename given
+        return b''.join(self.decompIter(data))
+
+    def decompIter(self, data, maxlen=-1):
+        # bounded incremental XZ/LZMA decompression, the input left over by
+        # max_length is kept by the decompressor until it needs input again
         try:
-            if self.mDecompR is None:
-                self.mDecompR = lzma.LZMADecompressor(format=lzma.FORMAT_XZ, memlimit=100663296) # 111982830(103MB) 134217728(128MB)
-            # decompress the read data and return uncompressed data
-            return self.mDecompR.decompress(data)
+            if self.mParallel:
+                # blocks decoded on the thread pool, in pieces of maxlen
+                yield from self.mParallel.decompIter(data, maxlen)
+                return
+            while True:
+                if self.mDecompR is None:
+                    # skip the stream padding in between concatenated streams
+                    if data and data[0] == 0:
+                        data = bytes(data).lstrip(b'\x00')
+                    if not data:
+                        return
+                    self.mDecompR = lzma.LZMADecompressor(format=lzma.FORMAT_XZ, memlimit=self.mMemLimit)
+                # decompress the read data and return uncompressed data
+                ret = self.mDecompR.decompress(data, maxlen)
+                data = b''
+                if ret:
+                    yield ret
+                if self.mDecompR.eof:
+                    # next stream of a multi-stream xz file follows
+                    data = self.mDecompR.unused_data
+                    self.mDecompR = None
+                elif self.mDecompR.needs_input:
+                    return
         except lzma.LZMAError as err:
             _logger.error('{} (XZFile) lzma fail decompress within given memory limit: {}'.format(type(self).__name__, err))
             raise
         except Exception as ex:
             _logger.error('{} (XZFile) lzma decompress exception: {}'.format(type(self).__name__, ex))
             raise
-        return 0
 
     def flush(self):
         try:
@@ -258,6 +359,284 @@ class XZFile (CompressedFile):
             raise
         return 0
 
+class XZIndex(object):
+    """
+    Index of all the blocks of a xz file, parsed backwards from the end of file
+    through the stream footer, index field and stream header of every stream,
+    skipping stream padding, i.e. supports multi-stream files and index fields
+    of any size. readat(start, end) returns the bytes from start up to end of
+    the xz file, so the index can be parsed from local and web files alike
+    """
+    MEMLIMIT = 100663296 # 111982830(103MB) 134217728(128MB)
+    HEADER_SIZE = 12
+    FOOTER_MAGIC = b'\x59\x5A'
+
+    def __init__(self, readat, filesize):
+        super().__init__()
+        # each stream as dict of offset, header, index_offset and end
+        self.mStreams = []
+        # each block as (compressed offset, uncompressed offset, compressed
+        # size, uncompressed size, stream number)
+        self.mBlocks = []
+        self.__parse(readat, filesize)
+        self.mUOffsets = [b[1] for b in self.mBlocks]
+        self.mCOffsets = [b[0] for b in self.mBlocks]
+
+    def __parse(self, readat, filesize):
+        streams = []
+        end = filesize
+        while end > 0:
+            if end < 2 * self.HEADER_SIZE:
+                raise ValueError('truncated xz stream at {}'.format(end))
+            footer = readat(end - self.HEADER_SIZE, end)
+            if footer[-2:] != self.FOOTER_MAGIC:
+                if footer[-4:] == b'\x00\x00\x00\x00':
+                    # stream padding is multiple of 4 null bytes
+                    end -= 4
+                    continue
+                raise ValueError('no xz stream footer at {}'.format(end - self.HEADER_SIZE))
+            if zlib.crc32(footer[4:10]) != int.from_bytes(footer[0:4], byteorder='little'):
+                raise ValueError('xz stream footer crc32 mismatch at {}'.format(end - self.HEADER_SIZE))
+            backsize = (int.from_bytes(footer[4:8], byteorder='little') + 1) * 4
+            indexstart = end - self.HEADER_SIZE - backsize
+            records = self.__decodeIndex(readat(indexstart, end - self.HEADER_SIZE))
+            start = indexstart - sum(-(-unpadded // 4) * 4 for unpadded, _ in records) - self.HEADER_SIZE
+            if start < 0:
+                raise ValueError('xz index field exceeds the file at {}'.format(indexstart))
+            header = readat(start, start + self.HEADER_SIZE)
+            if not header.startswith(XZFile.magic) or header[6:8] != footer[8:10] or \
+               zlib.crc32(header[6:8]) != int.from_bytes(header[8:12], byteorder='little'):
+                raise ValueError('no matching xz stream header at {}'.format(start))
+            streams.insert(0, {'offset': start, 'header': header, 'index_offset': indexstart, 'end': end, 'records': records})
+            end = start
+        # offsets of the blocks, counting from the first stream
+        uoffset = 0
+        for num, stream in enumerate(streams):
+            coffset = stream['offset'] + self.HEADER_SIZE
+            for unpadded, uncompressed in stream.pop('records'):
+                # blocks are padded to multiple of 4 bytes
+                padded = -(-unpadded // 4) * 4
+                self.mBlocks.append((coffset, uoffset, padded, uncompressed, num))
+                coffset += padded
+                uoffset += uncompressed
+        self.mStreams = streams
+
+    def __decodeIndex(self, indexdata):
+        # index field: indicator, number of records, records of (unpadded
+        # size, uncompressed size), padding and crc32
+        if len(indexdata) < 8 or indexdata[0] != 0:
+            raise ValueError('not a xz index field')
+        if zlib.crc32(indexdata[:-4]) != int.from_bytes(indexdata[-4:], byteorder='little'):
+            raise ValueError('xz index field crc32 mismatch')
+        numrec, pos = self.__decodeVarint(indexdata, 1)
+        records = []
+        for i in range(numrec):
+            unpadded, pos = self.__decodeVarint(indexdata, pos)
+            uncompressed, pos = self.__decodeVarint(indexdata, pos)
+            records.append((unpadded, uncompressed))
+        return records
+
+    @staticmethod
+    def __decodeVarint(data, pos):
+        # xz multibyte integer, 7 bits per byte, least significant byte first
+        ret = 0
+        for i in range(9):
+            ret |= (data[pos + i] & 0x7f) << (i * 7)
+            if not (data[pos + i] & 0x80):
+                return ret, pos + i + 1
+        raise ValueError('xz multibyte integer too long')
+
+    def getBlocks(self):
+        return self.mBlocks
+
+    def getStreams(self):
+        return self.mStreams
+
+    def getUncompressedSize(self):
+        if self.mBlocks:
+            return self.mBlocks[-1][1] + self.mBlocks[-1][3]
+        return 0
+
+    def findBlock(self, uoffset):
+        """
+        returns the number of the block holding uncompressed offset uoffset
+        """
+        return max(bisect.bisect_right(self.mUOffsets, uoffset) - 1, 0)
+
+    def findBlockAt(self, coffset):
+        """
+        returns the number of the first block starting at or after compressed
+        offset coffset
+        """
+        return bisect.bisect_left(self.mCOffsets, coffset)
+
+
+
+class XZSeekableReader(object):
+    """
+    Seekable file like reader of the uncompressed data of a xz file, on top of
+    the XZIndex. Each block is decoded with its own decompressor, fed with the
+    stream header followed by the block, so reading starts at the block holding
+    the position instead of at the start of file
+    """
+    def __init__(self, index, readat, chunksize=1048576, memlimit=None):
+        super().__init__()
+        self.mIndex = index
+        self.mReadAt = readat
+        self.mChunkSize = chunksize
+        self.mMemLimit = memlimit if memlimit else XZIndex.MEMLIMIT
+        self.mSize = index.getUncompressedSize()
+        self.mPos = 0
+        # decoder state of the current block
+        self.mBlock = -1
+        self.mDecompR = None
+        self.mCPos = 0
+        self.mCEnd = 0
+        self.mUPos = 0
+        self.mBytesRead = 0
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.mPos
+        elif whence == 2:
+            offset += self.mSize
+        if offset < 0:
+            raise ValueError('negative seek position {}'.format(offset))
+        self.mPos = offset
+        return self.mPos
+
+    def tell(self):
+        return self.mPos
+
+    def __startBlock(self, num):
+        coffset, uoffset, csize, usize, stream = self.mIndex.getBlocks()[num]
+        self.mDecompR = lzma.LZMADecompressor(format=lzma.FORMAT_XZ, memlimit=self.mMemLimit)
+        self.mDecompR.decompress(self.mIndex.getStreams()[stream]['header'])
+        self.mBlock = num
+        self.mCPos = coffset
+        self.mCEnd = coffset + csize
+        self.mUPos = uoffset
+
+    def __decode(self, maxlen):
+        data = b''
+        if self.mDecompR.needs_input:
+            if self.mCPos >= self.mCEnd:
+                raise lzma.LZMAError('xz block {} ends before its uncompressed size'.format(self.mBlock))
+            data = self.mReadAt(self.mCPos, min(self.mCPos + self.mChunkSize, self.mCEnd))
+            self.mCPos += len(data)
+            self.mBytesRead += len(data)
+        ret = self.mDecompR.decompress(data, maxlen)
+        self.mUPos += len(ret)
+        return ret
+
+    def read(self, size=-1):
+        if size < 0 or size > self.mSize - self.mPos:
+            size = max(self.mSize - self.mPos, 0)
+        ret = bytearray()
+        while len(ret) < size:
+            num = self.mIndex.findBlock(self.mPos)
+            blockend = self.mIndex.getBlocks()[num][1] + self.mIndex.getBlocks()[num][3]
+            if num != self.mBlock or self.mUPos > self.mPos:
+                self.__startBlock(num)
+            # decode and discard up to the position within the block
+            while self.mUPos < self.mPos:
+                self.__decode(min(self.mPos - self.mUPos, self.mChunkSize))
+            data = self.__decode(min(size - len(ret), blockend - self.mUPos))
+            ret += data
+            self.mPos += len(data)
+            if self.mUPos >= blockend:
+                self.mBlock = -1
+        return bytes(ret)
+
+    def getBytesRead(self):
+        """
+        returns the number of compressed bytes read so far
+        """
+        return self.mBytesRead
+
+    def close(self):
+        self.mDecompR = None
+        self.mBlock = -1
+
+
+
+class XZParallelDecoder(object):
+    """
+    Decodes the blocks of a block indexed xz file, e.g. made by xz -T, on a
+    pool of threads, as lzma releases the GIL while decoding. The raw data is
+    fed in file order by decompIter(), every complete block is decoded by its
+    own decompressor, and the uncompressed data is yielded in file order.
+    start is the compressed offset of the first raw data fed in. budget bounds
+    the memory of the blocks held at once, compressed and decoded, sized by
+    the largest block of the index, 0 for workers + 1 blocks
+    """
+    def __init__(self, index, workers, start=0, memlimit=None, budget=0):
+        super().__init__()
+        self.mIndex = index
+        self.mMemLimit = memlimit if memlimit else XZIndex.MEMLIMIT
+        # decoded blocks held back for the writer at most
+        self.mMaxPending = workers + 1
+        if budget > 0:
+            blocksize = max(csize + usize for _, _, csize, usize, _ in index.getBlocks())
+            self.mMaxPending = max(1, min(self.mMaxPending, budget // blocksize))
+            workers = min(workers, self.mMaxPending)
+        self.mExecutor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='XZDec')
+        self.mPending = collections.deque()
+        self.mRaw = bytearray()
+        self.mRawStart = start
+        self.mBlock = index.findBlockAt(start)
+        _logger.debug('{} workers: {} pending: {}'.format(type(self).__name__, workers, self.mMaxPending))
+
+    @staticmethod
+    def __decodeBlock(header, blockdata, usize, memlimit):
+        decompr = lzma.LZMADecompressor(format=lzma.FORMAT_XZ, memlimit=memlimit)
+        decompr.decompress(header)
+        data = decompr.decompress(blockdata)
+        if len(data) != usize:
+            raise lzma.LZMAError('xz block decoded to {} instead of {} bytes'.format(len(data), usize))
+        return data
+
+    @staticmethod
+    def __split(data, maxlen):
+        # the decoded block in pieces of at most maxlen bytes, without copies
+        view = memoryview(data)
+        if maxlen <= 0:
+            maxlen = len(view)
+        for pos in range(0, len(view), maxlen):
+            yield view[pos:pos + maxlen]
+
+    def decompIter(self, data, maxlen=-1):
+        self.mRaw += data
+        blocks = self.mIndex.getBlocks()
+        rawend = self.mRawStart + len(self.mRaw)
+        # submit every block complete in the raw data
+        while self.mBlock < len(blocks) and blocks[self.mBlock][0] + blocks[self.mBlock][2] <= rawend:
+            coffset, uoffset, csize, usize, stream = blocks[self.mBlock]
+            # skips stream headers, index fields and stream padding
+            del self.mRaw[:coffset - self.mRawStart]
+            blockdata = self.mRaw[:csize]
+            del self.mRaw[:csize]
+            self.mRawStart = coffset + csize
+            if len(self.mPending) >= self.mMaxPending:
+                # waits on the oldest block rather than buffering any more
+                yield from self.__split(self.mPending.popleft().result(), maxlen)
+            self.mPending.append(self.mExecutor.submit(self.__decodeBlock, \
+                                 self.mIndex.getStreams()[stream]['header'], blockdata, usize, self.mMemLimit))
+            self.mBlock += 1
+        done = self.mBlock >= len(blocks)
+        while self.mPending and (done or self.mPending[0].done()):
+            yield from self.__split(self.mPending.popleft().result(), maxlen)
+        if done and not self.mPending:
+            self.close()
+
+    def close(self):
+        for future in self.mPending:
+            future.cancel()
+        self.mPending.clear()
+        self.mExecutor.shutdown(wait=False)
+
+
+
 import bz2
 class BZ2File (CompressedFile):
     """
@@ -268,10 +647,45 @@ class BZ2File (CompressedFile):
     file_type = 'bz2'
     mime_type = 'compressed/bz2'
 
+    def __init__(self, fname, mode):
+        super().__init__(fname, mode)
+        self.mDecompR = None
+
     def getFileHandle(self):
         return bz2.BZ2File(self.mFilename, self.mMode)
 
+    @classmethod
+    def peek(cls, header):
+        return bz2.BZ2Decompressor().decompress(header, len(header))
+
+    def decomp(self, data):
+        # incremental bzip2 decompression
+        try:
+            if self.mDecompR is None:
+                self.mDecompR = bz2.BZ2Decompressor()
+            return self.mDecompR.decompress(data)
+        except Exception as ex:
+            _logger.error('{} (BZ2File) bz2 decompress exception: {}'.format(type(self).__name__, ex))
+            raise
+
+    def decompIter(self, data, maxlen=-1):
+        # bounded incremental bzip2 decompression
+        try:
+            if self.mDecompR is None:
+                self.mDecompR = bz2.BZ2Decompressor()
+            while not self.mDecompR.eof:
+                ret = self.mDecompR.decompress(data, maxlen)
+                data = b''
+                if ret:
+                    yield ret
+                if self.mDecompR.needs_input:
+                    return
+        except Exception as ex:
+            _logger.error('{} (BZ2File) bz2 decompress exception: {}'.format(type(self).__name__, ex))
+            raise
+
 import gzip
+import zlib
 class GZFile (CompressedFile):
     """
     Working directly with gzip files
@@ -281,9 +695,568 @@ class GZFile (CompressedFile):
     file_type = 'gz'
     mime_type = 'compressed/gz'
 
+    def __init__(self, fname, mode):
+        super().__init__(fname, mode)
+        self.mDecompR = None
+
     def getFileHandle(self):
         return gzip.GzipFile(self.mFilename, self.mMode)
 
+    @classmethod
+    def peek(cls, header):
+        return zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(header, len(header))
+
+    def calcRec(self, endmatter):
+        # ISIZE, i.e. uncompressed size modulo 2^32, is the last 4 bytes
+        return int.from_bytes(endmatter[-4:], byteorder='little')
+
+    def decomp(self, data):
+        # incremental gzip decompression, wbits=16+MAX_WBITS for gzip header
+        try:
+            if self.mDecompR is None:
+                self.mDecompR = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            return self.mDecompR.decompress(data)
+        except Exception as ex:
+            _logger.error('{} (GZFile) zlib decompress exception: {}'.format(type(self).__name__, ex))
+            raise
+
+    def decompIter(self, data, maxlen=-1):
+        # bounded incremental gzip decompression, zlib keeps the input left
+        # over by max_length in unconsumed_tail, and may hold output back
+        # while a call returns exactly max_length bytes
+        try:
+            if self.mDecompR is None:
+                self.mDecompR = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            maxlen = max(maxlen, 0)
+            while True:
+                ret = self.mDecompR.decompress(data, maxlen)
+                data = self.mDecompR.unconsumed_tail
+                if ret:
+                    yield ret
+                if not data and (maxlen == 0 or len(ret) < maxlen):
+                    return
+        except Exception as ex:
+            _logger.error('{} (GZFile) zlib decompress exception: {}'.format(type(self).__name__, ex))
+            raise
+
+
+
+class SparseImageFile (CompressedFile):
+    """
+    Working with android sparse images, as made by img2simg, the RAW, FILL
+    and DONT_CARE chunks are decoded into extents of the expanded image,
+    i.e. (chunk type, offset, length, data), where data is the raw data, the
+    4 bytes fill value, or None. Also decodes images wrapped in xz or gz,
+    as the magic is checked on the uncompressed data
+    """
+    magic = b'\x3a\xff\x26\xed'
+    file_type = 'simg'
+    mime_type = 'compressed/simg'
+    HEADER_SIZE = 28
+    CHUNK_RAW = 0xCAC1
+    CHUNK_FILL = 0xCAC2
+    CHUNK_DONT_CARE = 0xCAC3
+    CHUNK_CRC32 = 0xCAC4
+
+    def __init__(self, fname, mode):
+        super().__init__(fname, mode)
+        self.mBuffer = bytearray()
+        self.mState = 'header'
+        self.mNeed = self.HEADER_SIZE
+        self.mChunkHdrSize = 12
+        self.mBlockSize = 0
+        self.mImageSize = 0
+        self.mChunks = 0
+        self.mOffset = 0
+        self.mRemain = 0
+
+    def getOriginalSize(self):
+        try:
+            with open(self.mFilename, 'rb', 0) as f:
+                self.__parseHeader(f.read(self.HEADER_SIZE))
+            return self.mImageSize
+        except Exception as ex:
+            _logger.error('{} (SparseImageFile) calsize exception: {}'.format(type(self).__name__, ex))
+            return 0
+
+    def getImageSize(self):
+        """
+        returns the size of the expanded image, once the header is decoded
+        """
+        return self.mImageSize
+
+    def __parseHeader(self, header):
+        magic, major, minor, hdrsize, chunkhdrsize, blksize, totalblks, totalchunks, checksum = \
+            struct.unpack('<IHHHHIIII', header[:self.HEADER_SIZE])
+        if header[:4] != self.magic or major != 1:
+            raise ValueError('not an android sparse image version 1')
+        self.mChunkHdrSize = chunkhdrsize
+        self.mBlockSize = blksize
+        self.mImageSize = blksize * totalblks
+        self.mChunks = totalchunks
+        return hdrsize
+
+    def __parse(self, data, extents):
+        # parses the bytes needed by the current state, sets the next state
+        if self.mState == 'header':
+            skip = self.__parseHeader(data) - self.HEADER_SIZE
+            self.mState, self.mNeed = ('skip', skip) if skip > 0 else ('chunk', self.mChunkHdrSize)
+        elif self.mState == 'skip':
+            self.mState, self.mNeed = 'chunk', self.mChunkHdrSize
+        elif self.mState == 'chunk':
+            chunktype, _, chunksize, totalsize = struct.unpack('<HHII', data[:12])
+            size = chunksize * self.mBlockSize
+            datasize = totalsize - self.mChunkHdrSize
+            self.mChunks -= 1
+            self.mState, self.mNeed = 'chunk', self.mChunkHdrSize
+            if chunktype == self.CHUNK_RAW and datasize == size:
+                self.mState, self.mRemain = 'raw', size
+            elif chunktype == self.CHUNK_FILL and datasize == 4:
+                self.mState, self.mNeed, self.mRemain = 'fill', 4, size
+            elif chunktype == self.CHUNK_DONT_CARE and datasize == 0:
+                extents.append((self.CHUNK_DONT_CARE, self.mOffset, size, None))
+                self.mOffset += size
+            elif chunktype == self.CHUNK_CRC32 and datasize == 4:
+                self.mState, self.mNeed = 'crc', 4
+            else:
+                raise ValueError('invalid sparse image chunk {:#x} at {}'.format(chunktype, self.mOffset))
+        elif self.mState == 'fill':
+            extents.append((self.CHUNK_FILL, self.mOffset, self.mRemain, data))
+            self.mOffset += self.mRemain
+            self.mState, self.mNeed = 'chunk', self.mChunkHdrSize
+        elif self.mState == 'crc':
+            self.mState, self.mNeed = 'chunk', self.mChunkHdrSize
+        if self.mState == 'chunk' and self.mChunks == 0 and self.mBlockSize:
+            self.mState = 'done'
+
+    def decomp(self, data):
+        # incremental sparse image decoding, returns the list of extents
+        extents = []
+        view = memoryview(data)
+        pos = 0
+        while pos < len(view) and self.mState != 'done':
+            if self.mState == 'raw':
+                # raw data is handed on as is, without waiting for the whole chunk
+                size = min(self.mRemain, len(view) - pos)
+                extents.append((self.CHUNK_RAW, self.mOffset, size, view[pos:pos + size]))
+                self.mOffset += size
+                self.mRemain -= size
+                pos += size
+                if self.mRemain == 0:
+                    self.mState, self.mNeed = 'chunk', self.mChunkHdrSize
+                    if self.mChunks == 0:
+                        self.mState = 'done'
+                continue
+            size = min(self.mNeed - len(self.mBuffer), len(view) - pos)
+            self.mBuffer += view[pos:pos + size]
+            pos += size
+            if len(self.mBuffer) == self.mNeed:
+                data = bytes(self.mBuffer)
+                self.mBuffer.clear()
+                self.__parse(data, extents)
+        return extents
+
+
+
+class FormatRegistry(object):
+    """
+    Registry of the CompressedFile formats, all matched against the header
+    of a file read once, i.e. sniff() returns the decode chain, outermost
+    format first, including the nested formats, e.g. tar inside xz. Formats
+    registered with handle=False are decoded on the data stream instead of
+    by the CompressedFile handle of the file, e.g. android sparse images
+    """
+    SNIFF_SIZE = 8192 # 8K
+    MAX_NESTING = 4
+    mFormats = []
+
+    @classmethod
+    def register(cls, fmt, handle=True):
+        """
+        registers a CompressedFile class, matched after the ones before it
+        """
+        cls.mFormats.append((fmt, handle))
+        return fmt
+
+    @classmethod
+    def sniff(cls, header, nesting=0):
+        """
+        returns the list of CompressedFile classes decoding the header
+        """
+        for fmt, handle in cls.mFormats:
+            if header and fmt.isMagicData(header):
+                try:
+                    inner = fmt.peek(header) if nesting < cls.MAX_NESTING else None
+                except Exception as ex:
+                    _logger.debug('{} sniff {} nested format: {}'.format(cls.__name__, fmt.file_type, ex))
+                    inner = None
+                return [fmt] + (cls.sniff(inner, nesting + 1) if inner else [])
+        return []
+
+    @classmethod
+    def findFileType(cls, ftype):
+        """
+        returns the list of the CompressedFile class of a file type, e.g. of
+        the content type of a web file
+        """
+        for fmt, handle in cls.mFormats:
+            if handle and fmt.isFileType(ftype):
+                return [fmt]
+        return []
+
+    @classmethod
+    def getHandle(cls, chain, fname, mode):
+        """
+        returns the CompressedFile instance of the outermost format of chain,
+        or None
+        """
+        if chain and (chain[0], True) in cls.mFormats:
+            return chain[0](fname, mode)
+        return None
+
+for _fmt in (BZ2File, GZFile, XZFile, ZIPFile, TARFile):
+    FormatRegistry.register(_fmt)
+FormatRegistry.register(SparseImageFile, handle=False)
+
+
+
+class BoundedDecoder(object):
+    """
+    Bounded memory decoding of a CompressedFile, the raw data is decompressed
+    at most blocksize bytes at a time, with max_length and needs_input of the
+    decompressor, so a highly compressible chunk, e.g. of zeros, never
+    expands at once. decode() yields output blocks of exactly blocksize
+    bytes, the remainder is held back for the next raw data, and returned by
+    flush() at the end of the raw data
+    """
+    def __init__(self, cfile, blocksize):
+        super().__init__()
+        self.mCFile = cfile
+        self.mBlockSize = blocksize
+        self.mBuffer = bytearray()
+
+    def getBlockSize(self):
+        return self.mBlockSize
+
+    def decode(self, data):
+        for ret in self.mCFile.decompIter(data, self.mBlockSize):
+            view = memoryview(ret)
+            if self.mBuffer:
+                # complete the held back block first
+                size = min(self.mBlockSize - len(self.mBuffer), len(view))
+                self.mBuffer += view[:size]
+                view = view[size:]
+                if len(self.mBuffer) < self.mBlockSize:
+                    continue
+                yield bytes(self.mBuffer)
+                self.mBuffer.clear()
+            while len(view) >= self.mBlockSize:
+                yield view[:self.mBlockSize]
+                view = view[self.mBlockSize:]
+            self.mBuffer += view
+
+    def flush(self):
+        ret = bytes(self.mBuffer)
+        self.mBuffer.clear()
+        return ret
+
+
+
+# ============================================================
+# Preallocated buffer pool for block I/O
+# ============================================================
+class BufferPool(object):
+    """
+    Pool of reusable buffer slots, each slot is an anonymous mmap, i.e. page
+    aligned, handed out as a writable memoryview to be filled by ReadInto().
+    When the pool runs dry, an extra slot is allocated rather than blocking,
+    so it does not deadlock a pipeline holding all the slots
+    """
+    def __init__(self, slotsize, count):
+        super().__init__()
+        self.mSlotSize = slotsize
+        self.mLock = threading.Lock()
+        self.mSlots = {}
+        self.mFree = []
+        for i in range(count):
+            self.mFree.append(self.__allocSlot())
+
+    def __allocSlot(self):
+        slot = mmap.mmap(-1, self.mSlotSize)
+        self.mSlots[id(slot)] = slot
+        return slot
+
+    def acquire(self):
+        """
+        returns a free slot, as a memoryview of slotsize bytes
+        """
+        with self.mLock:
+            if self.mFree:
+                slot = self.mFree.pop()
+            else:
+                _logger.debug('{} ran dry, allocates slot {}'.format(type(self).__name__, len(self.mSlots)))
+                slot = self.__allocSlot()
+        return memoryview(slot)
+
+    def release(self, buf):
+        """
+        returns the slot of buf, or any slice of it, back to the pool
+        """
+        slot = buf.obj if isinstance(buf, memoryview) else buf
+        with self.mLock:
+            if id(slot) in self.mSlots and self.mSlots[id(slot)] is slot and slot not in self.mFree:
+                self.mFree.append(slot)
+
+    def getSlotSize(self):
+        return self.mSlotSize
+
+
+
+# ============================================================
+# Block map (bmap) of images
+# ============================================================
+class BlockMap(object):
+    """
+    Block map of an image, as published by bmaptool in a .bmap file next to
+    the image, i.e. the byte ranges of the image holding data, each with a
+    checksum. Only the mapped ranges have to be read, decoded and written.
+    Without data, the block map of the given (start, end, checksum) ranges,
+    e.g. the segments of a delta flash
+    """
+    def __init__(self, data=None, imagesize=0, ranges=None, checksum='sha256'):
+        super().__init__()
+        # state of verify()
+        self.mRange = 0
+        self.mHasher = None
+        if data is None:
+            self.mVersion = '2.0'
+            self.mImageSize = imagesize
+            self.mBlockSize = 4096
+            self.mChecksumType = checksum
+            self.mRanges = list(ranges or [])
+            return
+        root = ElementTree.fromstring(data)
+        if root.tag != 'bmap':
+            raise ValueError('not a bmap file')
+        self.mVersion = root.get('version', '1.0').strip()
+        self.mImageSize = int(root.findtext('ImageSize'))
+        self.mBlockSize = int(root.findtext('BlockSize'))
+        # sha1 up to version 1.4, sha256 or as specified from version 2.0
+        self.mChecksumType = (root.findtext('ChecksumType') or 'sha1').strip()
+        self.__verifyFile(data, root)
+        attr = 'chksum' if int(self.mVersion.split('.')[0]) >= 2 else 'sha1'
+        # each range as (start, end, checksum) in bytes
+        self.mRanges = []
+        for elem in root.find('BlockMap').iter('Range'):
+            first, _, last = elem.text.strip().partition('-')
+            self.mRanges.append((int(first) * self.mBlockSize, \
+                                 min((int(last or first) + 1) * self.mBlockSize, self.mImageSize), elem.get(attr)))
+
+    def __verifyFile(self, data, root):
+        # the checksum of the bmap file is taken with its own value zeroed
+        for tag, ctype in (('BmapFileChecksum', self.mChecksumType), ('BmapFileSHA1', 'sha1')):
+            expected = (root.findtext(tag) or '').strip()
+            if expected:
+                hasher = hashlib.new(ctype)
+                hasher.update(data.replace(expected.encode(), b'0' * len(expected), 1))
+                if hasher.hexdigest() != expected:
+                    raise ValueError('bmap file checksum mismatch')
+                return
+
+    def getImageSize(self):
+        return self.mImageSize
+
+    def getMappedSize(self):
+        return sum(end - start for start, end, _ in self.mRanges)
+
+    def getRanges(self):
+        return self.mRanges
+
+    def clip(self, size):
+        """
+        drops the mapped data beyond size, a cut range is not verified
+        """
+        self.mRanges = [(start, min(end, size), chksum if end <= size else None) \
+                        for start, end, chksum in self.mRanges if start < size]
+
+    def pieces(self, chunksize):
+        """
+        yields (offset, size) of the mapped ranges, in pieces of chunksize
+        """
+        for start, end, _ in self.mRanges:
+            for offset in range(start, end, chunksize):
+                yield offset, min(chunksize, end - offset)
+
+    def split(self, chunks):
+        """
+        yields (offset, data) of the mapped data, out of chunks of the whole
+        image data in order, and stops after the last mapped range
+        """
+        pos = 0
+        num = 0
+        for data in chunks:
+            view = memoryview(data)
+            end = pos + len(view)
+            while num < len(self.mRanges) and self.mRanges[num][0] < end:
+                start, stop = max(self.mRanges[num][0], pos), min(self.mRanges[num][1], end)
+                if start < stop:
+                    yield start, view[start - pos:stop - pos]
+                if self.mRanges[num][1] > end:
+                    break
+                num += 1
+            pos = end
+            if num >= len(self.mRanges):
+                return
+
+    def verify(self, offset, data):
+        """
+        verifies the mapped data in order, raises IOError when the checksum
+        of a range does not match
+        """
+        while self.mRanges[self.mRange][1] <= offset:
+            self.mRange += 1
+        start, end, chksum = self.mRanges[self.mRange]
+        if offset == start:
+            self.mHasher = hashlib.new(self.mChecksumType)
+        if self.mHasher is not None:
+            self.mHasher.update(data)
+            if offset + len(data) == end:
+                if chksum and self.mHasher.hexdigest() != chksum:
+                    raise IOError('bmap range {}-{} checksum mismatch'.format(start, end))
+                self.mHasher = None
+
+
+
+# ============================================================
+# Segment hash manifest of images
+# ============================================================
+class SegmentManifest(object):
+    """
+    Segment hash manifest of an image, published in json as a .segments
+    file next to the image, i.e. the hash of every fixed size segment of the
+    image, and the root of the binary hash tree over them. The segments are
+    hashed independently, i.e. in parallel, and a root not matching is
+    narrowed down to the ranges of the segments not matching
+    """
+    VERSION = 1
+    SUFFIX = '.segments'
+    SEGMENT_SIZE = 4194304 # 4MB
+
+    def __init__(self, data=None, algo='sha256', segsize=SEGMENT_SIZE, imagesize=0, hashes=None):
+        super().__init__()
+        root = None
+        if data is not None:
+            manifest = json.loads(data)
+            if not isinstance(manifest, dict) or manifest.get('version') != self.VERSION:
+                raise ValueError('not a segment manifest')
+            algo, segsize, imagesize = manifest['algo'], int(manifest['segment_size']), int(manifest['image_size'])
+            hashes, root = manifest['segments'], manifest.get('root')
+        hashlib.new(algo)
+        self.mAlgo = algo
+        self.mSegmentSize = segsize
+        self.mImageSize = imagesize
+        self.mHashes = [h.lower() for h in (hashes or [])]
+        if segsize <= 0 or len(self.mHashes) != self.getNumSegments():
+            raise ValueError('segment manifest of {} segments, instead of {}'.format(len(self.mHashes), self.getNumSegments()))
+        self.mRoot = self.hashTree(algo, self.mHashes)
+        if root is not None and root.lower() != self.mRoot:
+            raise ValueError('segment manifest root mismatch')
+
+    @staticmethod
+    def hashTree(algo, hashes):
+        """
+        returns the root of the binary hash tree over the segment hashes, each
+        node hashes the digests of its two children, an odd one is carried up
+        """
+        level = [bytes.fromhex(h) for h in hashes]
+        if not level:
+            return hashlib.new(algo).hexdigest()
+        while len(level) > 1:
+            # nodes are prefixed, so they never hash like a segment
+            nodes = [hashlib.new(algo, b'\x01' + level[i] + level[i + 1]).digest() for i in range(0, len(level) - 1, 2)]
+            if len(level) % 2:
+                nodes.append(level[-1])
+            level = nodes
+        return level[0].hex()
+
+    def getAlgo(self):
+        return self.mAlgo
+
+    def getSegmentSize(self):
+        return self.mSegmentSize
+
+    def getImageSize(self):
+        return self.mImageSize
+
+    def getNumSegments(self):
+        return -(-self.mImageSize // self.mSegmentSize)
+
+    def getHashes(self):
+        return self.mHashes
+
+    def getRoot(self):
+        return self.mRoot
+
+    def segments(self):
+        """
+        yields (offset, size) of every segment of the image
+        """
+        for offset in range(0, self.mImageSize, self.mSegmentSize):
+            yield offset, min(self.mSegmentSize, self.mImageSize - offset)
+
+    def compare(self, hashes):
+        """
+        returns the (start, end) ranges of the image, of adjacent segments
+        merged, whose hashes in order do not match the manifest
+        """
+        ranges = []
+        for num, (offset, size) in enumerate(self.segments()):
+            if num < len(hashes) and hashes[num] == self.mHashes[num]:
+                continue
+            if ranges and ranges[-1][1] == offset:
+                ranges[-1] = (ranges[-1][0], offset + size)
+            else:
+                ranges.append((offset, offset + size))
+        return ranges
+
+    def dumps(self):
+        """
+        returns the manifest in json, to be published next to the image
+        """
+        return json.dumps({'version': self.VERSION, 'algo': self.mAlgo, 'segment_size': self.mSegmentSize, \
+                           'image_size': self.mImageSize, 'root': self.mRoot, 'segments': self.mHashes}, indent=1)
+
+
+
+# ============================================================
+# Zeroing ranges of block devices and regular files
+# ============================================================
+# ioctls from linux/fs.h
+BLKDISCARD = 0x1277 # _IO(0x12,119)
+BLKZEROOUT = 0x127f # _IO(0x12,127)
+BLKSSZGET = 0x1268 # _IO(0x12,104)
+# modes from linux/falloc.h
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+FALLOC_FL_ZERO_RANGE = 0x10
+
+_libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+# 64 bit offsets on 32 bit arm as well
+_libc_fallocate = getattr(_libc, 'fallocate64', _libc.fallocate)
+_libc_fallocate.argtypes = (ctypes.c_int, ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong)
+
+def _fallocate(fd, mode, offset, length):
+    # os.posix_fallocate() does not take the mode, e.g. for punching holes
+    if _libc_fallocate(fd, mode, offset, length) != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+
+# max number of iovecs of a single pwritev, from limits.h
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (ValueError, OSError):
+    IOV_MAX = 1024
+
 
 
 # ============================================================
@@ -293,44 +1266,365 @@ class BaseInputOutput(object):
     """
     BaseInputOutput
     """
+    # write durability policies, i.e. when the written data are synced to disk
+    SYNC_POLICIES = ('chunk', 'size', 'checkpoint', 'close')
+    # sparse write modes, i.e. how all-zero blocks are written
+    SPARSE_MODES = ('off', 'zeroout', 'discard', 'skip')
+    SPARSE_BLOCK = 65536 # 64KB
+    # erase modes, i.e. how a range is erased by Erase()
+    ERASE_MODES = ('zeroout', 'discard')
+    # write combining, adjacent writes are submitted together by pwritev
+    COMBINE_SIZE = 4194304 # 4MB
+    COMBINE_ALIGN = 4096
+    # O_DIRECT writes and reads go through an aligned bounce buffer
+    DIRECT_BOUNCE = 4194304 # 4MB
+    # pages behind the read cursor are dropped in windows of this size
+    ADVISE_WINDOW = 8388608 # 8MB
+
     def __init__(self, filename, mode='rb+'):
         super().__init__()
         self.mHandle = None
         self.mFilename = filename
         self.mMode = mode
         self.mBuffer = 0 if 'b' in self.mMode else 1
+        self.mSyncPolicy = 'chunk'
+        self.mSyncSize = 0
+        self.mSyncBarrier = 0
+        self.mUnsynced = 0
+        self.mSparseMode = 'off'
+        self.mZeroRange = None
+        self.mSparseImage = None
+        self.mDecodeSparse = False
+        self.mCombine = []
+        self.mCombineStart = 0
+        self.mCombineSize = 0
+        self.mCombineLimit = 0
+        self.mDirect = False
+        self.mDirectFd = None
+        self.mDirectAlign = 512
+        self.mBounce = None
+        self.mReadAhead = 0
+        self.mReadAheadMark = 0
+        self.mDropBehind = False
+        self.mDropStart = 0
+        self.mDirtyRange = None
+        self.mCopyFileRange = True
         self._open()
 
     def _write(self, data, start):
         # should try python3 -u flag to get unbuffered writes for all file I/O
         try:
             if (self._open()):
-                if 'b' in self.mMode:
-                    # NOTE: we always seek from start of file
-                    self.mHandle.seek(start, 0)
-                    ret = self.mHandle.write(data)
+                if start < self.mSyncBarrier:
+                    # boot region, everything written before has to be on disk first
+                    self.Sync(True)
+                if 'b' in self.mMode and self.mSparseMode != 'off':
+                    ret = self.__writeSparse(memoryview(data), start)
+                elif 'b' in self.mMode:
+                    # NOTE: positioned write from start of file, no seeks
+                    ret = self.__queueWrite(memoryview(data), start)
                 else:
                     # read up to start lines
                     self.mHandle.readlines(start)
                     self.mHandle.truncate()
                     ret = self.mHandle.writelines(data)
-                # flush to disk straight away
-                self.mHandle.flush()
-                # data sync
-                os.fdatasync(self.mHandle)
+                self.mUnsynced += len(data)
+                if self.mDropBehind and 'b' in self.mMode:
+                    self.__addDirtyRange(start, start + len(data))
+                # flush and data sync, according to the sync policy
+                if self.mSyncPolicy == 'chunk' or start < self.mSyncBarrier or \
+                   (self.mSyncPolicy == 'size' and self.mUnsynced >= self.mSyncSize):
+                    self.Sync(True)
                 return ret
         except Exception as ex:
             _logger.error('{} (Base) write exception: {}'.format(type(self).__name__, ex))
             raise
         return 0
 
+    def __pwrite(self, view, start):
+        if self.mDirectFd is not None:
+            return self.__writeDirect([view], start)
+        return self.__pwriteCached(view, start)
+
+    def __pwriteCached(self, view, start):
+        ret = 0
+        while ret < len(view):
+            ret += os.pwrite(self.mHandle.fileno(), view[ret:], start + ret)
+        return ret
+
+    def __writeDirect(self, views, start):
+        """
+        writes the aligned middle of the extent by O_DIRECT, copied through
+        the aligned bounce buffer, and the unaligned head and tail through
+        the page cache
+        """
+        align = self.mDirectAlign
+        end = start + sum(len(v) for v in views)
+        first = min(end, -(-start // align) * align)
+        last = max(first, end - (end % align))
+        filled = 0
+        offset = start
+        for view in views:
+            pos = 0
+            while pos < len(view):
+                if self.mDirectFd is None:
+                    # O_DIRECT fell back on the way, the rest goes cached
+                    self.__pwriteCached(view[pos:], offset)
+                    offset += len(view) - pos
+                    break
+                if offset < first or offset >= last:
+                    size = min(len(view) - pos, (first if offset < first else end) - offset)
+                    self.__pwriteCached(view[pos:pos + size], offset)
+                else:
+                    size = min(len(view) - pos, last - offset, len(self.mBounce) - filled)
+                    self.mBounce[filled:filled + size] = view[pos:pos + size]
+                    filled += size
+                    if filled == len(self.mBounce) or offset + size == last:
+                        self.__pwriteDirect(self.mBounce[:filled], offset + size - filled)
+                        filled = 0
+                pos += size
+                offset += size
+        return end - start
+
+    def __pwriteDirect(self, view, start):
+        ret = 0
+        try:
+            while ret < len(view):
+                ret += os.pwrite(self.mDirectFd, view[ret:], start + ret)
+        except OSError as ex:
+            if ex.errno != errno.EINVAL:
+                raise
+            # e.g. the file system rejects the alignment, continue cached
+            _logger.warning('{} (Base) O_DIRECT write fallback: {}'.format(type(self).__name__, ex))
+            self.__closeDirect()
+            self.mDirect = False
+            self.__pwriteCached(view[ret:], start + ret)
+        return len(view)
+
+    def __readDirect(self, start, view):
+        # reads the aligned blocks holding the range into the bounce buffer
+        align = self.mDirectAlign
+        ret = 0
+        while ret < len(view):
+            offset = start + ret
+            base = offset - (offset % align)
+            size = min(len(self.mBounce), -(-(offset + len(view) - ret - base) // align) * align)
+            try:
+                got = os.preadv(self.mDirectFd, [self.mBounce[:size]], base)
+            except OSError as ex:
+                if ex.errno != errno.EINVAL:
+                    raise
+                _logger.warning('{} (Base) O_DIRECT read fallback: {}'.format(type(self).__name__, ex))
+                self.__closeDirect()
+                self.mDirect = False
+                return ret
+            if got <= offset - base:
+                break
+            size = min(got - (offset - base), len(view) - ret)
+            view[ret:ret + size] = self.mBounce[offset - base:offset - base + size]
+            ret += size
+        return ret
+
+    def __openDirect(self):
+        """
+        opens the O_DIRECT descriptor next to the cached handle, aligned to
+        the logical block size, and at least to a page, so the cached head
+        and tail never share a page with the direct blocks
+        """
+        if self.mDirectFd is not None or 'b' not in self.mMode:
+            return
+        flags = os.O_RDWR if any(s in self.mMode for s in ['w', 'a', '+']) else os.O_RDONLY
+        try:
+            self.mDirectFd = os.open(self.mFilename, flags | os.O_DIRECT)
+            self.mDirectAlign = max(self.getLogicalBlockSize(), mmap.PAGESIZE)
+            if self.mBounce is None:
+                # anonymous mmap is page aligned
+                self.mBounce = memoryview(mmap.mmap(-1, self.DIRECT_BOUNCE))
+            _logger.debug('{} (Base) O_DIRECT: {} align:{}'.format(type(self).__name__, self.mFilename, self.mDirectAlign))
+        except (OSError, AttributeError) as ex:
+            _logger.warning('{} (Base) O_DIRECT not supported: {}'.format(type(self).__name__, ex))
+            self.__closeDirect()
+            self.mDirect = False
+
+    def __closeDirect(self):
+        if self.mDirectFd is not None:
+            os.close(self.mDirectFd)
+            self.mDirectFd = None
+
+    def __writeSparse(self, view, start):
+        # writes the data runs, and queues the aligned all-zero blocks
+        zeros = bytes(self.SPARSE_BLOCK)
+        datastart = 0
+        pos = 0
+        while pos < len(view):
+            end = min(len(view), ((start + pos) // self.SPARSE_BLOCK + 1) * self.SPARSE_BLOCK - start)
+            # compared on the buffer of the view, without a copy of the block
+            if end - pos == self.SPARSE_BLOCK and zeros.startswith(view[pos:end]):
+                if datastart < pos:
+                    self.__flushZeroRange()
+                    self.__queueWrite(view[datastart:pos], start + datastart)
+                self.__addZeroRange(start + pos, start + end)
+                datastart = end
+            pos = end
+        if datastart < len(view):
+            self.__flushZeroRange()
+            self.__queueWrite(view[datastart:], start + datastart)
+        return len(view)
+
+    def __queueWrite(self, view, start):
+        # adjacent writes are gathered, and submitted once the pending extent
+        # reaches the combine size, views of mutable buffers (e.g. pooled or
+        # mapped) are submitted right away, as they are reused after return
+        if self.mCombineLimit <= 0:
+            return self.__pwrite(view, start)
+        if not len(view):
+            return 0
+        if self.mCombine and (start != self.mCombineStart + self.mCombineSize or len(self.mCombine) >= IOV_MAX):
+            self._flushWrites()
+        if not self.mCombine:
+            self.mCombineStart = start
+        self.mCombine.append(view)
+        self.mCombineSize += len(view)
+        if self.mCombineSize >= self.mCombineLimit or not isinstance(view.obj, bytes):
+            self._flushWrites(self.COMBINE_ALIGN)
+        return len(view)
+
+    def _flushWrites(self, align=0):
+        """
+        submits the pending adjacent writes by pwritev, with align the
+        extent ends at an align boundary, and the unaligned tail is held back
+        """
+        if not self.mCombine:
+            return
+        views = self.mCombine
+        tail = (self.mCombineStart + self.mCombineSize) % align if align else 0
+        held = []
+        while tail > 0 and tail < self.mCombineSize:
+            # splits the unaligned tail off the end, and copies it
+            last = views.pop()
+            size = min(tail, len(last))
+            held.insert(0, last[len(last) - size:].tobytes())
+            if size < len(last):
+                views.append(last[:len(last) - size])
+            tail -= size
+            self.mCombineSize -= size
+        start = self.mCombineStart
+        size = self.mCombineSize
+        self.mCombine = [memoryview(b) for b in held]
+        self.mCombineStart = start + size
+        self.mCombineSize = sum(len(b) for b in held)
+        if self.mDirectFd is not None:
+            self.__writeDirect(views, start)
+            return
+        fd = self.mHandle.fileno()
+        index = 0
+        while index < len(views):
+            ret = os.pwritev(fd, views[index:index + IOV_MAX], start)
+            start += ret
+            while ret > 0 and ret >= len(views[index]):
+                ret -= len(views[index])
+                index += 1
+            if ret > 0:
+                # partially written view
+                views[index] = views[index][ret:]
+
+    def __addZeroRange(self, start, end):
+        # coalesces the contiguous all-zero blocks into one range
+        if self.mZeroRange and self.mZeroRange[1] == start:
+            self.mZeroRange = (self.mZeroRange[0], end)
+        else:
+            self.__flushZeroRange()
+            self.mZeroRange = (start, end)
+
+    def __flushZeroRange(self):
+        """
+        zeroes the queued range, with a single BLKZEROOUT on a block device,
+        or by punching a hole into a regular file, and falls back to writing
+        zeros if the device or file system cannot
+        """
+        if not self.mZeroRange:
+            return
+        self._flushWrites()
+        start, end = self.mZeroRange
+        self.mZeroRange = None
+        mode = self.mSparseMode
+        if mode == 'discard' and stat.S_ISBLK(os.fstat(self.mHandle.fileno()).st_mode):
+            # zeros of the image have to read back as zeros, which many eMMC
+            # and SD devices do not guarantee for a discarded range
+            mode = 'zeroout'
+        self.__zeroRange(start, end, mode, FALLOC_FL_PUNCH_HOLE)
+
+    def __zeroRange(self, start, end, mode, falloc):
+        fd = self.mHandle.fileno()
+        fmode = os.fstat(fd).st_mode
+        try:
+            if stat.S_ISBLK(fmode):
+                if mode != 'skip':
+                    request = BLKDISCARD if mode == 'discard' else BLKZEROOUT
+                    fcntl.ioctl(fd, request, struct.pack('QQ', start, end - start))
+            elif stat.S_ISREG(fmode):
+                size = os.fstat(fd).st_size
+                if start < size and mode != 'skip':
+                    _fallocate(fd, falloc | FALLOC_FL_KEEP_SIZE, start, min(end, size) - start)
+                if end > size:
+                    # extends the file with a hole
+                    os.ftruncate(fd, end)
+            else:
+                raise OSError(errno.EOPNOTSUPP, 'not a block device nor regular file')
+            _logger.debug('{} (Base) {} zero range: {:#x}-{:#x}'.format(type(self).__name__, mode, start, end))
+        except OSError as ex:
+            _logger.debug('{} (Base) writes zeros {:#x}-{:#x}: {}'.format(type(self).__name__, start, end, ex))
+            zeros = memoryview(bytes(min(end - start, 1048576)))
+            for offset in range(start, end, len(zeros)):
+                self.__pwrite(zeros[:min(end - offset, len(zeros))], offset)
+            self.mUnsynced += end - start
+
+    def __advise(self, start, length, advice):
+        try:
+            os.posix_fadvise(self.mHandle.fileno(), start, length, advice)
+        except (OSError, AttributeError) as ex:
+            # e.g. pipes and char devices, the hints are just dropped
+            _logger.debug('{} (Base) fadvise {} failed: {}'.format(type(self).__name__, advice, ex))
+
+    def _adviseRead(self, start, end):
+        """
+        reads ahead the next window, and drops the pages read behind the
+        cursor, see setAccessHints()
+        """
+        if self.mReadAhead > 0 and end > self.mReadAheadMark:
+            self.__advise(end, self.mReadAhead, os.POSIX_FADV_WILLNEED)
+            self.mReadAheadMark = end + self.mReadAhead // 2
+        if self.mDropBehind:
+            if start < self.mDropStart or start > self.mDropStart + self.ADVISE_WINDOW:
+                # not sequential, restart from here
+                self.mDropStart = start
+            elif end - self.mDropStart >= self.ADVISE_WINDOW:
+                self.__advise(self.mDropStart, end - self.mDropStart, os.POSIX_FADV_DONTNEED)
+                self.mDropStart = end
+
+    def __addDirtyRange(self, start, end):
+        if self.mDirtyRange:
+            self.mDirtyRange = (min(self.mDirtyRange[0], start), max(self.mDirtyRange[1], end))
+        else:
+            self.mDirtyRange = (start, end)
+
+    def __dropDirtyRange(self):
+        # the synced pages are clean, and dropped from the page cache
+        if self.mDirtyRange:
+            start, end = self.mDirtyRange
+            self.mDirtyRange = None
+            self.__advise(start, end - start, os.POSIX_FADV_DONTNEED)
+
     def _read(self, start, size):
         try:
             if (self._open()):
+                self._flushWrites()
                 if 'b' in self.mMode:
                     # # NOTE: we always seek from start of file
                     self.mHandle.seek(start, 0)
-                    return self.mHandle.read(size) if (size > 0) else self.mHandle.read()
+                    data = self.mHandle.read(size) if (size > 0) else self.mHandle.read()
+                    self._adviseRead(start, start + len(data))
+                    return data
                 else:
                     # change the behaviour to read from start line, and number of lines
                     self.mHandle.seek(0)
@@ -341,6 +1635,33 @@ class BaseInputOutput(object):
             raise
         return 0
 
+    def _readinto(self, start, buf):
+        """
+        reads into the preallocated buf from start, returns number of bytes
+        read, which is less than len(buf) only at the end of file
+        """
+        try:
+            if (self._open()):
+                self._flushWrites()
+                view = memoryview(buf)
+                ret = 0
+                if self.mDirectFd is not None:
+                    ret = self.__readDirect(start, view)
+                    if self.mDirectFd is not None:
+                        return ret
+                self.mHandle.seek(start + ret, 0)
+                while ret < len(view):
+                    size = self.mHandle.readinto(view[ret:])
+                    if not size:
+                        break
+                    ret += size
+                self._adviseRead(start, start + ret)
+                return ret
+        except Exception as ex:
+            _logger.error('{} (Base) readinto exception: {}'.format(type(self).__name__, ex))
+            raise
+        return 0
+
     def _open(self):
         if (self.mHandle is None) or (isinstance(self.mHandle, IOBase) and self.mHandle.closed):
             # if filehandle already exist, or mode is write or append
@@ -351,6 +1672,8 @@ class BaseInputOutput(object):
                 self.mHandle = open(self.mFilename, mode=self.mMode, buffering=self.mBuffer)
                 if any(s in self.mMode for s in ['w', 'a', '+']) and self.mHandle:
                     fcntl.flock(self.mHandle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                if self.mDirect:
+                    self.__openDirect()
                 _logger.debug('{} (Base) _open: {} mode:{} buffering:{}'.format(type(self).__name__, self.mFilename, self.mMode, self.mBuffer))
                 return True
             except Exception as ex:
@@ -363,11 +1686,16 @@ class BaseInputOutput(object):
     def _close(self):
         if (self.mHandle and (isinstance(self.mHandle, IOBase) and not self.mHandle.closed)):
             if any(s in self.mMode for s in ['w', 'a', '+']):
+                self._flushWrites()
+                self.__flushZeroRange()
                 fcntl.flock(self.mHandle, fcntl.LOCK_UN)
                 # only flush and fsync files with write mode
                 # metadata (owner, size, mtime, etc) sync
                 self.mHandle.flush()
                 os.fsync(self.mHandle)
+                self.mUnsynced = 0
+                self.__dropDirtyRange()
+            self.__closeDirect()
             self.mHandle.close()
             _logger.debug('{} (Base) _close: {}'.format(type(self).__name__, self.mFilename))
 
@@ -391,6 +1719,8 @@ class BaseInputOutput(object):
         """
         returns file size in bytes
         """
+        if self.mCombine and self.mHandle and not self.mHandle.closed:
+            self._flushWrites()
         statinfo = os.stat(self.mFilename)
         if int(statinfo.st_size) > 0:
             _logger.debug('{} (Base) {} - getFileSize: {}'.format(type(self).__name__, self.mFilename, statinfo.st_size))
@@ -411,6 +1741,18 @@ class BaseInputOutput(object):
             return int(statinfo.st_blksize)
         return 0
 
+    def getLogicalBlockSize(self):
+        """
+        returns the logical block size of a block device, 512 otherwise
+        """
+        if self.mHandle and hasattr(self.mHandle, 'fileno') and stat.S_ISBLK(os.fstat(self.mHandle.fileno()).st_mode):
+            try:
+                buf = fcntl.ioctl(self.mHandle.fileno(), BLKSSZGET, b'\x00' * 4)
+                return struct.unpack('i', buf)[0]
+            except OSError as ex:
+                _logger.warning('{} (Base) BLKSSZGET failed: {}'.format(type(self).__name__, ex))
+        return 512
+
     def getFileType(self):
         return mimetypes.guess_type(self.mFilename)
 
@@ -420,6 +1762,226 @@ class BaseInputOutput(object):
             _logger.debug('{} (Base) {} - getStatInfo: {}'.format(type(self).__name__, self.mFilename, statinfo))
             return dict(zip('mode ino dev nlink uid gid size atime mtime ctime'.split(), statinfo))
 
+    def setSyncPolicy(self, policy='chunk', size=0, barrier=0):
+        """
+        sets the write durability policy, 'chunk' syncs after every write,
+        'size' syncs every size bytes written, 'checkpoint' syncs on Sync()
+        calls only, and 'close' syncs once on _close(). writes below the
+        barrier offset (i.e. the boot region) are always synced, after all
+        the data written before them
+        """
+        if policy not in self.SYNC_POLICIES:
+            raise ValueError('{} unknown sync policy: {}'.format(type(self).__name__, policy))
+        self.mSyncPolicy = policy
+        self.mSyncSize = size
+        self.mSyncBarrier = barrier
+        _logger.debug('{} setSyncPolicy: {} size:{} barrier:{}'.format(type(self).__name__, policy, size, barrier))
+
+    def setSparseMode(self, mode='off'):
+        """
+        sets how aligned all-zero blocks of binary writes and zero fills are
+        written, 'off' writes them as is, 'zeroout' and 'discard' punch a
+        hole into a regular file, and issue BLKZEROOUT over the range of a
+        block device, 'skip' leaves an already zeroed target untouched.
+        'discard' never issues BLKDISCARD for the zeros of an image, as many
+        eMMC and SD devices do not guarantee a discarded range reads back as
+        zeros, so the stream hash of the image would not hold, see Erase()
+        """
+        if mode not in self.SPARSE_MODES:
+            raise ValueError('{} unknown sparse mode: {}'.format(type(self).__name__, mode))
+        self.mSparseMode = mode
+        _logger.debug('{} setSparseMode: {}'.format(type(self).__name__, mode))
+
+    def setWriteCombine(self, size=COMBINE_SIZE):
+        """
+        enables combining the adjacent binary writes, gathered up to size
+        bytes and submitted by a single pwritev at an aligned offset, size 0
+        writes every piece at once
+        """
+        self._flushWrites()
+        self.mCombineLimit = size
+        _logger.debug('{} setWriteCombine: {}'.format(type(self).__name__, size))
+
+    def setAccessHints(self, readahead=0, dropbehind=False):
+        """
+        sets the access pattern hints of binary I/O, readahead bytes are
+        read ahead of sequential reads, and with dropbehind the pages read,
+        or written and synced, are dropped from the page cache
+        """
+        self.mReadAhead = readahead
+        self.mReadAheadMark = 0
+        self.mDropBehind = dropbehind
+        if readahead > 0 and self._open() and 'b' in self.mMode:
+            self.__advise(0, 0, os.POSIX_FADV_SEQUENTIAL)
+        _logger.debug('{} setAccessHints: readahead:{} dropbehind:{}'.format(type(self).__name__, readahead, dropbehind))
+
+    def setDirectIO(self, enable=True):
+        """
+        enables O_DIRECT binary writes and reads, bypassing the page cache,
+        e.g. of a block device target, the unaligned head and tail of a write
+        still go through the page cache, falls back to cached I/O where
+        O_DIRECT is not supported
+        """
+        self._flushWrites()
+        self.mDirect = enable
+        if not enable:
+            self.__closeDirect()
+        elif self.mHandle and (isinstance(self.mHandle, IOBase) and not self.mHandle.closed):
+            self.__openDirect()
+        _logger.debug('{} setDirectIO: {}'.format(type(self).__name__, self.mDirect))
+
+    def Sync(self, barrier=False):
+        """
+        checkpoint, flush and data sync the pending writes, except with the
+        'close' sync policy where only the barriers are synced
+        """
+        if self.mCombine and (self.mHandle and (isinstance(self.mHandle, IOBase) and not self.mHandle.closed)):
+            self._flushWrites()
+        if self.mZeroRange and (self.mHandle and (isinstance(self.mHandle, IOBase) and not self.mHandle.closed)):
+            self.__flushZeroRange()
+        if self.mUnsynced > 0 and (barrier or self.mSyncPolicy != 'close') and \
+           (self.mHandle and (isinstance(self.mHandle, IOBase) and not self.mHandle.closed)):
+            self.mHandle.flush()
+            os.fdatasync(self.mHandle)
+            self.mUnsynced = 0
+            self.__dropDirtyRange()
+
+    def Fill(self, start, length, value=b'\x00\x00\x00\x00'):
+        """
+        fills length bytes from start with the repeated value, zeros of whole
+        sectors are written as a zero range, see setSparseMode(), returns
+        length
+        """
+        if (self._open()):
+            if start < self.mSyncBarrier:
+                self.Sync(True)
+            if bytes(value) == bytes(len(value)) and 'b' in self.mMode and start % 512 == 0 and length % 512 == 0:
+                self.__addZeroRange(start, start + length)
+            else:
+                pattern = memoryview(bytes(value) * (1048576 // len(value)))
+                for offset in range(start, start + length, len(pattern)):
+                    self._write(pattern[:min(start + length - offset, len(pattern))], offset)
+            return length
+        return 0
+
+    def Erase(self, start, length, mode='zeroout'):
+        """
+        erases length bytes from start at once, 'zeroout' issues BLKZEROOUT
+        on a block device and zeroes the range of a regular file with
+        FALLOC_FL_ZERO_RANGE, 'discard' issues BLKDISCARD and punches a hole,
+        falls back to writing zeros, returns length. A discarded range of a
+        block device may read back as stale data rather than zeros
+        """
+        if mode not in self.ERASE_MODES:
+            raise ValueError('{} unknown erase mode: {}'.format(type(self).__name__, mode))
+        if (self._open()):
+            self._flushWrites()
+            self.__flushZeroRange()
+            self.__zeroRange(start, start + length, mode, FALLOC_FL_ZERO_RANGE if mode == 'zeroout' else FALLOC_FL_PUNCH_HOLE)
+            return length
+        return 0
+
+    def CopyRange(self, srcio, srcstart, start, length):
+        """
+        copies length bytes of the uncompressed srcio from srcstart to start
+        in the kernel, by copy_file_range, or by sendfile where it is refused,
+        e.g. across file systems or from a block device, returns the number
+        of bytes copied, less than length at the end of srcio, or where the
+        kernel refuses both
+        """
+        if 'b' not in self.mMode or not (self._open() and srcio._open()):
+            return 0
+        self._flushWrites()
+        self.__flushZeroRange()
+        if start < self.mSyncBarrier:
+            self.Sync(True)
+        infd = srcio.mHandle.fileno()
+        outfd = self.mHandle.fileno()
+        copied = 0
+        while copied < length:
+            try:
+                if self.mCopyFileRange:
+                    ret = os.copy_file_range(infd, outfd, length - copied, srcstart + copied, start + copied)
+                else:
+                    # sendfile writes at the file position of the target
+                    os.lseek(outfd, start + copied, os.SEEK_SET)
+                    ret = os.sendfile(outfd, infd, srcstart + copied, length - copied)
+            except (OSError, AttributeError) as ex:
+                if getattr(ex, 'errno', errno.ENOSYS) not in (errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP, errno.EBADF):
+                    raise
+                _logger.debug('{} (Base) {} refused: {}'.format(type(self).__name__, 'copy_file_range' if self.mCopyFileRange else 'sendfile', ex))
+                if self.mCopyFileRange:
+                    self.mCopyFileRange = False
+                    continue
+                break
+            if not ret:
+                break
+            copied += ret
+        if copied > 0:
+            self.mUnsynced += copied
+            if self.mDropBehind:
+                self.__addDirtyRange(start, start + copied)
+            srcio._adviseRead(srcstart, srcstart + copied)
+            if self.mSyncPolicy == 'chunk' or start < self.mSyncBarrier or \
+               (self.mSyncPolicy == 'size' and self.mUnsynced >= self.mSyncSize):
+                self.Sync(True)
+        return copied
+
+    def PreadInto(self, start, buf, size=-1):
+        """
+        positional read of size bytes from start into buf, for concurrent
+        readers each with its own buf, as neither the file position nor the
+        bounce buffer are shared. Read by O_DIRECT when it is set up, start is
+        aligned, and buf is an aligned buffer pool slot holding size rounded
+        up to the alignment, returns number of bytes read, which is less than
+        size only at the end of file. The file is opened by the caller first
+        """
+        view = memoryview(buf)
+        size = len(view) if size < 0 else min(size, len(view))
+        ret = 0
+        if self.mDirectFd is not None and start % self.mDirectAlign == 0:
+            length = -(-size // self.mDirectAlign) * self.mDirectAlign
+            if length <= len(view):
+                try:
+                    while ret < size:
+                        got = os.preadv(self.mDirectFd, [view[ret:length]], start + ret)
+                        ret += got
+                        if got < length - (ret - got):
+                            # short read at the end of file
+                            break
+                    return min(ret, size)
+                except OSError as ex:
+                    if ex.errno != errno.EINVAL:
+                        raise
+                    _logger.debug('{} (Base) O_DIRECT pread fallback: {}'.format(type(self).__name__, ex))
+        fd = self.mHandle.fileno()
+        while ret < size:
+            got = os.preadv(fd, [view[ret:size]], start + ret)
+            if not got:
+                break
+            ret += got
+        return ret
+
+    def setDecodeSparse(self, enable=True):
+        """
+        enables decoding an android sparse image, raw or wrapped in xz or gz,
+        into the extents of the expanded image by Decompress()
+        """
+        self.mDecodeSparse = enable
+
+    def _decodeSparse(self, data):
+        # android sparse image, also when wrapped in xz or gz, is decoded into
+        # extents once its magic shows up at the start of the data
+        if self.mDecodeSparse and self.mSparseImage is None and len(data) >= len(SparseImageFile.magic):
+            self.mSparseImage = SparseImageFile(self.mFilename, 'rb') if SparseImageFile.isMagicData(data) else False
+        return self.mSparseImage.decomp(data) if self.mSparseImage else data
+
+    def getSparseImage(self):
+        """
+        returns the SparseImageFile decoding the data, or None
+        """
+        return self.mSparseImage or None
+
     def Write(self, data, start):
         pass
 
@@ -435,15 +1997,29 @@ class CompressInputOutput(BaseInputOutput):
     def __init__(self, filename, mode='ab+'):
         super().__init__(filename, mode)
         self.mCFHandle = None
+        self.mFormatChain = []
+        self.mBounded = None
+        self.mMemLimit = XZIndex.MEMLIMIT
         if stat.S_ISREG(os.stat(filename).st_mode):
             self.mCFHandle = self.__getCompressedFile()
 
     # factory function to create a suitable instance for accessing files
     def __getCompressedFile(self):
-        for cls in (BZ2File, GZFile, XZFile, ZIPFile, TARFile):
-            if cls.isMagic(self.mFilename):
-                return cls(self.mFilename, self.mMode)
-        return None
+        # the header, read once from the opened file, is matched against
+        # all the registered formats
+        try:
+            header = os.pread(self.mHandle.fileno(), FormatRegistry.SNIFF_SIZE, 0)
+        except (OSError, ValueError, AttributeError):
+            header = b''
+        self.mFormatChain = FormatRegistry.sniff(header)
+        return FormatRegistry.getHandle(self.mFormatChain, self.mFilename, self.mMode)
+
+    def getFormatChain(self):
+        """
+        returns the file types decoding the file, outermost first, e.g.
+        ['xz', 'tar']
+        """
+        return [fmt.file_type for fmt in self.mFormatChain]
 
     def _write(self, data, start):
         """
@@ -514,6 +2090,106 @@ class CompressInputOutput(BaseInputOutput):
             _logger.error('{} (Comp) Read() exception: {}'.format(type(self).__name__, ex))
             raise
 
+    def ReadRaw(self, start, size):
+        """
+        read stage of Read(), returns raw (still compressed) bytes
+        """
+        try:
+            return super()._read(start, size)
+        except Exception as ex:
+            _logger.error('{} (Comp) ReadRaw() exception: {}'.format(type(self).__name__, ex))
+            raise
+
+    def ReadInto(self, start, buf):
+        """
+        read stage of Read() into preallocated buf, returns number of raw
+        (still compressed) bytes read
+        """
+        try:
+            return super()._readinto(start, buf)
+        except Exception as ex:
+            _logger.error('{} (Comp) ReadInto() exception: {}'.format(type(self).__name__, ex))
+            raise
+
+    def Decompress(self, data):
+        """
+        decompress stage of Read(), returns uncompressed data of raw bytes,
+        or the list of extents of an android sparse image
+        """
+        return self._decodeSparse(self.mCFHandle.decomp(data) if self.mCFHandle else data)
+
+    def setDecodeBlockSize(self, blocksize):
+        """
+        bounds the memory of DecompressBlocks() to output blocks of exactly
+        blocksize bytes, 0 decompresses the raw data as a whole
+        """
+        self.mBounded = BoundedDecoder(self.mCFHandle, blocksize) if (self.mCFHandle and blocksize > 0) else None
+
+    def DecompressBlocks(self, data):
+        """
+        bounded decompress stage of Read(), yields the uncompressed data of
+        raw bytes in blocks of the size set by setDecodeBlockSize()
+        """
+        if self.mBounded is None:
+            yield self.Decompress(data)
+        else:
+            for block in self.mBounded.decode(data):
+                yield self._decodeSparse(block)
+
+    def FlushBlocks(self):
+        """
+        returns the uncompressed data held back by DecompressBlocks(), at the
+        end of the raw data
+        """
+        return self._decodeSparse(self.mBounded.flush()) if self.mBounded else b''
+
+    def getBlockIndex(self):
+        """
+        returns list of (compressed offset, uncompressed offset, compressed
+        size, uncompressed size, stream number) of the xz blocks, or an empty
+        list if not available
+        """
+        if isinstance(self.mCFHandle, XZFile):
+            try:
+                return self.mCFHandle.getIndex().getBlocks()
+            except Exception as ex:
+                _logger.warning('{} (Comp) no xz block index: {}'.format(type(self).__name__, ex))
+        return []
+
+    def setDecodeThreads(self, threads, start=0, budget=0):
+        """
+        decodes the blocks of a block indexed xz file on threads in parallel,
+        for raw data fed to Decompress() from offset start, holding blocks of
+        budget bytes at most, returns True if enabled
+        """
+        if isinstance(self.mCFHandle, XZFile) and threads > 1:
+            try:
+                return self.mCFHandle.setParallel(self.mCFHandle.getIndex(), threads, start, budget)
+            except Exception as ex:
+                _logger.warning('{} (Comp) no xz block index: {}'.format(type(self).__name__, ex))
+        return False
+
+    def setMemLimit(self, memlimit):
+        """
+        sets the memory limit of the xz decompressors, in bytes
+        """
+        self.mMemLimit = memlimit
+        if isinstance(self.mCFHandle, XZFile):
+            self.mCFHandle.setMemLimit(memlimit)
+
+    def getSeekableReader(self):
+        """
+        returns a XZSeekableReader of the uncompressed data, reading the raw
+        data with ReadRaw(), or None if not a xz file with a valid index
+        """
+        if isinstance(self.mCFHandle, XZFile):
+            try:
+                return XZSeekableReader(self.mCFHandle.getIndex(), lambda start, end: self.ReadRaw(start, end - start), \
+                                        memlimit=self.mMemLimit)
+            except Exception as ex:
+                _logger.warning('{} (Comp) no xz block index: {}'.format(type(self).__name__, ex))
+        return None
+
 
 
 class BlockInputOutput(CompressInputOutput):
@@ -521,10 +2197,69 @@ class BlockInputOutput(CompressInputOutput):
     BlockInputOutput
 
     """
-    def __init__(self, chunksize, filename, mode='rb+'):
+    # size of the mapped window of a regular file, in bytes
+    MMAP_WINDOW = 67108864 # 64MB
+    # read ahead of a source file or block device, in bytes
+    READAHEAD = 4194304 # 4MB
+
+    def __init__(self, chunksize, filename, mode='rb+', use_mmap=False):
         super().__init__(filename, mode)
         self.mChunkSize = chunksize
-        _logger.debug('{} init() - chunksize:{}'.format(type(self).__name__, self.mChunkSize))
+        self.mMap = None
+        self.mMapStart = 0
+        self.mMapSize = 0
+        # mmap read mode only for read-only regular files
+        self.mUseMmap = use_mmap and stat.S_ISREG(os.stat(filename).st_mode) and \
+                        not any(s in self.mMode for s in ['w', 'a', '+'])
+        if self.mUseMmap:
+            self.mMapSize = os.stat(filename).st_size
+        # images and block devices are streamed once, sources are read ahead,
+        # and the pages behind the cursor of both are dropped
+        self.setAccessHints(0 if any(s in self.mMode for s in ['w', 'a', '+']) else self.READAHEAD, True)
+        _logger.debug('{} init() - chunksize:{} mmap:{}'.format(type(self).__name__, self.mChunkSize, self.mUseMmap))
+
+    def __mapView(self, start, size):
+        """
+        returns a memoryview slice of the mapped file, remapping the window of
+        the file when the slice is outside of it. the old windows are unmapped
+        once all their slices are released
+        """
+        end = min(start + size, self.mMapSize) if (size > 0) else self.mMapSize
+        if start >= end:
+            return b''
+        if self.mMap is None or start < self.mMapStart or end > self.mMapStart + len(self.mMap):
+            base = start - (start % mmap.ALLOCATIONGRANULARITY)
+            length = min(max(self.MMAP_WINDOW, end - base), self.mMapSize - base)
+            self.mMap = mmap.mmap(self.mHandle.fileno(), length, access=mmap.ACCESS_READ, offset=base)
+            if self.mReadAhead > 0 and hasattr(self.mMap, 'madvise'):
+                self.mMap.madvise(mmap.MADV_SEQUENTIAL)
+            self.mMapStart = base
+        return memoryview(self.mMap)[start - self.mMapStart:end - self.mMapStart]
+
+    def __readMapped(self, start, size):
+        # returns None if mmap is not possible, i.e. fallback to read()
+        if self.mUseMmap and self._open():
+            try:
+                view = self.__mapView(start, size)
+                self._adviseRead(start, start + len(view))
+                return view
+            except (OSError, ValueError) as ex:
+                _logger.warning('{} mmap fallback to read: {}'.format(type(self).__name__, ex))
+                self.mUseMmap = False
+        return None
+
+    def _close(self):
+        """
+        Overrides CompressInputOutput _close()
+        """
+        if self.mMap is not None:
+            try:
+                self.mMap.close()
+            except BufferError:
+                # slices still in use, unmapped when they are released
+                pass
+            self.mMap = None
+        super()._close()
 
     def Write(self, chunkdata, byteoffset):
         """
@@ -545,11 +2280,24 @@ class BlockInputOutput(CompressInputOutput):
         """
         try:
             # convert byteoffset to byte byteoffset address, and size in bytes
+            view = self.__readMapped(byteoffset, totalchunks * self.mChunkSize)
+            if view is not None:
+                return self.Decompress(view)
             return super().Read(byteoffset, totalchunks * self.mChunkSize)
         except Exception as ex:
             _logger.error('{} Read() exception: {}'.format(type(self).__name__, ex))
             raise
 
+    def ReadRaw(self, start, size):
+        """
+        Overrides CompressInputOutput ReadRaw()
+        returns memoryview slices of the mapped file in mmap read mode
+        """
+        view = self.__readMapped(start, size)
+        if view is not None:
+            return view
+        return super().ReadRaw(start, size)
+
 
 
 class FileInputOutput(BaseInputOutput):
@@ -575,20 +2323,347 @@ class FileInputOutput(BaseInputOutput):
 
 
 
+# ============================================================
+# Persistent HTTP connections
+# ============================================================
+class PooledHTTPSConnection(http.client.HTTPSConnection):
+    """
+    HTTPSConnection resuming the TLS session of the previous connection to
+    the same host, i.e. skips the full TLS handshake
+    """
+    def __init__(self, host, port=None, session=None, **kwargs):
+        super().__init__(host, port, **kwargs)
+        self.mSession = session
+
+    def connect(self):
+        http.client.HTTPConnection.connect(self)
+        server_hostname = self._tunnel_host if self._tunnel_host else self.host
+        self.sock = self._context.wrap_socket(self.sock, server_hostname=server_hostname, session=self.mSession)
+
+
+
+class PooledResponse(object):
+    """
+    Wraps the http.client.HTTPResponse of a pooled connection, the connection
+    goes back to the pool once the response is completely read, or is closed
+    if the response is closed before that
+    """
+    def __init__(self, pool, key, conn, response):
+        super().__init__()
+        self.mPool = pool
+        self.mKey = key
+        self.mConn = conn
+        self.mResponse = response
+        if response._method == 'HEAD':
+            response.read()
+        self.__checkDone()
+
+    def __getattr__(self, name):
+        # status, headers, info(), getheader(), etc. of the response
+        return getattr(self.mResponse, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __checkDone(self):
+        if self.mConn is not None and self.mResponse.isclosed():
+            self.mPool.release(self.mKey, self.mConn, not self.mResponse.will_close)
+            self.mConn = None
+
+    def read(self, size=-1):
+        data = self.mResponse.read(size if (size is not None and size >= 0) else None)
+        self.__checkDone()
+        return data
+
+    def readinto(self, buf):
+        ret = self.mResponse.readinto(buf)
+        self.__checkDone()
+        return ret
+
+    def close(self):
+        if self.mConn is not None:
+            # not completely read, the connection cannot be reused
+            self.mConn.close()
+            self.mConn = None
+        self.mResponse.close()
+
+    @property
+    def closed(self):
+        return self.mResponse.isclosed()
+
+
+
+class HTTPConnectionPool(object):
+    """
+    Per host pool of persistent HTTP/1.1 (keep-alive) connections, shared by
+    all the WebInputOutput of the process. HTTPS connections resume the TLS
+    session of the host. Other schemes, e.g. ftp, fall back to urlopen()
+    """
+    def __init__(self, maxidle=8):
+        super().__init__()
+        self.mMaxIdle = maxidle
+        self.mLock = threading.Lock()
+        self.mIdle = {} # idle connections per (scheme, host, port)
+        self.mSessions = {} # TLS sessions per (scheme, host, port)
+        self.mContext = ssl.create_default_context()
+
+    def __newConnection(self, key, timeout):
+        scheme, host, port = key
+        # honours the http_proxy/https_proxy environment, like urlopen()
+        proxy = urllib.request.getproxies().get(scheme)
+        if proxy and not urllib.request.proxy_bypass(host):
+            proxyurl = urllib.parse.urlsplit(proxy if '://' in proxy else 'http://' + proxy)
+            host, port = proxyurl.hostname, proxyurl.port
+        else:
+            proxy = None
+        if scheme == 'https':
+            conn = PooledHTTPSConnection(host, port, timeout=timeout, context=self.mContext, session=self.mSessions.get(key))
+            if proxy:
+                conn.set_tunnel(key[1], key[2])
+        else:
+            conn = http.client.HTTPConnection(host, port, timeout=timeout)
+        # plain http proxies take the absolute url in the request line
+        conn.mViaProxy = bool(proxy) and scheme == 'http'
+        return conn
+
+    def __getConnection(self, key, timeout):
+        # returns (connection, reused)
+        with self.mLock:
+            if self.mIdle.get(key):
+                conn = self.mIdle[key].pop()
+                conn.timeout = timeout
+                if conn.sock is not None:
+                    conn.sock.settimeout(timeout)
+                return conn, True
+        return self.__newConnection(key, timeout), False
+
+    @staticmethod
+    def __getKey(urlobj):
+        # pool key of the origin, i.e. (scheme, host, port)
+        port = urlobj.port if urlobj.port else (443 if urlobj.scheme == 'https' else 80)
+        return (urlobj.scheme, urlobj.hostname, port)
+
+    def release(self, key, conn, reusable=True):
+        """
+        returns the connection of a completely read response to the pool
+        """
+        with self.mLock:
+            if isinstance(conn, http.client.HTTPSConnection) and conn.sock is not None:
+                try:
+                    self.mSessions[key] = conn.sock.session
+                except (AttributeError, ValueError):
+                    pass
+            idle = self.mIdle.setdefault(key, [])
+            if reusable and conn.sock is not None and len(idle) < self.mMaxIdle:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def request(self, url, headers=None, timeout=30, method='GET'):
+        """
+        sends the request on a pooled connection, follows redirections, and
+        returns the response, raises urllib.error.HTTPError on error status
+        """
+        headers = dict(headers) if headers else {}
+        for redirect in range(6):
+            urlobj = urllib.parse.urlsplit(url)
+            if urlobj.scheme not in ('http', 'https'):
+                return urllib.request.urlopen(urllib.request.Request(url, headers=headers, method=method), None, timeout)
+            key = self.__getKey(urlobj)
+            path = urllib.parse.urlunsplit(('', '', urlobj.path or '/', urlobj.query, ''))
+            while True:
+                conn, reused = self.__getConnection(key, timeout)
+                try:
+                    conn.request(method, url if conn.mViaProxy else path, headers=headers)
+                    response = conn.getresponse()
+                    break
+                except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                    conn.close()
+                    if not reused:
+                        raise
+                    # the host closed the idle connection, retry on a new one
+                except Exception:
+                    conn.close()
+                    raise
+            if response.status in (301, 302, 303, 307, 308) and response.getheader('location'):
+                response.read()
+                self.release(key, conn, not response.will_close)
+                if response.status == 303 and method != 'HEAD':
+                    method = 'GET'
+                url = urllib.parse.urljoin(url, response.getheader('location'))
+                if self.__getKey(urllib.parse.urlsplit(url)) != key:
+                    # credentials are scoped to the origin, and never go over
+                    # to another host, port or scheme, e.g. https to http
+                    headers = {name: value for name, value in headers.items() \
+                               if name.lower() not in ('authorization', 'proxy-authorization')}
+                continue
+            if response.status >= 400:
+                # the connection is not reused, its socket is closed for real
+                # once the response is, so the error body stays readable
+                if conn.sock is not None:
+                    sock, conn.sock = conn.sock, None
+                    sock.close()
+                raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, response)
+            return PooledResponse(self, key, conn, response)
+        raise urllib.error.URLError('{} too many redirections'.format(url))
+
+# the connection pool shared by all the web input/output of the process
+_httpPool = HTTPConnectionPool()
+
+
+
+# ============================================================
+# Segmented download over HTTP byte ranges
+# ============================================================
+class SegmentedDownload(object):
+    """
+    File like reader of the start to end byte range of a web file, which
+    downloads segments of segsize bytes over parallel connections with HTTP
+    Range requests, and reassembles the segments in order. The downloaders wait for the reader when it falls
+    2 * connections segments behind, to bound the reorder memory
+    """
+    def __init__(self, url, start, end, connections, segsize=1048576, headers=None, timeout=30):
+        super().__init__()
+        self.mUrl = url
+        self.mStart = start
+        self.mEnd = end
+        self.mSegSize = segsize
+        self.mHeaders = dict(headers) if headers else {}
+        self.mTimeout = timeout
+        self.mNumSegs = -(-(end - start) // segsize) # int ceiling division
+        self.mWindow = 2 * connections
+        self.mNextFetch = 0 # next segment to download
+        self.mNextRead = 0 # next segment to read
+        self.mSegments = {} # reorder buffer of downloaded segments
+        self.mCurrent = memoryview(b'')
+        self.mCurPos = 0
+        self.mPos = 0
+        self.mError = None
+        self.closed = False
+        self.mCond = threading.Condition()
+        for i in range(connections):
+            threading.Thread(name='SegDL{}'.format(i), target=self.__download, daemon=True).start()
+        _logger.debug('{} {} range:{}-{} segments:{} connections:{}'.format(type(self).__name__, url, start, end, self.mNumSegs, connections))
+
+    def __download(self):
+        while True:
+            with self.mCond:
+                while not self.closed and self.mError is None and self.mNextFetch < self.mNumSegs and \
+                      self.mNextFetch >= self.mNextRead + self.mWindow:
+                    self.mCond.wait()
+                if self.closed or self.mError is not None or self.mNextFetch >= self.mNumSegs:
+                    return
+                index = self.mNextFetch
+                self.mNextFetch += 1
+            try:
+                data = self.__fetch(index)
+            except Exception as ex:
+                _logger.error('{} segment {} download exception: {}'.format(type(self).__name__, index, ex))
+                with self.mCond:
+                    if self.mError is None:
+                        self.mError = ex
+                    self.mCond.notify_all()
+                return
+            with self.mCond:
+                self.mSegments[index] = data
+                self.mCond.notify_all()
+
+    def __fetch(self, index):
+        start = self.mStart + index * self.mSegSize
+        end = min(start + self.mSegSize, self.mEnd) - 1
+        retry = 3
+        while True:
+            try:
+                headers = dict(self.mHeaders, range='bytes={}-{}'.format(start, end))
+                response = _httpPool.request(self.mUrl, headers, self.mTimeout)
+                with response:
+                    if response.status != 206:
+                        raise urllib.error.URLError('Range request not honoured, status {}'.format(response.status))
+                    data = response.read()
+                if len(data) != end - start + 1:
+                    raise ConnectionError('Short segment {} of {} bytes'.format(len(data), end - start + 1))
+                return data
+            except urllib.error.HTTPError:
+                raise
+            except (urllib.error.URLError, http.client.HTTPException, ConnectionError, socket.timeout) as err:
+                if retry > 1 and not self.closed:
+                    _logger.warning('{} segment {} retry: {}'.format(type(self).__name__, index, err))
+                    retry -= 1
+                else:
+                    raise
+
+    def __nextSegment(self):
+        # waits for the next segment in order from the reorder buffer
+        with self.mCond:
+            while self.mNextRead not in self.mSegments and self.mError is None and not self.closed:
+                self.mCond.wait()
+            if self.mError is not None:
+                raise self.mError
+            if self.closed:
+                raise ValueError('read of closed segmented download')
+            self.mCurrent = memoryview(self.mSegments.pop(self.mNextRead))
+            self.mCurPos = 0
+            self.mNextRead += 1
+            self.mCond.notify_all()
+
+    def readinto(self, buf):
+        view = memoryview(buf)
+        ret = 0
+        while ret < len(view):
+            if self.mCurPos >= len(self.mCurrent):
+                if self.mNextRead >= self.mNumSegs:
+                    break
+                self.__nextSegment()
+            size = min(len(view) - ret, len(self.mCurrent) - self.mCurPos)
+            view[ret:ret + size] = self.mCurrent[self.mCurPos:self.mCurPos + size]
+            self.mCurPos += size
+            ret += size
+        self.mPos += ret
+        return ret
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.mEnd - self.mStart - self.mPos
+        buf = bytearray(size)
+        return bytes(buf[:self.readinto(buf)])
+
+    def close(self):
+        with self.mCond:
+            self.closed = True
+            self.mSegments.clear()
+            self.mCond.notify_all()
+
+
+
 class WebInputOutput(BaseInputOutput):
     """
     WebInputOutput
     """
-    def __init__(self, chunksize, filename, mode='dl', host='http://rescue.technexion.net/', username=None, password=None):
+    # size of the byte ranges of the segmented download
+    SEGMENT_SIZE = 1048576 # 1MB
+
+    def __init__(self, chunksize, filename, mode='dl', host='http://rescue.technexion.net/', username=None, password=None, connections=1, optional=False):
         self.mChunkSize = chunksize if (chunksize > 0) else 65536
+        self.mConnections = connections
+        # optional web file, e.g. a sidecar file next to an image, is probed
+        # for, so a missing one is not an error
+        self.mOptional = optional
+        self.mRange = (0, 0)
+        self.mPosition = 0
+        self.mXZIndex = None
+        self.mBounded = None
+        self.mMemLimit = XZIndex.MEMLIMIT
         self.mHost = host
         self.mUrl = self.mHost.rstrip('/') + '/' + filename.lstrip('/')
         self.mAuthFlag = False
         self.mUsername = username
         self.mPassword = password
-        self.mAuthMgr = urllib.request.HTTPPasswordMgrWithDefaultRealm()
         # will call to the overridden _open() which
-        # handles our own web input(download, 'dl') output(upload, 'ul')
+        # handles our own web input(download, 'dl') output(upload, 'ul'), and
+        # header only ('hd') input which downloads the content on first read
         super().__init__(filename, mode)
         # and the overridden _open() will be called first for WebInputOutput
         self.mCFHandle = self.__getCompressedFile()
@@ -597,10 +2672,14 @@ class WebInputOutput(BaseInputOutput):
     # factory function to create a suitable instance for accessing files
     def __getCompressedFile(self):
         #self.mCFHandle = XZFile(filename, 'rb+')
-        for cls in (BZ2File, GZFile, XZFile, ZIPFile, TARFile):
-            if cls.isFileType(self.mFileType):
-                return cls(self.mFilename, 'rb+')
-        return None
+        self.mFormatChain = FormatRegistry.findFileType(self.mFileType)
+        return FormatRegistry.getHandle(self.mFormatChain, self.mFilename, 'rb+')
+
+    def getFormatChain(self):
+        """
+        returns the file types decoding the web file, by its content type
+        """
+        return [fmt.file_type for fmt in self.mFormatChain]
 
     def _write(self, data, start):
         """
@@ -620,12 +2699,17 @@ class WebInputOutput(BaseInputOutput):
         """
         Overrides _read() => Download from host and uncompress
         """
+        self.__openContent()
         retry = 3
         while retry:
             try:
                 if self.mHandle:
                     # download from urllib.response
-                    return self.mHandle.read(size) if (size > 0) else self.mHandle.read()
+                    ret = self.mHandle.read(size) if (size > 0) else self.mHandle.read()
+                    self.mPosition += len(ret)
+                    if not ret or size <= 0:
+                        self.__checkLength()
+                    return ret
             except TypeError as err:
                 _logger.error('{} _open ignore type error: {}'.format(self.__class__, err))
                 break
@@ -640,20 +2724,47 @@ class WebInputOutput(BaseInputOutput):
                     raise
         return 0
 
+    def _readinto(self, start, buf):
+        """
+        Overrides _readinto() => Download from host into preallocated buf
+        """
+        self.__openContent()
+        view = memoryview(buf)
+        ret = 0
+        retry = 3
+        while retry and self.mHandle and ret < len(view):
+            try:
+                size = self.mHandle.readinto(view[ret:])
+                if not size:
+                    self.__checkLength()
+                    break
+                ret += size
+                self.mPosition += size
+            except (urllib.error.URLError, urllib.error.HTTPError) as err:
+                _logger.error('{} download exception: {}'.format(self.__class__, err))
+                raise
+            except (socket.timeout) as err:
+                _logger.error('{} download time out exception: {}'.format(self.__class__, err))
+                if retry > 1:
+                    retry -= 1
+                else:
+                    raise
+        return ret
+
     def _open(self):
         """
         Overrides _open()
         """
         while True:
             try:
-                if 'dl' in self.mMode:
-                    # For HTTP and HTTPS URLs, setup request
-                    # req = urllib.request.Request(self.mUrl) # no cgi data, no timeout
-                    # self.mHandle = urllib.request.urlopen(req)
-                    if not self.mAuthFlag:
-                        self.mHandle = urllib.request.urlopen(self.mUrl, None, 30) # timeout 30s
-                    else:
-                        self.mHandle = self.mAuthOpener.open(self.mUrl)
+                if any(s in self.mMode for s in ['dl', 'hd']):
+                    # For HTTP and HTTPS URLs, request on a persistent connection of the pool
+                    headers = self.__getHeaders()
+                    if self.mRange != (0, 0):
+                        # continue the download from byte range start up to range end
+                        headers['range'] = 'bytes={}-{}'.format(self.mRange[0], (self.mRange[1] - 1) if self.mRange[1] > 0 else '')
+                    method = 'HEAD' if 'hd' in self.mMode else 'GET'
+                    self.mHandle = _httpPool.request(self.mUrl, headers, 30, method) # timeout 30s
 
                     if self.mHandle:
                         self.mWebHdrInfo = self.mHandle.info()
@@ -662,8 +2773,25 @@ class WebInputOutput(BaseInputOutput):
                             self.mFileSize = int(self.mWebHdrInfo['content-length'])
                         else:
                             self.mFileSize = 0
+                        if 'content-range' in self.mWebHdrInfo and self.mHandle.status == 206:
+                            # file size of the whole web file, from the byte range response
+                            total = self.mWebHdrInfo['content-range'].split('/')[-1].strip()
+                            self.mFileSize = int(total) if total.isdigit() else 0
+                        elif self.mRange != (0, 0):
+                            self.mHandle.close()
+                            raise IOError('{} host does not support byte range requests'.format(self.mUrl))
                         if 'content-type' in self.mWebHdrInfo:
                             self.mFileType = self.mWebHdrInfo['content-type']
+                        self.mPosition = self.mRange[0]
+                        start = self.mRange[0]
+                        end = self.mRange[1] if self.mRange[1] > 0 else self.mFileSize
+                        if 'dl' in self.mMode and self.mConnections > 1 and end - start > self.SEGMENT_SIZE and \
+                           (self.mHandle.status == 206 or self.mWebHdrInfo.get('accept-ranges', 'none').strip().lower() == 'bytes'):
+                            # server supports byte ranges, replace the single stream with
+                            # the segmented download over parallel connections
+                            self.mHandle.close()
+                            self.mHandle = SegmentedDownload(self.mUrl, start, end, self.mConnections, self.SEGMENT_SIZE, \
+                                                             self.__getHeaders())
                         break
                 else:
                     # For HTTP and HTTPS URLs, setup response to remote requester
@@ -674,15 +2802,16 @@ class WebInputOutput(BaseInputOutput):
                 _logger.error('{} _open ignore type error: {}'.format(type(self).__name__, err))
                 raise
             except urllib.error.HTTPError as err:
+                if self.mOptional and getattr(err, 'code', 0) == 404:
+                    _logger.debug('{} _open optional file not found: {} {}'.format(type(self).__name__, self.mUrl, err))
+                    raise
                 _logger.error('{} _open http error: {}'.format(type(self).__name__, err))
                 if hasattr(err, 'code') and err.code == 401:
-                    if self.mUsername and self.mPassword:
-                        self.mAuthMgr.add_password(None, self.mUrl, self.mUsername, self.mPassword)
-                        self.mAuthHdlr = urllib.request.HTTPBasicAuthHandler(self.mAuthMgr)
-                        self.mAuthOpener = urllib.request.build_opener(self.mAuthHdlr)
-                        urllib.request.install_opener(self.mAuthOpener)
+                    if self.mUsername and self.mPassword and not self.mAuthFlag:
+                        # retry with basic authentication
                         self.mAuthFlag = True
                         continue
+                    raise
                 else:
                     raise
             except (urllib.error.URLError, socket.timeout) as err:
@@ -735,6 +2864,151 @@ class WebInputOutput(BaseInputOutput):
             _logger.error('{} Read() exception: {}'.format(type(self).__name__, ex))
             raise
 
+    def ReadRaw(self, start, size):
+        """
+        download stage of Read(), returns raw (still compressed) bytes
+        """
+        try:
+            return self._read(start, size)
+        except Exception as ex:
+            _logger.error('{} ReadRaw() exception: {}'.format(type(self).__name__, ex))
+            raise
+
+    def ReadInto(self, start, buf):
+        """
+        download stage of Read() into preallocated buf, returns number of raw
+        (still compressed) bytes downloaded
+        """
+        try:
+            return self._readinto(start, buf)
+        except Exception as ex:
+            _logger.error('{} ReadInto() exception: {}'.format(type(self).__name__, ex))
+            raise
+
+    def Decompress(self, data):
+        """
+        decompress stage of Read(), returns uncompressed data of raw bytes,
+        or the list of extents of an android sparse image
+        """
+        return self._decodeSparse(self.mCFHandle.decomp(data) if self.mCFHandle else data)
+
+    def setDecodeBlockSize(self, blocksize):
+        """
+        bounds the memory of DecompressBlocks() to output blocks of exactly
+        blocksize bytes, 0 decompresses the raw data as a whole
+        """
+        self.mBounded = BoundedDecoder(self.mCFHandle, blocksize) if (self.mCFHandle and blocksize > 0) else None
+
+    def DecompressBlocks(self, data):
+        """
+        bounded decompress stage of Read(), yields the uncompressed data of
+        raw bytes in blocks of the size set by setDecodeBlockSize()
+        """
+        if self.mBounded is None:
+            yield self.Decompress(data)
+        else:
+            for block in self.mBounded.decode(data):
+                yield self._decodeSparse(block)
+
+    def FlushBlocks(self):
+        """
+        returns the uncompressed data held back by DecompressBlocks(), at the
+        end of the raw data
+        """
+        return self._decodeSparse(self.mBounded.flush()) if self.mBounded else b''
+
+    def __openContent(self):
+        # header only so far, download the content from now on
+        if 'hd' in self.mMode:
+            self.mMode = self.mMode.replace('hd', 'dl')
+            self._open()
+
+    def __checkLength(self):
+        # the response ended, a body cut short by the host or the network is
+        # not the end of file, as known from the content length
+        end = self.mRange[1] if self.mRange[1] > 0 else self.mFileSize
+        if 'dl' in self.mMode and self.mPosition < end:
+            raise IOError('Short download of {} ended at byte {} of {}'.format(self.mUrl, self.mPosition, end))
+
+    def __getHeaders(self):
+        # request headers, with basic authentication once the host asked for it
+        headers = {}
+        if self.mAuthFlag:
+            credentials = '{}:{}'.format(self.mUsername, self.mPassword).encode('utf-8')
+            headers['authorization'] = 'Basic {}'.format(base64.b64encode(credentials).decode('ascii'))
+        return headers
+
+    def openRange(self, start, end=0):
+        """
+        reopens the download from byte start up to byte end (0 for the end of
+        file) of the web file, i.e. continues the download from start. Raises
+        IOError if the host does not support byte range requests
+        """
+        if self.mHandle:
+            self.mHandle.close()
+        self.mRange = (start, end)
+        self._open()
+
+    def ReadRange(self, start, end):
+        """
+        returns the bytes from start up to end of the web file, with a
+        separate byte range request
+        """
+        headers = self.__getHeaders()
+        headers['range'] = 'bytes={}-{}'.format(start, end - 1)
+        with _httpPool.request(self.mUrl, headers, 30) as response: # timeout 30s
+            if response.status != 206:
+                raise IOError('{} host does not support byte range requests'.format(self.mUrl))
+            return response.read()
+
+    def getXZIndex(self):
+        """
+        returns the XZIndex parsed with byte range requests at the end of the
+        web file, or None if not a xz file or the index is not available
+        """
+        if self.mXZIndex is None and isinstance(self.mCFHandle, XZFile):
+            try:
+                self.mXZIndex = XZIndex(self.ReadRange, self.mFileSize)
+            except Exception as ex:
+                _logger.warning('{} no xz block index: {}'.format(type(self).__name__, ex))
+                self.mXZIndex = False
+        return self.mXZIndex or None
+
+    def getBlockIndex(self):
+        """
+        returns list of (compressed offset, uncompressed offset, compressed
+        size, uncompressed size, stream number) of the xz blocks, or an empty
+        list if not available
+        """
+        index = self.getXZIndex()
+        return index.getBlocks() if index else []
+
+    def setDecodeThreads(self, threads, start=0, budget=0):
+        """
+        decodes the blocks of a block indexed xz file on threads in parallel,
+        for raw data fed to Decompress() from offset start, holding blocks of
+        budget bytes at most, returns True if enabled
+        """
+        if isinstance(self.mCFHandle, XZFile) and threads > 1:
+            return self.mCFHandle.setParallel(self.getXZIndex(), threads, start, budget)
+        return False
+
+    def setMemLimit(self, memlimit):
+        """
+        sets the memory limit of the xz decompressors, in bytes
+        """
+        self.mMemLimit = memlimit
+        if isinstance(self.mCFHandle, XZFile):
+            self.mCFHandle.setMemLimit(memlimit)
+
+    def getSeekableReader(self):
+        """
+        returns a XZSeekableReader of the uncompressed data, fetching the
+        blocks with byte range requests, or None if not available
+        """
+        index = self.getXZIndex()
+        return XZSeekableReader(index, self.ReadRange, self.SEGMENT_SIZE, self.mMemLimit) if index else None
+
     def getHeaderInfo(self):
         """
         additional function to return header from webpage
@@ -757,35 +3031,35 @@ class WebInputOutput(BaseInputOutput):
         """
         returns uncompressed size in bytes
         """
-        # ask for end range of the xz file over the network
-        # Create a request for the given URL.
-        request = urllib.request.Request(self.mUrl)
-
-        # Add the header to specify the range to download.
+        index = self.getXZIndex()
+        if index:
+            return index.getUncompressedSize()
+        # ask for end range of the xz file over the network, with a request
+        # on a persistent connection of the pool, specifying the range
+        headers = self.__getHeaders()
         start = self.getFileSize() - 512
-        request.add_header('range', 'bytes={}-'.format(start))
-        response = urllib.request.urlopen(request)
-
-        # If a content-range header is present, partial retrieval worked.
-        if 'content-range' in response.headers:
-            # The header contains the string 'bytes', followed by a space, then the
-            # range in the format 'start-end', followed by a slash and then the total
-            # size of the page (or an asterix if the total size is unknown). Lets get
-            # the range and total size from this.
-            range, total = response.headers['content-range'].split(' ')[-1].split('/')
-
-            # Print a message giving the range information.
-            if total == '*':
-                _logger.debug("{} Bytes {} of an unknown total were retrieved.".format(type(self).__name__, range))
-            else:
-                _logger.debug("{} Bytes {} of a total of {} were retrieved.".format(type(self).__name__, range, total))
+        headers['range'] = 'bytes={}-'.format(start)
+        with _httpPool.request(self.mUrl, headers) as response:
+            # If a content-range header is present, partial retrieval worked.
+            if 'content-range' in response.headers:
+                # The header contains the string 'bytes', followed by a space, then the
+                # range in the format 'start-end', followed by a slash and then the total
+                # size of the page (or an asterix if the total size is unknown). Lets get
+                # the range and total size from this.
+                range, total = response.headers['content-range'].split(' ')[-1].split('/')
+
+                # Print a message giving the range information.
+                if total == '*':
+                    _logger.debug("{} Bytes {} of an unknown total were retrieved.".format(type(self).__name__, range))
+                else:
+                    _logger.debug("{} Bytes {} of a total of {} were retrieved.".format(type(self).__name__, range, total))
 
-            # And for good measure, lets check how much data we downloaded.
-            endmatter = response.read()
-            _logger.debug("{} Retrieved from {} data size: {} bytes in range {}".format(type(self).__name__, self.mUrl, len(endmatter), range))
+                # And for good measure, lets check how much data we downloaded.
+                endmatter = response.read()
+                _logger.debug("{} Retrieved from {} data size: {} bytes in range {}".format(type(self).__name__, self.mUrl, len(endmatter), range))
 
-            if self.mCFHandle:
-                return self.mCFHandle.calcRec(endmatter)
+                if self.mCFHandle:
+                    return self.mCFHandle.calcRec(endmatter)
         return 0
 
 
@@ -298,6 +298,10 @@ def main():
     del cliDl
     if dlResult['status'] == 'success':
         print('Flash complete...', end=((' '*60) + '\n'))
+        if 'stream_hash' in dlResult:
+            # hashed while flashing, against the published hash if there is one
+            print('Image {}: {} {}'.format(dlResult['hash_algo'], dlResult['stream_hash'], \
+                  ('verified' if dlResult['stream_hash_match'] == 'True' else 'mismatch') if 'stream_hash_match' in dlResult else 'not published'))
     else:
         # step 9: restore rescue system on target storage if failed to flash
         print('Flash failed, recover rescue system...', end=((' '*60) + '\n'))
@@ -323,19 +327,19 @@ def main():
         cliCfg.request(cfgparam)
         del cliCfg
 
-        cliFlash = CliViewer()
-        flashparam = {'cmd': 'flash', 'src_filename': '/dev/zero', 'tgt_filename': dlparam['tgt_filename'] + 'boot0'}
+        cliErase = CliViewer()
+        eraseparam = {'cmd': 'erase', 'tgt_filename': dlparam['tgt_filename'] + 'boot0'}
         print('Clear mmc boot partition...')
         endEvent = Event()
         endEvent.clear()
-        resultThread = Thread(name='ResultThread', target=loopResult, args=(cliFlash, endEvent))
+        resultThread = Thread(name='ResultThread', target=loopResult, args=(cliErase, endEvent))
         resultThread.start()
-        cliFlash.request(flashparam)
+        cliErase.request(eraseparam)
         time.sleep(1)
         endEvent.set()
         resultThread.join()
         print('Clear complete...', end=((' '*60) + '\n'))
-        del cliFlash
+        del cliErase
 
     cliCfg = CliViewer()
     # python3 view.py {config mmc -c bootpart -s enable/disable -n 1 -k 1 /dev/mmcblk2}
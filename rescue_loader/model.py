@@ -56,19 +56,24 @@ import psutil
 import array
 import binascii
 import base64
+import concurrent.futures
 import hashlib
+import json
 import platform
 import pyudev
 import socket
 import struct
 import subprocess
-import signal
 import logging
 import pyqrcode
+import queue
+import threading
+import time
+import types
 from html.parser import HTMLParser
 from urllib.parse import urlparse
 from defconfig import IsATargetBoard
-from inputoutput import BlockInputOutput, FileInputOutput, BaseInputOutput, WebInputOutput
+from inputoutput import BlockInputOutput, FileInputOutput, BaseInputOutput, WebInputOutput, BufferPool, BlockMap, SegmentManifest, SparseImageFile, XZIndex
 
 _logger = logging.getLogger(__name__)
 
@@ -111,6 +116,439 @@ class HtmlFileLinkParser(HTMLParser):
 
 
 
+class MemoryGovernor(object):
+    """
+    Memory governor of a copy/download job, picks the chunk size, the queue
+    depth, the xz decoder memlimit, the xz decode threads and the streaming
+    (dd) or chunked download engine from psutil.virtual_memory(), so the same
+    installerd runs on boards of 256MB to 4GB of RAM. A quarter of the
+    available memory is the budget of the buffers held by the pipeline, i.e.
+    about 3 * depth + 4 chunks, and adjust() lowers the queue depth while the
+    job runs, when the available memory shrinks. chunksize and depth given
+    by the job params are kept as is
+    """
+    MIN_CHUNK = 65536 # 64K
+    MAX_CHUNK = 4194304 # 4MB
+    MAX_DEPTH = 8
+    MIN_MEMLIMIT = XZIndex.MEMLIMIT # 96MB, enough for xz -9
+    MAX_MEMLIMIT = 1073741824 # 1GB
+    STREAM_BELOW = 734003200 # 700MB, streams the download below
+    INTERVAL = 2.0 # seconds between adjustments
+
+    def __init__(self, chunksize=0, depth=-1):
+        super().__init__()
+        self.mFixedChunk = chunksize
+        self.mFixedDepth = depth
+        self.mAvailable = self.getAvailable()
+        self.mChunkSize = chunksize if (chunksize > 0) else self.__planChunkSize(self.mAvailable, depth)
+        self.mDepth = depth if (depth >= 0) else self.__planDepth(self.mAvailable)
+        self.mMaxDepth = self.mDepth
+        self.mLastCheck = time.monotonic()
+        _logger.info('{} available: {} chunk_size: {} queue_depth: {} memlimit: {}'.format(type(self).__name__, \
+                     self.mAvailable, self.mChunkSize, self.mDepth, self.getMemLimit()))
+
+    @staticmethod
+    def getAvailable():
+        try:
+            return psutil.virtual_memory().available
+        except Exception as ex:
+            _logger.warning('MemoryGovernor cannot get virtual memory: {}'.format(ex))
+            return 0
+
+    def __planChunkSize(self, available, depth):
+        # largest power of 2 of the budget shared by the 3 * depth + 4 chunks
+        # of the queue depth given, or else of the deepest queue planned
+        depth = depth if (depth >= 0) else self.MAX_DEPTH
+        chunk = self.MIN_CHUNK
+        while chunk * 2 <= min(available // 4 // (3 * depth + 4), self.MAX_CHUNK):
+            chunk *= 2
+        return chunk
+
+    def __planDepth(self, available):
+        return max(1, min((available // 4 // self.mChunkSize - 4) // 3, self.MAX_DEPTH))
+
+    def getChunkSize(self):
+        return self.mChunkSize
+
+    def getQueueDepth(self):
+        return self.mDepth
+
+    def getMemLimit(self):
+        """
+        returns the memory limit of a xz decompressor, half the available
+        memory, but at least enough for xz -9
+        """
+        return max(self.MIN_MEMLIMIT, min(self.mAvailable // 2, self.MAX_MEMLIMIT))
+
+    def getChunkRange(self, chunksize):
+        """
+        returns the (min, max) chunk sizes of an adaptive ChunkPlanner, from a
+        quarter of chunksize up to 4 times of it, as far as the budget allows
+        """
+        budget = self.mAvailable // 4 // (3 * max(self.mDepth, 1) + 4)
+        maxsize = chunksize
+        while maxsize < chunksize * 4 and maxsize * 2 <= budget:
+            maxsize *= 2
+        return max(chunksize // 4, min(chunksize, self.MIN_CHUNK)), maxsize
+
+    def getDecodeThreads(self, threads, blocksize=0):
+        """
+        returns the xz decode threads fitting in half the available memory,
+        each of a decompressor of xz -9 and of a block of blocksize bytes,
+        i.e. the largest uncompressed block of the index
+        """
+        return max(1, min(threads, self.mAvailable // 2 // (blocksize + self.MIN_MEMLIMIT)))
+
+    def getDecodeBudget(self):
+        """
+        returns the memory of the xz blocks held by the parallel decoder, the
+        compressed and the decoded ones, half the available memory
+        """
+        return self.mAvailable // 2
+
+    def useStream(self):
+        """
+        returns True to stream the download, i.e. the in-process wget | xz | dd
+        """
+        return self.mAvailable < self.STREAM_BELOW
+
+    def adjust(self):
+        """
+        re-plans the queue depth about every INTERVAL seconds, up to the depth
+        planned at the start, returns the queue depth
+        """
+        if self.mFixedDepth >= 0 or time.monotonic() - self.mLastCheck < self.INTERVAL:
+            return self.mDepth
+        self.mLastCheck = time.monotonic()
+        self.mAvailable = self.getAvailable()
+        depth = min(self.__planDepth(self.mAvailable), self.mMaxDepth)
+        if depth != self.mDepth:
+            _logger.info('{} available: {} queue_depth: {} => {}'.format(type(self).__name__, self.mAvailable, self.mDepth, depth))
+            self.mDepth = depth
+        return self.mDepth
+
+
+
+class ChunkPlanner(object):
+    """
+    Lazy plan of the chunks of a copy, iterating (srcaddr, tgtaddr, size) up
+    to totalbytes, instead of a precomputed list of addresses. The chunk size
+    adapts to the throughput of the writes given to record(), it doubles while
+    the target keeps up, goes back once a smaller chunk size did better, and
+    halves on a write stalling far behind the running throughput, e.g. on the
+    garbage collection of an eMMC, all within minsize and maxsize. fixedsrc
+    reads every chunk from srcstart, e.g. of /dev/zero
+    """
+    WINDOW = 8 # writes measured per chunk size
+    GAIN = 0.05 # throughput gain worth a change of chunk size
+    STALL = 8.0 # a write this many times slower than the running rate stalls
+
+    def __init__(self, srcstart, tgtstart, totalbytes, chunksize, minsize=0, maxsize=0, fixedsrc=False):
+        super().__init__()
+        self.mSrcStart = srcstart
+        self.mTgtStart = tgtstart
+        self.mTotal = totalbytes
+        self.mChunkSize = chunksize
+        self.mMinSize = minsize if (minsize > 0) else chunksize
+        self.mMaxSize = max(maxsize, chunksize)
+        self.mFixedSrc = fixedsrc
+        # throughput of each chunk size, and the running throughput
+        self.mRates = {}
+        self.mRate = 0.0
+        self.mWindowBytes = 0
+        self.mWindowTime = 0.0
+        self.mWindowCount = 0
+        self.mSizes = {}
+        self.mStalls = 0
+
+    def __iter__(self):
+        offset = 0
+        while offset < self.mTotal:
+            size = min(self.mChunkSize, self.mTotal - offset)
+            self.mSizes[size] = self.mSizes.get(size, 0) + 1
+            yield (self.mSrcStart if self.mFixedSrc else self.mSrcStart + offset, self.mTgtStart + offset, size)
+            offset += size
+
+    def isAdaptive(self):
+        return self.mMinSize < self.mMaxSize
+
+    def getMaxSize(self):
+        return self.mMaxSize
+
+    def getSizes(self):
+        """
+        returns the number of chunks of every chunk size planned so far
+        """
+        return {'{}'.format(size): count for size, count in sorted(self.mSizes.items())}
+
+    def getStalls(self):
+        return self.mStalls
+
+    def record(self, size, seconds):
+        """
+        records a write of size bytes taking seconds, and adapts the chunk size
+        """
+        if not self.isAdaptive() or size <= 0 or seconds <= 0:
+            return
+        rate = size / seconds
+        if self.mRate and rate * self.STALL < self.mRate:
+            self.mStalls += 1
+            _logger.info('{} write stall: {} bytes in {:.3f}s'.format(type(self).__name__, size, seconds))
+            self.__resize(self.mChunkSize // 2)
+            return
+        self.mRate = rate if not self.mRate else (0.8 * self.mRate + 0.2 * rate)
+        if size != self.mChunkSize:
+            # chunks planned before the last change of the chunk size
+            return
+        self.mWindowBytes += size
+        self.mWindowTime += seconds
+        self.mWindowCount += 1
+        if self.mWindowCount >= self.WINDOW:
+            rate = self.mWindowBytes / self.mWindowTime
+            self.mRates[size] = rate
+            down, up = size // 2, size * 2
+            if down >= self.mMinSize and self.mRates.get(down, 0) > rate * (1 + self.GAIN):
+                self.__resize(down)
+            elif up <= self.mMaxSize and (up not in self.mRates or self.mRates[up] > rate * (1 + self.GAIN)):
+                self.__resize(up)
+            else:
+                self.__resize(size)
+
+    def __resize(self, size):
+        size = max(self.mMinSize, min(size, self.mMaxSize))
+        if size != self.mChunkSize:
+            _logger.debug('{} chunk size: {} => {}'.format(type(self).__name__, self.mChunkSize, size))
+        self.mChunkSize = size
+        self.mWindowBytes = 0
+        self.mWindowTime = 0.0
+        self.mWindowCount = 0
+
+
+
+class StreamHasher(object):
+    """
+    Hash of the decoded image stream, computed as it is written, i.e. of the
+    image as flashed without reading the target back. The data is given at
+    its offset in the image, the gaps before it, e.g. the unmapped ranges of a
+    bmap or the don't care chunks of a sparse image, are hashed as zeros, and
+    finish() pads the zeros up to the size of the whole image
+    """
+    ALGOS = ('md5', 'sha256', 'blake2b')
+    ZEROS = 1048576 # zeros hashed at a time
+
+    def __init__(self, algo='md5'):
+        super().__init__()
+        if algo not in self.ALGOS:
+            raise ValueError('unknown stream hash: {}'.format(algo))
+        self.mAlgo = algo
+        self.mHash = hashlib.new(algo)
+        self.mOffset = 0
+        self.mValid = True
+        self.mZeros = memoryview(bytes(self.ZEROS))
+
+    def getAlgo(self):
+        return self.mAlgo
+
+    def getOffset(self):
+        return self.mOffset
+
+    def getDigestSize(self):
+        return self.mHash.digest_size
+
+    def isValid(self):
+        return self.mValid
+
+    def update(self, data, offset=None):
+        """
+        hashes the data at offset, or right after the data hashed so far
+        """
+        if offset is not None and not self.__seek(offset):
+            return
+        self.mHash.update(data)
+        self.mOffset += len(data)
+
+    def fill(self, offset, length, value):
+        """
+        hashes length bytes of the repeated (4 bytes) fill value at offset
+        """
+        if not self.__seek(offset):
+            return
+        pattern = bytes(value) * (self.ZEROS // len(value))
+        while length > 0:
+            size = min(length, len(pattern))
+            self.mHash.update(pattern[:size])
+            self.mOffset += size
+            length -= size
+
+    def finish(self, size=0):
+        """
+        returns the hex digest of the image of size bytes, or None if the
+        stream was not written in order
+        """
+        self.__seek(max(size, self.mOffset))
+        return self.mHash.hexdigest() if self.mValid else None
+
+    def __seek(self, offset):
+        # the gap before offset is hashed as zeros, going back is not hashable
+        if offset < self.mOffset:
+            self.mValid = False
+        while self.mValid and offset > self.mOffset:
+            size = min(offset - self.mOffset, self.ZEROS)
+            self.mHash.update(self.mZeros[:size])
+            self.mOffset += size
+        return self.mValid
+
+
+
+class CopyPipeline(object):
+    """
+    Multi-stage copy pipeline, the read/download stage, the decompress stage
+    and the write stage run concurrently, joined by bounded queues of depth
+    items, so the network/source, the cpu and the storage can work at the
+    same time. With depth 0, all the stages run one after another on the
+    calling thread.
+
+    reader: iterable yielding raw data
+    decoder: callable returning decoded data of the raw data, or None, or a
+             generator yielding the decoded data in blocks
+    writer: callable writing the decoded data, runs on the calling thread
+    release: callable given back the raw data, once its decoded data is
+             written, e.g. to return buffer pool slots
+    flush: callable returning the decoded data held back by the decoder, at
+           the end of the raw data
+    governor: MemoryGovernor lowering the queue depth while running
+    """
+    _END = object()
+
+    def __init__(self, reader, decoder, writer, depth=4, interrupt=None, release=None, flush=None, governor=None):
+        super().__init__()
+        self.mReader = reader
+        self.mDecoder = decoder
+        self.mWriter = writer
+        self.mDepth = depth
+        self.mInterrupt = interrupt if callable(interrupt) else (lambda: False)
+        self.mRelease = release if callable(release) else (lambda rawdata: None)
+        self.mFlush = flush if callable(flush) else (lambda: None)
+        self.mGovernor = governor
+        self.mStopEvent = threading.Event()
+        self.mError = None
+
+    def run(self):
+        if self.mDepth <= 0:
+            for rawdata in self.mReader:
+                self.__checkInterrupt()
+                for data in self.__decode(rawdata):
+                    self.mWriter(data)
+                self.mRelease(rawdata)
+            data = self.mFlush()
+            if data is not None and len(data):
+                self.mWriter(data)
+            return True
+
+        rawq = queue.Queue(self.mDepth)
+        decq = queue.Queue(self.mDepth)
+        threads = [threading.Thread(name='PipeRead', target=self.__readStage, args=(rawq,)), \
+                   threading.Thread(name='PipeDecode', target=self.__decodeStage, args=(rawq, decq))]
+        for thrd in threads:
+            thrd.start()
+        try:
+            while True:
+                item = self.__get(decq)
+                if item is self._END:
+                    break
+                self.__checkInterrupt()
+                self.mWriter(item[1])
+                if item[0] is not None:
+                    self.mRelease(item[0])
+                if self.mGovernor is not None:
+                    # queues of a lower depth hold fewer chunks from now on
+                    rawq.maxsize = decq.maxsize = max(1, min(self.mGovernor.adjust(), self.mDepth))
+        except Exception as ex:
+            self.__abort(ex)
+        finally:
+            self.mStopEvent.set()
+            for thrd in threads:
+                thrd.join()
+        if self.mError is not None:
+            raise self.mError
+        return True
+
+    def __readStage(self, outq):
+        try:
+            for rawdata in self.mReader:
+                # stops pulling from the network/source on a user interrupt
+                self.__checkInterrupt()
+                if not self.__put(outq, rawdata):
+                    return
+        except Exception as ex:
+            self.__abort(ex)
+        finally:
+            self.__put(outq, self._END)
+
+    def __decodeStage(self, inq, outq):
+        try:
+            while True:
+                rawdata = self.__get(inq)
+                if rawdata is self._END:
+                    break
+                # the raw data is given back with its last decoded block
+                pending = None
+                for data in self.__decode(rawdata):
+                    if pending is not None and not self.__put(outq, (None, pending)):
+                        return
+                    pending = data
+                if pending is not None:
+                    if not self.__put(outq, (rawdata, pending)):
+                        return
+                else:
+                    self.mRelease(rawdata)
+            if not self.mStopEvent.is_set():
+                data = self.mFlush()
+                if data is not None and len(data):
+                    self.__put(outq, (None, data))
+        except Exception as ex:
+            self.__abort(ex)
+        finally:
+            self.__put(outq, self._END)
+
+    def __decode(self, rawdata):
+        # yields the non-empty decoded data of the raw data
+        data = self.mDecoder(rawdata)
+        for block in (data if isinstance(data, types.GeneratorType) else (data,)):
+            if block is not None and len(block):
+                yield block
+
+    def __put(self, q, item):
+        # blocks while the queue is full, unless the pipeline is aborted
+        while not self.mStopEvent.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def __get(self, q):
+        # blocks while the queue is empty, unless the pipeline is aborted
+        while not self.mStopEvent.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                self.__checkInterrupt()
+        return self._END
+
+    def __checkInterrupt(self):
+        if self.mInterrupt():
+            raise InterruptedError('User Interrupt to cancel running pipeline')
+
+    def __abort(self, ex):
+        if self.mError is None:
+            _logger.error('{} {} aborted: {}'.format(type(self).__name__, threading.current_thread().name, ex))
+            self.mError = ex
+        self.mStopEvent.set()
+
+
+
 class BaseActionModeller(object):
     """
     Base Action Model for modelling actions to be taken from users commands
@@ -121,6 +559,9 @@ class BaseActionModeller(object):
         self.mParam = {}
         self.mResult = {}
         self.mInterruptedFlag = False
+        self.mGovernor = None
+        self.mHasher = None
+        self.mHashRef = None
 
     def checkInterruptAndExit(self):
         if self.mInterruptedFlag:
@@ -161,6 +602,238 @@ class BaseActionModeller(object):
         # set the interrupted flag
         self.mInterruptedFlag = True
 
+    def _setupSyncPolicy(self, ioobj, barrier=0):
+        # write durability policy of the job, default syncs every 32 MiB
+        policy = self.mParam['sync_policy'] if ('sync_policy' in self.mParam) else 'size'
+        size = self.mParam['sync_size'] if ('sync_size' in self.mParam and self.mParam['sync_size'] > 0) else 32
+        ioobj.setSyncPolicy(policy, size * 1048576, barrier)
+
+    def _setupSparseMode(self, ioobj):
+        # how the all-zero blocks of the job are written, default as is
+        ioobj.setSparseMode(self.mParam['sparse_mode'] if ('sparse_mode' in self.mParam) else 'off')
+
+    def _setupWriteCombine(self, ioobj):
+        # adjacent writes of the job are submitted together, default 4 MiB
+        size = self.mParam['write_combine'] if ('write_combine' in self.mParam and self.mParam['write_combine'] >= 0) else 4
+        ioobj.setWriteCombine(size * 1048576)
+
+    def _setupDirectIO(self, ioobj):
+        # target accessed by O_DIRECT, leaving the page cache to the others
+        if 'direct_io' in self.mParam and self.mParam['direct_io']:
+            ioobj.setDirectIO(True)
+
+    def _getBlockMapNames(self, filename):
+        # bmap file given, or named by bmaptool after the (uncompressed) image
+        if 'bmap_file' in self.mParam and self.mParam['bmap_file']:
+            return [self.mParam['bmap_file']]
+        names = [filename + '.bmap']
+        root, ext = os.path.splitext(filename)
+        if ext in ('.xz', '.gz', '.bz2'):
+            names.insert(0, root + '.bmap')
+        return names
+
+    def _setupStreamHash(self, default='off'):
+        # hash of the decoded image stream as it is written, md5, sha256,
+        # blake2b or off
+        algo = self.mParam['stream_hash'] if ('stream_hash' in self.mParam) else default
+        self.mHasher = StreamHasher(algo) if (algo and algo != 'off') else None
+        return self.mHasher
+
+    def _getHashNames(self, filename):
+        # hash file given, or published next to the (uncompressed) image, e.g.
+        # image.md5.txt of image.xz
+        if 'hash_file' in self.mParam and self.mParam['hash_file']:
+            return [self.mParam['hash_file']]
+        suffix = '.{}.txt'.format(self.mHasher.getAlgo())
+        names = [filename + suffix]
+        root, ext = os.path.splitext(filename)
+        if ext in ('.xz', '.gz', '.bz2'):
+            names.insert(0, root + suffix)
+        return names
+
+    def _parseHash(self, text):
+        # the digest is the 1st word of the hash file, as of md5sum/sha256sum
+        words = (text.decode('utf-8', 'replace') if isinstance(text, bytes) else text).split()
+        digest = words[0].lower() if words else ''
+        if not re.fullmatch('[0-9a-f]+', digest) or len(digest) != 2 * self.mHasher.getDigestSize():
+            raise ValueError('no {} digest'.format(self.mHasher.getAlgo()))
+        return digest
+
+    def _hashData(self, data, offset=None):
+        # hashes the data written, or the extents of an android sparse image
+        if self.mHasher is None:
+            return
+        if isinstance(data, list):
+            for kind, start, length, value in data:
+                if kind == SparseImageFile.CHUNK_RAW:
+                    self.mHasher.update(value, start)
+                elif kind == SparseImageFile.CHUNK_FILL:
+                    self.mHasher.fill(start, length, value)
+        else:
+            self.mHasher.update(data, offset)
+
+    def _verifyStreamHash(self, size=0, compare=True):
+        """
+        finishes the stream hash of the image of size bytes, and compares it
+        with the published hash, returns False on a mismatch
+        """
+        if self.mHasher is None:
+            return True
+        digest = self.mHasher.finish(size)
+        if digest is None:
+            _logger.warning('{} stream hash: not written in order, not verified'.format(type(self).__name__))
+            return True
+        self.mResult['stream_hash'] = digest
+        self.mResult['hash_algo'] = self.mHasher.getAlgo()
+        if self.mHashRef is None or not compare:
+            _logger.info('{} stream {}: {}'.format(type(self).__name__, self.mHasher.getAlgo(), digest))
+            return True
+        self.mResult['stream_hash_match'] = (digest == self.mHashRef)
+        if digest != self.mHashRef:
+            _logger.error('{} stream {} mismatch: {} expected {}'.format(type(self).__name__, self.mHasher.getAlgo(), digest, self.mHashRef))
+            return False
+        _logger.info('{} stream {} verified: {}'.format(type(self).__name__, self.mHasher.getAlgo(), digest))
+        return True
+
+    def _getHashThreads(self):
+        # threads hashing the segments, defaults to all the cpu cores
+        if 'hash_threads' in self.mParam and self.mParam['hash_threads'] > 0:
+            return self.mParam['hash_threads']
+        return os.cpu_count() or 1
+
+    def _hashSegments(self, ioobj, start, algo, segments, executor, threads):
+        """
+        returns the hashes of the (offset, size) segments of ioobj from start
+        in order, read and hashed by the threads, each into its own buffer
+        pool slot, i.e. by O_DIRECT if ioobj is set up so
+        """
+        ioobj.getFileSize() # opens the file before the threads read it
+        slotsize = -(-max([size for offset, size in segments] + [1]) // 65536) * 65536
+        pool = BufferPool(slotsize, threads)
+        futures = [executor.submit(self._hashSegment, ioobj, pool, algo, start + offset, size) for offset, size in segments]
+        hashes = []
+        for future in futures:
+            if self.checkInterruptAndExit():
+                for pending in futures:
+                    pending.cancel()
+                break
+            digest, got = future.result()
+            self.mResult['bytes_read'] += got
+            hashes.append(digest)
+        return hashes
+
+    def _hashSegment(self, ioobj, pool, algo, start, size):
+        # worker, reads and hashes one segment
+        buf = pool.acquire()
+        try:
+            got = ioobj.PreadInto(start, buf, size)
+            return hashlib.new(algo, buf[:got]).hexdigest(), got
+        finally:
+            pool.release(buf)
+
+    def _getManifestNames(self, filename):
+        # segment manifest given, or published next to the (uncompressed) image
+        if 'manifest_file' in self.mParam and self.mParam['manifest_file']:
+            return [self.mParam['manifest_file']]
+        names = [filename + SegmentManifest.SUFFIX]
+        root, ext = os.path.splitext(filename)
+        if ext in ('.xz', '.gz', '.bz2'):
+            names.insert(0, root + SegmentManifest.SUFFIX)
+        return names
+
+    def _planDelta(self, manifest, tgtname, keep=0):
+        """
+        reads back the target by the segments of the manifest, by O_DIRECT in
+        parallel, and returns the block map of the segments to flash, i.e. the
+        ones not matching and the ones below keep, each verified by its hash
+        """
+        tgtio = BlockInputOutput(manifest.getSegmentSize(), tgtname, 'rb', use_mmap=False)
+        tgtio.setDirectIO(True)
+        threads = self._getHashThreads()
+        read = self.mResult['bytes_read']
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=threads, thread_name_prefix='SegHash') as executor:
+                hashes = self._hashSegments(tgtio, 0, manifest.getAlgo(), list(manifest.segments()), executor, threads)
+        finally:
+            tgtio._close()
+            self.mResult['bytes_read'] = read
+        if len(hashes) < manifest.getNumSegments():
+            raise IOError('delta flash interrupted')
+        ranges = [(offset, offset + size, manifest.getHashes()[num]) for num, (offset, size) in enumerate(manifest.segments()) \
+                  if offset < keep or hashes[num] != manifest.getHashes()[num]]
+        self.mResult['delta_segments'] = manifest.getNumSegments()
+        self.mResult['delta_changed'] = len(ranges)
+        self.mResult['delta_bytes'] = sum(end - start for start, end, _ in ranges)
+        _logger.info('{} delta {}: {} of {} segments to flash'.format(type(self).__name__, tgtname, len(ranges), manifest.getNumSegments()))
+        return BlockMap(imagesize=manifest.getImageSize(), ranges=ranges, checksum=manifest.getAlgo())
+
+    def _extendTarget(self, ioobj, size):
+        # regular file target gets the size of the whole image, i.e. the
+        # unmapped ranges of the bmap are holes
+        if stat.S_ISREG(os.stat(ioobj.mFilename).st_mode) and os.path.getsize(ioobj.mFilename) < size:
+            os.truncate(ioobj.mFilename, size)
+
+    def _decodedSize(self, data):
+        # bytes of the decoded data, or of the extents of a sparse image
+        if isinstance(data, list):
+            return sum(extent[2] for extent in data)
+        return len(data)
+
+    def _clipExtents(self, extents, size):
+        # drops the extents of a sparse image beyond size
+        return [(kind, offset, min(length, size - offset), data[:size - offset] if kind == SparseImageFile.CHUNK_RAW else data) \
+                for kind, offset, length, data in extents if offset < size]
+
+    def _writeExtents(self, ioobj, extents):
+        # writes the extents of an android sparse image, i.e. the raw data as
+        # is, the fills as fills, and nothing for the don't care chunks
+        written = 0
+        for kind, offset, length, data in extents:
+            if kind == SparseImageFile.CHUNK_RAW:
+                written += ioobj.Write(data, offset)
+            elif kind == SparseImageFile.CHUNK_FILL:
+                written += ioobj.Fill(offset, length, data)
+        return written
+
+    def _getDecodeBlockSize(self, ioobj, chunksize):
+        # output blocks of the bounded decoder, chunksize rounded up to the
+        # logical block size of the target
+        blksize = ioobj.getLogicalBlockSize()
+        return -(-chunksize // blksize) * blksize
+
+    def _decodeBlocks(self, ioobj, rawchunks):
+        # bounded decoded data of the raw chunks in order, in blocks
+        for rawdata in rawchunks:
+            yield from ioobj.DecompressBlocks(rawdata)
+        yield ioobj.FlushBlocks()
+
+    def _getDecodeThreads(self, ioobj):
+        # threads decoding the xz blocks of ioobj in parallel, defaults to all
+        # the cpu cores the memory governor fits in, with the largest block
+        if 'decode_threads' in self.mParam and self.mParam['decode_threads'] > 0:
+            return self.mParam['decode_threads']
+        if self.mGovernor is not None and (os.cpu_count() or 1) > 1:
+            blocksize = max((block[3] for block in ioobj.getBlockIndex()), default=0)
+            return self.mGovernor.getDecodeThreads(os.cpu_count(), blocksize)
+        return os.cpu_count() or 1
+
+    def _getDecodeBudget(self):
+        # memory of the xz blocks held by the parallel decoder, 0 unbounded
+        if self.mGovernor is not None:
+            return self.mGovernor.getDecodeBudget()
+        return 0
+
+    def _setupGovernor(self, chunksize=0):
+        # memory governor of the job, picks the chunk_size and queue_depth not
+        # given by the params from the available memory, unless chunksize > 0
+        if 'chunk_size' in self.mParam and self.mParam['chunk_size'] > 0:
+            chunksize = self.mParam['chunk_size']
+        depth = self.mParam['queue_depth'] if ('queue_depth' in self.mParam) else -1
+        self.mGovernor = MemoryGovernor(chunksize, depth)
+        self.mParam['chunk_size'] = self.mGovernor.getChunkSize()
+        self.mParam['queue_depth'] = self.mGovernor.getQueueDepth()
+        return self.mGovernor
+
     def _preAction(self):
         """
         To be overriden
@@ -239,6 +912,7 @@ class BasicBlockActionModeller(BaseActionModeller):
                 elif int(self.mParam['tgt_start_sector']) % 512 != 0:
                     raise ValueError('preAction: target start sector must be multiples of 512 sector size')
                 self.mIO = BlockInputOutput(self.mChunkSize, self.mParam['tgt_filename'], 'wb+')
+                self._setupWriteCombine(self.mIO)
                 if 'tgt_data' not in self.mParam or len(self.mParam['tgt_data']) == 0:
                     raise ValueError('preAction: No data to be written')
                 # if no coding and data is hexdecimal, then unhex it,
@@ -307,29 +981,42 @@ class CopyBlockActionModeller(BaseActionModeller):
     """
     Copy Block Action Model to copy blocks of files
     """
+    # copied in the kernel per step, between progress updates
+    COPY_STEP = 33554432 # 32MB
 
     def __init__(self):
         super().__init__()
         self.mIOs = []
+        self.mPool = None
+        self.mBMap = None
+        self.mPlanner = None
         self.isSrcCharDev = False
+        self.mSrcTotalSet = False
 
     def _preAction(self):
         self.mResult['bytes_read'] = 0
         self.mResult['bytes_written'] = 0
+        self.mSrcTotalSet = ('src_total_sectors' in self.mParam) and (self.mParam['src_total_sectors'] != -1)
         # setup the chunksize for input/output objects
         self.isSrcCharDev = stat.S_ISCHR(os.stat(self.mParam['src_filename']).st_mode)
-        if ('chunk_size' in self.mParam and self.mParam['chunk_size'] > 0):
-            chunksize = self.mParam['chunk_size']
-        else:
-            # chunk_size in bytes default 1MB, i.e. 1048576
-            chunksize = 1048576 # 1MB
-            self.mParam['chunk_size'] = chunksize
+        # the memory governor picks the chunk_size, but the start/total sectors
+        # are in chunks, i.e. default 1MB, i.e. 1048576
+        sectors = self.mSrcTotalSet or any((s in self.mParam and self.mParam[s] > 0) for s in ['src_start_sector', 'tgt_start_sector'])
+        chunksize = self._setupGovernor(1048576 if sectors else 0).getChunkSize()
 
         if all(s in self.mParam for s in ['src_filename', 'tgt_filename']):
             try:
                 # default mode is rb+
-                self.mIOs.append(BlockInputOutput(chunksize, self.mParam['src_filename'], 'rb'))
-                self.mIOs.append(BlockInputOutput(chunksize, self.mParam['tgt_filename'], 'wb+'))
+                # regular file source is read by memoryview slices of mmap
+                usemmap = self.mParam['use_mmap'] if ('use_mmap' in self.mParam) else True
+                self.mIOs.append(BlockInputOutput(chunksize, self.mParam['src_filename'], 'rb', use_mmap=usemmap))
+                # delta flash reads back the target first, and keeps what matches
+                delta = self.__loadDeltaMap()
+                self.mIOs.append(BlockInputOutput(chunksize, self.mParam['tgt_filename'], 'wb+' if delta is None else 'rb+'))
+                self._setupSyncPolicy(self.mIOs[1])
+                self._setupSparseMode(self.mIOs[1])
+                self._setupWriteCombine(self.mIOs[1])
+                self._setupDirectIO(self.mIOs[1])
                 if self.isSrcCharDev:
                     filesize = self.mIOs[-1].getFileSize()
                     # special case where source is a char device and target is a block device, 
@@ -346,6 +1033,9 @@ class CopyBlockActionModeller(BaseActionModeller):
                 if ('src_total_sectors' not in self.mParam) or (self.mParam['src_total_sectors'] == -1):
                     chunks, remainder = divmod(filesize, blksize)
                     self.mParam['src_total_sectors'] = chunks + (0 if remainder == 0 else 1)
+                self.mBMap = self.__loadBlockMap() if delta is None else delta
+                if self._setupStreamHash() is not None:
+                    self.mHashRef = self.__loadHashFile()
             except Exception as ex:
                 raise IOError('Cannot create block inputoutput: {}'.format(ex))
         else:
@@ -369,22 +1059,72 @@ class CopyBlockActionModeller(BaseActionModeller):
                 srcstart = self.mParam['src_start_sector'] * blksize
                 tgtstart = self.mParam['tgt_start_sector'] * blksize
                 totalbytes = self.mParam['src_total_sectors'] * blksize
+                # xz source from a start sector decodes from the block holding it
+                reader = self.mIOs[0].getSeekableReader() if (srcstart > 0 and not self.isSrcCharDev) else None
+                if reader is not None:
+                    uncompressed = max(reader.seek(0, 2) - srcstart, 0)
+                    totalbytes = min(totalbytes, uncompressed) if self.mSrcTotalSet else uncompressed
                 self.mResult['total_size'] = totalbytes
-                # sector addresses of a very large file for looping
-                address = self.__chunks(srcstart, tgtstart, totalbytes, chunksize)
-                _logger.warn('total_size: {} block_size: {} list of addresses {} to copy: {}'.format(totalbytes, blksize, len(address), [addr for addr in address]))
-                if len(address) > 1:
-                    for (srcaddr, tgtaddr) in address:
-                        if not self.checkInterruptAndExit():
-                            self.__copyChunk(srcaddr, tgtaddr, 1)
-                        else:
-                            raise InterruptedError('User Interrupt to cancel running process')
+                _logger.info('total_size: {} block_size: {} chunk_size: {}'.format(totalbytes, blksize, chunksize))
+                # android sparse image source is expanded, when copied as a whole
+                self.mIOs[0].setDecodeSparse(self.mBMap is None and srcstart == 0)
+                # compressed source decodes into bounded blocks of the target
+                self.mIOs[0].setDecodeBlockSize(self._getDecodeBlockSize(self.mIOs[1], chunksize))
+                self.mIOs[0].setMemLimit(self.mGovernor.getMemLimit())
+                if self.__canCopyRange(tgtstart):
+                    # uncompressed source is copied in the kernel, whatever it
+                    # refuses is copied by the chunks below
+                    totalbytes = min(totalbytes, max(self.mIOs[0].getFileSize() - srcstart, 0))
+                    copied = self.__copyRange(srcstart, totalbytes)
+                    srcstart += copied
+                    totalbytes -= copied
+                if totalbytes <= 0 or self.checkInterruptAndExit():
+                    # all copied in the kernel, or interrupted
+                    pass
+                elif self.mBMap is not None and srcstart == 0:
+                    # only the mapped ranges are read, decoded, verified and written
+                    if self.mSrcTotalSet:
+                        self.mBMap.clip(totalbytes)
+                    self.mResult['total_size'] = self.mBMap.getMappedSize()
+                    depth = self.mParam['queue_depth'] if ('queue_depth' in self.mParam) else 4
+                    pipeline = CopyPipeline(self.__readMapped(chunksize), self.__verifyMapped, \
+                                            self.__writeMapped, depth, self.checkInterruptAndExit)
+                    pipeline.run()
+                    self._extendTarget(self.mIOs[1], self.mBMap.getImageSize())
+                elif reader is not None:
+                    depth = self.mParam['queue_depth'] if ('queue_depth' in self.mParam) else 4
+                    pipeline = CopyPipeline(self.__readSeekable(reader, srcstart, totalbytes, chunksize), \
+                                            lambda data: data, self.__writeChunk, depth, self.checkInterruptAndExit)
+                    pipeline.run()
+                elif totalbytes > chunksize:
+                    # read, decompress and write on a pipeline of queue_depth
+                    depth = self.mParam['queue_depth'] if ('queue_depth' in self.mParam) else 4
+                    # lazy chunks of the source, of the chunk size adapting to the target
+                    self.mPlanner = self.__planChunks(srcstart, tgtstart, totalbytes, chunksize)
+                    # enough slots for the chunks held by all the pipeline stages, of
+                    # a source read by ReadInto(), a memory mapped one is not copied
+                    self.mPool = None if self.mIOs[0].mUseMmap else BufferPool(self.mPlanner.getMaxSize(), 2 * max(depth, 0) + 4)
+                    # block indexed xz source decodes on all the cpu cores
+                    self.mIOs[0].setDecodeThreads(self._getDecodeThreads(self.mIOs[0]), srcstart, self._getDecodeBudget())
+                    pipeline = CopyPipeline(self.__readChunks(self.mPlanner), self.__decodeChunk, \
+                                            self.__writeChunk, depth, self.checkInterruptAndExit, \
+                                            self.mPool.release if self.mPool else None, self.__flushChunk, self.mGovernor)
+                    pipeline.run()
+                    self.mResult['chunk_sizes'] = self.mPlanner.getSizes()
+                    self.mResult['chunk_stalls'] = self.mPlanner.getStalls()
                 else:
                     self.__copyChunk(srcstart, tgtstart, totalbytes)
+                if self.mIOs[0].getSparseImage():
+                    # trailing don't care chunks of an android sparse image
+                    self._extendTarget(self.mIOs[1], self.mIOs[0].getSparseImage().getImageSize())
+                # checkpoint at the end of copy
+                self.mIOs[1].Sync()
                 ret = True
             else:
                 self.__copyChunk(srcstart, tgtstart, totalbytes)
-            ret = True
+            # the image as written is checked against the published hash,
+            # unless only the mapped ranges or the expanded sparse image are
+            ret = self._verifyStreamHash(self.__getImageSize(), self.mBMap is None and not self.mIOs[0].getSparseImage())
         except:
             raise ValueError('mainAction: No specified src/tgt start sector, nor total sectors')
         finally:
@@ -397,22 +1137,252 @@ class CopyBlockActionModeller(BaseActionModeller):
 
     def __copyChunk(self, srcaddr, tgtaddr, numChunks):
         # read src and write to the target
+        if self.mIOs[0].mCFHandle is not None:
+            # compressed src decodes into bounded blocks
+            rawdata = self.mIOs[0].ReadRaw(srcaddr, self.mIOs[0].getFileSize() - srcaddr)
+            for data in self._decodeBlocks(self.mIOs[0], [rawdata]):
+                if self._decodedSize(data) > 0:
+                    self.mResult['bytes_read'] += self._decodedSize(data)
+                    self.__writeChunk(data)
+            return
         data = self.mIOs[0].Read(srcaddr, numChunks)
-        self.mResult['bytes_read'] += len(data)
-        written = self.mIOs[1].Write(data, self.mResult['bytes_written'])
-        _logger.debug('{} read: @{} size:{}, written: @{} size:{}'.format(type(self).__name__, hex(srcaddr), len(data), hex(tgtaddr), written))
+        self.mResult['bytes_read'] += self._decodedSize(data)
+        self._hashData(data, self.mResult['bytes_written'])
+        if isinstance(data, list):
+            # extents of an android sparse image, at their own offsets
+            written = self._writeExtents(self.mIOs[1], data)
+        else:
+            written = self.mIOs[1].Write(data, self.mResult['bytes_written'])
+        _logger.debug('{} read: @{} size:{}, written: @{} size:{}'.format(type(self).__name__, hex(srcaddr), self._decodedSize(data), hex(tgtaddr), written))
         # write should return number of bytes written
         if (written > 0):
             self.mResult['bytes_written'] += written
         del data # hopefully this would clear the write data buffer
 
-    def __chunks(self, srcstart, tgtstart, totalbytes, chunksize):
-        # breaks up data into blocks, with source/target sector addresses
-        parts = -(-totalbytes // chunksize) # int ceiling division
-        if stat.S_ISCHR(os.stat(self.mParam['src_filename']).st_mode):
-            return [(0, tgtstart + i*chunksize) for i in range(parts)]
+    def __canCopyRange(self, tgtstart):
+        # plain image or block device copied as is, from the start of the target
+        return (self.mParam['kernel_copy'] if ('kernel_copy' in self.mParam) else True) and \
+               not self.isSrcCharDev and self.mBMap is None and tgtstart == 0 and \
+               self.mIOs[0].mCFHandle is None and not self.mIOs[0].getFormatChain() and \
+               self.mIOs[1].mSparseMode == 'off' and not self.mIOs[1].mDirect and self.mHasher is None
+
+    def __copyRange(self, srcstart, totalbytes):
+        # kernel side copy in steps of COPY_STEP, returns the bytes copied
+        copied = 0
+        while copied < totalbytes and not self.checkInterruptAndExit():
+            size = min(self.COPY_STEP, totalbytes - copied)
+            written = self.mIOs[1].CopyRange(self.mIOs[0], srcstart + copied, copied, size)
+            self.mResult['bytes_read'] += written
+            self.mResult['bytes_written'] += written
+            copied += written
+            if written < size:
+                break
+        return copied
+
+    def __planChunks(self, srcstart, tgtstart, totalbytes, chunksize):
+        # the chunk size of an uncompressed source adapts to the writes, as
+        # the chunks read are the chunks written
+        adaptive = (self.mParam['adaptive_chunks'] if ('adaptive_chunks' in self.mParam) else True) and \
+                   self.mIOs[0].mCFHandle is None
+        minsize, maxsize = self.mGovernor.getChunkRange(chunksize) if adaptive else (chunksize, chunksize)
+        return ChunkPlanner(srcstart, tgtstart, totalbytes, chunksize, minsize, maxsize, self.isSrcCharDev)
+
+    def __readChunks(self, planner):
+        # read stage, yields raw (still compressed) chunks of the source,
+        # read into buffer pool slots unless the source is memory mapped
+        for (srcaddr, tgtaddr, chunksize) in planner:
+            if self.mIOs[0].mUseMmap:
+                yield self.mIOs[0].ReadRaw(srcaddr, chunksize)
+            else:
+                buf = self.mPool.acquire()
+                size = self.mIOs[0].ReadInto(srcaddr, buf[:chunksize])
+                yield buf[:size]
+
+    def __loadBlockMap(self):
+        # optional bmap file next to the source image
+        if self.isSrcCharDev or not (self.mParam['use_bmap'] if ('use_bmap' in self.mParam) else True):
+            return None
+        for name in self._getBlockMapNames(self.mParam['src_filename']):
+            if os.path.isfile(name):
+                try:
+                    with open(name, 'rb') as f:
+                        bmap = BlockMap(f.read())
+                    _logger.info('{} bmap {}: {} of {} bytes mapped'.format(type(self).__name__, name, bmap.getMappedSize(), bmap.getImageSize()))
+                    return bmap
+                except Exception as ex:
+                    _logger.warning('{} ignores bmap {}: {}'.format(type(self).__name__, name, ex))
+        return None
+
+    def __loadHashFile(self):
+        # optional hash file next to the source image, of a whole image only
+        if self.isSrcCharDev or self.mSrcTotalSet or ('src_start_sector' in self.mParam and self.mParam['src_start_sector'] > 0):
+            return None
+        for name in self._getHashNames(self.mParam['src_filename']):
+            if os.path.isfile(name):
+                try:
+                    with open(name, 'rb') as f:
+                        digest = self._parseHash(f.read())
+                    _logger.info('{} hash {}: {}'.format(type(self).__name__, name, digest))
+                    return digest
+                except Exception as ex:
+                    _logger.warning('{} ignores hash {}: {}'.format(type(self).__name__, name, ex))
+        return None
+
+    def __loadDeltaMap(self):
+        """
+        returns the block map of the segments of the existing target to flash
+        by the manifest next to the source, i.e. the ones not matching, or None
+        to flash as a whole, e.g. without a manifest, or not a whole image
+        """
+        if not (self.mParam['delta_flash'] if ('delta_flash' in self.mParam) else False) or self.isSrcCharDev or self.mSrcTotalSet or \
+           any((s in self.mParam and self.mParam[s] > 0) for s in ['src_start_sector', 'tgt_start_sector']) or \
+           not os.path.exists(self.mParam['tgt_filename']):
+            return None
+        for name in self._getManifestNames(self.mParam['src_filename']):
+            if os.path.isfile(name):
+                try:
+                    with open(name, 'rb') as f:
+                        manifest = SegmentManifest(f.read())
+                except Exception as ex:
+                    _logger.warning('{} ignores manifest {}: {}'.format(type(self).__name__, name, ex))
+                    continue
+                return self._planDelta(manifest, self.mParam['tgt_filename'])
+        return None
+
+    def __getImageSize(self):
+        # size of the whole image hashed, of the bmap or of the sparse image
+        if self.mIOs[0].getSparseImage():
+            return self.mIOs[0].getSparseImage().getImageSize()
+        if self.mBMap is not None and self.mParam['src_start_sector'] == 0:
+            return self.mBMap.getImageSize()
+        return 0
+
+    def __readMapped(self, chunksize):
+        # read stage of the mapped ranges, yields (offset, data)
+        if self.mIOs[0].mCFHandle is None:
+            for offset, size in self.mBMap.pieces(chunksize):
+                yield offset, self.mIOs[0].ReadRaw(offset, size)
+            return
+        reader = self.mIOs[0].getSeekableReader()
+        if reader is not None:
+            for offset, size in self.mBMap.pieces(chunksize):
+                reader.seek(offset)
+                yield offset, reader.read(size)
+        else:
+            # other compressed images are decoded as a whole, keeping the mapped data
+            rawchunks = (self.mIOs[0].ReadRaw(addr, chunksize) for addr in range(0, self.mIOs[0].getFileSize(), chunksize))
+            yield from self.mBMap.split(self._decodeBlocks(self.mIOs[0], rawchunks))
+
+    def __verifyMapped(self, item):
+        # verify stage, against the range checksums of the bmap
+        self.mBMap.verify(item[0], item[1])
+        self.mResult['bytes_read'] += len(item[1])
+        return item
+
+    def __writeMapped(self, item):
+        # write stage, at the offset of the mapped data
+        self._hashData(item[1], item[0])
+        written = self.mIOs[1].Write(item[1], item[0])
+        if written != len(item[1]):
+            raise IOError('Failed to write {} bytes at {}'.format(len(item[1]), item[0]))
+        self.mResult['bytes_written'] += written
+
+    def __readSeekable(self, reader, srcstart, totalbytes, chunksize):
+        # read stage of a xz source, yields chunks already decoded, from the
+        # block holding srcstart onwards
+        reader.seek(srcstart)
+        while totalbytes > 0:
+            data = reader.read(min(chunksize, totalbytes))
+            if not data:
+                break
+            totalbytes -= len(data)
+            self.mResult['bytes_read'] += len(data)
+            yield data
+
+    def __decodeChunk(self, rawdata):
+        # decompress stage, yields bounded blocks of the decoded data
+        for data in self.mIOs[0].DecompressBlocks(rawdata):
+            self.mResult['bytes_read'] += self._decodedSize(data)
+            yield data
+
+    def __flushChunk(self):
+        # decompress stage, the decoded data held back at the end
+        data = self.mIOs[0].FlushBlocks()
+        self.mResult['bytes_read'] += self._decodedSize(data)
+        return data
+
+    def __writeChunk(self, data):
+        # write stage, write should return number of bytes written
+        self._hashData(data, self.mResult['bytes_written'])
+        start = time.monotonic()
+        if isinstance(data, list):
+            # extents of an android sparse image, at their own offsets
+            written = self._writeExtents(self.mIOs[1], data)
+        else:
+            written = self.mIOs[1].Write(data, self.mResult['bytes_written'])
+            if self.mPlanner is not None:
+                self.mPlanner.record(written, time.monotonic() - start)
+        if (written > 0):
+            self.mResult['bytes_written'] += written
+
+
+
+class EraseBlockActionModeller(BaseActionModeller):
+    """
+    Erase Block Action Model to erase ranges of storage media or files, by the
+    zeroing and discard ioctls or fallocate, instead of copying /dev/zero
+    """
+    # erased per step, between progress updates and interrupt checks
+    ERASE_STEP = 67108864 # 64MB
+
+    def __init__(self):
+        super().__init__()
+        self.mIO = None
+
+    def _preAction(self):
+        self.mResult['bytes_written'] = 0
+        if 'tgt_filename' not in self.mParam or not os.path.exists(self.mParam['tgt_filename']):
+            raise ValueError('preAction: No tgt file specified')
+        if stat.S_ISCHR(os.stat(self.mParam['tgt_filename']).st_mode):
+            raise IOError('preAction: target filename/device cannot be a char dev')
+        # the target is never truncated, i.e. a regular file keeps its size
+        self.mIO = BlockInputOutput(self.ERASE_STEP, self.mParam['tgt_filename'], 'rb+')
+        self._setupSyncPolicy(self.mIO)
+        filesize = self.mIO.getFileSize()
+        tgtstart = self.mParam['tgt_start_sector'] * 512 if ('tgt_start_sector' in self.mParam and self.mParam['tgt_start_sector'] > 0) else 0
+        if 'total_sectors' in self.mParam and self.mParam['total_sectors'] > 0:
+            totalbytes = min(self.mParam['total_sectors'] * 512, max(filesize - tgtstart, 0))
         else:
-            return [(srcstart+i*chunksize, tgtstart + i*chunksize) for i in range(parts)]
+            totalbytes = max(filesize - tgtstart, 0)
+        self.mParam['tgt_start_sector'] = tgtstart // 512
+        self.mParam['total_sectors'] = totalbytes // 512
+        self.mResult['total_size'] = totalbytes
+        _logger.warn('self.mParam: {}'.format(self.mParam))
+        return True
+
+    def _mainAction(self):
+        # erase the range of the target in steps
+        ret = False
+        try:
+            mode = self.mParam['erase_mode'] if ('erase_mode' in self.mParam) else 'zeroout'
+            step = self.mParam['chunk_size'] if ('chunk_size' in self.mParam and self.mParam['chunk_size'] >= 512) else self.ERASE_STEP
+            # whole sectors, as the zeroing ioctls require
+            step -= step % 512
+            start = self.mParam['tgt_start_sector'] * 512
+            end = start + self.mResult['total_size']
+            for offset in range(start, end, step):
+                if self.checkInterruptAndExit():
+                    break
+                self.mResult['bytes_written'] += self.mIO.Erase(offset, min(step, end - offset), mode)
+            # checkpoint at the end of erase
+            self.mIO.Sync()
+            ret = self.mResult['bytes_written'] == self.mResult['total_size']
+        finally:
+            # close the block device
+            _logger.warn('close mIO: {} mHandle: {}'.format(self.mIO, self.mIO.mHandle))
+            self.mIO._close()
+            del self.mIO
+        return ret
 
 
 
@@ -783,17 +1753,19 @@ class WebDownloadActionModeller(BaseActionModeller):
         self.mPartRead = 0
         self.mPartWritten = 0
         self.mUseDD = True
-        self.mWGETcmd = None
-        self.mDECOMPcmd = None
-        self.mDDcmd = None
+        self.mPool = None
+        self.mBlocks = []
+        self.mBlock = 0
+        self.mResume = None
+        self.mBMap = None
 
     def _preAction(self):
         self.mResult['bytes_read'] = 0
         self.mResult['bytes_written'] = 0
-        self.mUseDD = self.mParam['use_dd'] if 'use_dd' in self.mParam else True
-
-        # setup options, chunk_size in bytes default 64KB, i.e. 65536
-        chunksize = self.mParam['chunk_size'] if ('chunk_size' in self.mParam) else 65535 # 64K
+        # setup options, the memory governor picks the chunk_size in bytes, and
+        # streams the download (dd) unless there is plenty of free memory
+        chunksize = self._setupGovernor().getChunkSize()
+        self.mUseDD = self.mParam['use_dd'] if 'use_dd' in self.mParam else self.mGovernor.useStream()
         srcPath = '{}/{}'.format(self.mParam['src_directory'].strip('/'), self.mParam['src_filename'].lstrip('/'))
         host = self.mParam['host_name'] if ('host_name' in self.mParam) else 'rescue.technexion.net'
         port = self.mParam['host_port'] if ('host_port' in self.mParam) else None
@@ -809,10 +1781,40 @@ class WebDownloadActionModeller(BaseActionModeller):
         if os.path.exists(self.mParam['tgt_filename']):
             # ensure target path exists, and then setup the input/output objects
             if 'tgt_filename' in self.mParam:
-                self.mIOs.append(WebInputOutput(chunksize, srcPath, host=dlhost, username=username, password=password))
-                self.mIOs.append(BlockInputOutput(chunksize, self.mParam['tgt_filename'], 'wb+'))
+                # parallel connections of segmented download, if the host supports byte ranges
+                connections = self.mParam['dl_connections'] if ('dl_connections' in self.mParam) else 4
+                self.mIOs.append(WebInputOutput(chunksize, srcPath, host=dlhost, username=username, password=password, connections=connections))
+                # resume from the checkpoint of a previous failed download of the same
+                # image, from the same or a different host, without truncating the target
+                # only single stream, as the range of a partial stream stops before its index
+                index = self.mIOs[0].getXZIndex()
+                self.mBlocks = index.getBlocks() if (index and len(index.getStreams()) == 1) else []
+                # only the mapped ranges are written with a bmap, i.e. no checkpoints
+                self.mBMap = self.__loadBlockMap(srcPath, dlhost, username, password)
+                # delta flash reads back the target first, and only the segments
+                # not matching are downloaded and written, as mapped ranges
+                delta = self.__loadDeltaMap(srcPath, dlhost, username, password)
+                if delta is not None:
+                    self.mBMap = delta
+                if self.mBMap is not None:
+                    self.mBlocks = []
+                self.mResume = self.__loadCheckpoint()
+                # the stream is hashed from its start, i.e. not when resumed
+                if not self.mResume and self._setupStreamHash('md5') is not None:
+                    self.mHashRef = self.__loadHashFile(srcPath, dlhost, username, password)
+                mode = 'rb+' if self.mResume else 'wb+'
+                self.mIOs.append(BlockInputOutput(chunksize, self.mParam['tgt_filename'], 'rb+' if delta is not None else mode))
+                # the decompressed image is written as is, whatever the (not truncated)
+                # target looks like, e.g. a tar magic of the held back zeroed head
+                self.mIOs[1].mCFHandle = None
+                # the held back 1st boot partition is the ordering barrier of the target
+                self._setupSyncPolicy(self.mIOs[1], self.mParam['src_start_sector'] * 512)
+                self._setupSparseMode(self.mIOs[1])
+                self._setupWriteCombine(self.mIOs[1])
+                self._setupDirectIO(self.mIOs[1])
                 if self.mParam['src_start_sector'] > 0:
-                    self.mIOs.append(FileInputOutput('/tmp/p1.img', 'wb+'))
+                    self.mIOs.append(FileInputOutput('/tmp/p1.img', mode))
+                    self.mIOs[2].setSyncPolicy('close')
             else:
                 raise ValueError('preAction: No tgt file specified')
         else:
@@ -827,62 +1829,64 @@ class WebDownloadActionModeller(BaseActionModeller):
         ret = False
         try:
             self.mResult['total_uncompressed'] = self.mIOs[0].getUncompressedSize()
+            # enough buffer pool slots for the chunks held by all the pipeline stages
+            chunksize = self.mParam['chunk_size'] if ('chunk_size' in self.mParam) else 65536 # 64K
+            self.mPool = BufferPool(chunksize, 2 * max(self.__getQueueDepth(), 0) + 4)
+            self.mResult['bytes_downloaded'] = 0
+            self.mIOs[0].setMemLimit(self.mGovernor.getMemLimit())
+            if self.mResume:
+                self.__resumeDownload()
+            else:
+                # block indexed xz image decodes on all the cpu cores
+                self.mIOs[0].setDecodeThreads(self._getDecodeThreads(self.mIOs[0]), 0, self._getDecodeBudget())
+                # android sparse image is expanded, unless only mapped ranges are
+                self.mIOs[0].setDecodeSparse(self.mBMap is None)
+            # compressed image decodes into bounded blocks of the target
+            self.mIOs[0].setDecodeBlockSize(self._getDecodeBlockSize(self.mIOs[1], chunksize))
 
             # if free mem available > 671088640: # 640 * 1024 * 1024 bytes
-            if not self.mUseDD: # not dd-able (plenty of free memory)
+            if self.mBMap is not None:
+                chunksize = self.mParam['chunk_size'] if ('chunk_size' in self.mParam) else 65536 # 64K
+                headsize = self.mParam['src_start_sector'] * 512
+                if 'src_total_sectors' in self.mParam and self.mParam['src_total_sectors'] > 0:
+                    self.mBMap.clip(self.mParam['src_total_sectors'] * 512)
+                ret = self.__streamMapped(headsize, chunksize)
+            elif not self.mUseDD: # not dd-able (plenty of free memory)
                 # python lzma method
                 chunksize = self.mParam['chunk_size'] if ('chunk_size' in self.mParam) else 65536 # 64K
                 srcstart = self.mParam['src_start_sector'] * 512
                 tgtstart = srcstart
-                totalbytes = self.mIOs[0].getFileSize()
-                # sector addresses of a very large file for looping
-                if totalbytes > 0:
-                    address = self.__chunks(0, 0, totalbytes, chunksize)
-                else:
+                totalbytes = self.mIOs[0].getFileSize() - self.mResult['bytes_downloaded']
+                if totalbytes <= 0:
                     raise IOError('There is 0 Total Bytes to download')
-                _logger.debug('list of addresses {} to copy: {}'.format(len(address), address))
-                if len(address) > 0:
-                    # copy the target image
-                    for (srcaddr, tgtaddr) in address:
-                        if not self.checkInterruptAndExit():
-                            self.__copyChunk(srcaddr, tgtaddr, 1, skip=True)
-                        else:
-                            raise InterruptedError('User Interrupt to cancel copy chunk process')
-                    ret = True
+                # copy the target image on a download, decompress and write pipeline,
+                # over the lazy chunks of a very large file
+                pipeline = CopyPipeline(self.__readChunks(ChunkPlanner(0, 0, totalbytes, chunksize)), self.__decodeChunk, \
+                                        lambda data: self.__writeData(data, srcstart), \
+                                        self.__getQueueDepth(), self.checkInterruptAndExit, \
+                                        self.mPool.release, self.__flushChunk, self.mGovernor)
+                ret = pipeline.run()
             else:
-                # otherwise use shell subprocess Popen to dd
-                chunksize = self.mParam['chunk_size'] if ('chunk_size' in self.mParam) else 4096 # 4K
-                skipstart = (self.mParam['src_start_sector'] * 512) // chunksize
-                seekstart = skipstart
+                # otherwise stream in-process, i.e. replaces wget | xz -d | dd
+                chunksize = self.mParam['chunk_size'] if ('chunk_size' in self.mParam) else 65536 # 64K
+                headsize = self.mParam['src_start_sector'] * 512
                 if 'src_total_sectors' in self.mParam and self.mParam['src_total_sectors'] > 0:
-                    srccount = (self.mParam['src_total_sectors'] * 512) // chunksize
-                else:
-                    srccount = self.mResult['total_uncompressed'] // chunksize
-                # setup decompress command
-                DecompCmd = {'tar': 'tar xvf', 'zip':'zip -d', 'xz':'xz -d', 'bz':'bzip2 -d', 'gz':'gzip -d'}
-                self.mDECOMPcmd = 'xz -d' # default
-                for k, v in DecompCmd.items():
-                    if k in self.mIOs[0].getFileType():
-                        self.mDECOMPcmd = v
-                # setup wget command with html header with basicc login info
-                if 'host_username' in self.mParam and 'host_password' in self.mParam:
-                    login = '{}:{}'.format(self.mParam['host_username'], self.mParam['host_password'])
-                    strAuth = base64.urlsafe_b64encode(login.encode('utf-8'))
-                    header = "--header='Accept-Encoding: identity' --header='Authorization: Basic {}'".format(strAuth.decode())
+                    totalbytes = self.mParam['src_total_sectors'] * 512
                 else:
-                    header = ''
-                self.mWGETcmd = 'wget {} -q -O - {}'.format(header, self.mIOs[0].mUrl)
-
-                # setup dd command, chunksize at a time
-                ddcmd = 'dd of={} bs={} skip={} seek={} count={} conv=notrunc,fsync'.format(self.mIOs[1].mFilename, chunksize, skipstart, seekstart, srccount)
-                ret = self.__ddChunk(self.mWGETcmd, self.mDECOMPcmd, ddcmd)
-                if ret:
-                    self.mPartRead = self.mResult['bytes_read']
-                    self.mPartWritten = self.mResult['bytes_written']
-                self.mDDcmd = 'dd of={} bs={} count={} conv=notrunc,fsync'.format(self.mIOs[1].mFilename, chunksize, skipstart)
-
+                    totalbytes = 0 # till the end of the download stream
+                ret = self.__streamImage(headsize, totalbytes, chunksize)
+
+            if self.mIOs[0].getSparseImage():
+                self._extendTarget(self.mIOs[1], self.mIOs[0].getSparseImage().getImageSize())
+            # checkpoint at the end of download
+            self.mIOs[1].Sync()
+            # the image as written is checked against the published hash,
+            # unless only the mapped ranges or the expanded sparse image are
+            if not self._verifyStreamHash(self.__getImageSize(), self.mBMap is None and not self.mIOs[0].getSparseImage()):
+                raise IOError('{} of the image stream does not match'.format(self.mHasher.getAlgo()))
             ret = True
         except Exception as ex:
+            ret = False
             # close the block device
             for ioobj in self.mIOs:
                 _logger.warn('close mIO: {} mHandle: {}'.format(ioobj, ioobj.mHandle))
@@ -893,21 +1897,18 @@ class WebDownloadActionModeller(BaseActionModeller):
 
     def _postAction(self):
         ret = False
-        # write back the first partition to eMMC from /tmp/mmcblk2p1
+        # write back the first partition to eMMC from /tmp/p1.img
         if self.mParam['src_start_sector'] > 0:
-            if not self.mUseDD:
-                # copy the target image
-                data = self.mIOs[2].Read(0)
-                written = self.mIOs[1].Write(data, 0)
-                _logger.debug('Write over 1st boot partition: copied size {}, written: {}'.format(self.mPartWritten, written))
-                if written == self.mPartWritten:
-                    ret = True
-            else:
-                # dd to overwrite the first partition
-                self.__ddChunk(self.mWGETcmd, self.mDECOMPcmd, self.mDDcmd)
+            # copy the held back 1st boot partition
+            data = self.mIOs[2].Read(0)
+            written = self.mIOs[1].Write(data, 0)
+            _logger.debug('Write over 1st boot partition: copied size {}, written: {}'.format(self.mPartWritten, written))
+            if written == self.mPartWritten:
                 ret = True
         else:
             ret = True
+        if ret:
+            self.__removeCheckpoint()
         # close the block device
         for ioobj in self.mIOs:
             _logger.warn('close mIO: {} mHandle: {}'.format(ioobj, ioobj.mHandle))
@@ -916,135 +1917,323 @@ class WebDownloadActionModeller(BaseActionModeller):
 
         return ret
 
-    def __chunks(self, srcstart, tgtstart, totalbytes, chunksize):
-        # breaks up data into blocks, with source/target sector addresses
-        parts = -(-totalbytes // chunksize) # int ceiling division
-        return [(srcstart+i*chunksize, tgtstart + i*chunksize) for i in range(parts)]
-
-    def __parseProgress(self, pid, line, rex):
-        # extract percentage and size downloaded from web
-        p = re.compile(rex, re.IGNORECASE)
-        m = p.match(line)
-        if m:
-            _logger.debug('parseProgress: i/o records: {}'.format(m.groups()))
-            if pid == self.__pddpid:
-                recin, partin, recout, partout = m.groups()
-                self.mResult['bytes_read'] = int(recin) * 4096 + self.mPartRead
-                self.mResult['bytes_written'] = int(recout) * 4096 + self.mPartWritten
-            else:
-                percent, read, eta = m.groups()
-                self.mResult['bytes_read'] = read
-                self.mResult['bytes_written'] = self.mResult['total_uncompressed'] * int(percent) // 100
-                self.mResult['eta'] = eta
+    def __getQueueDepth(self):
+        return self.mParam['queue_depth'] if ('queue_depth' in self.mParam) else 4
+
+    def __readChunks(self, planner):
+        # download stage, yields raw (still compressed) chunks in buffer pool slots
+        for (srcaddr, tgtaddr, chunksize) in planner:
+            buf = self.mPool.acquire()
+            size = self.mIOs[0].ReadInto(srcaddr, buf[:chunksize])
+            yield buf[:size]
+
+    def __decodeChunk(self, rawdata):
+        # decompress stage, yields bounded blocks of the decoded data
+        for data in self.mIOs[0].DecompressBlocks(rawdata):
+            self.mResult['bytes_read'] += self._decodedSize(data)
+            yield data
+
+    def __flushChunk(self):
+        # decompress stage, the decoded data held back at the end
+        data = self.mIOs[0].FlushBlocks()
+        self.mResult['bytes_read'] += self._decodedSize(data)
+        return data
+
+    def __streamImage(self, headsize, totalbytes, chunksize):
+        """
+        in-process replacement of the wget | xz -d | dd | tee pipeline
+        downloads raw data, decompresses it incrementally, and writes it at
+        exact byte offsets of the target, so the bytes_read/bytes_written
+        results are always precise
+        """
+        pipeline = CopyPipeline(self.__downloadStream(totalbytes, chunksize), \
+                                lambda rawdata: self.__decodeStream(rawdata, totalbytes), \
+                                lambda data: self.__writeData(data, headsize), \
+                                self.__getQueueDepth(), self.checkInterruptAndExit, \
+                                self.mPool.release, lambda: self.__flushStream(totalbytes), self.mGovernor)
+        pipeline.run()
+        _logger.info('streamed: downloaded {} decompressed {} written {}'.format(self.mResult['bytes_downloaded'], self.mResult['bytes_read'], self.mResult['bytes_written']))
+        # the decoder has to reach the end of the last xz stream, as listed by the index
+        index = self.mIOs[0].getXZIndex()
+        if totalbytes == 0 and index and not self.mIOs[0].getSparseImage() and \
+           self.mResult['bytes_read'] < index.getUncompressedSize():
+            raise IOError('Truncated image stream, decompressed {} of {} bytes'.format(self.mResult['bytes_read'], index.getUncompressedSize()))
+        return True
 
-    def __copyChunk(self, srcaddr, tgtaddr, numChunks, skip=False):
-        written = 0
-        # read src and write to the target
-        data = self.mIOs[0].Read(srcaddr, numChunks)
-        self.mResult['bytes_read'] += len(data)
-        if skip and self.mResult['bytes_written'] <= (self.mParam['src_start_sector'] * 512):
-            # skip writing 1st boot partition until the end, since urllib.request.urlopen()
-            # does not support seek to go back to beginning of file. we need to
-            # dump the data to a file using FileInputOutput
-            written = self.mIOs[2].Write(data, self.mResult['bytes_written'])
-            self.mPartWritten += written
-        else:
-            written = self.mIOs[1].Write(data, self.mResult['bytes_written'])
-            _logger.debug('read: @{} size:{}, written: @{} size:{}'.format(hex(srcaddr), len(data), hex(self.mResult['bytes_written']), written))
-        # write should return number of bytes written
-        if (written) > 0:
-            self.mResult['bytes_written'] += written
-        del data # hopefully this would clear the write data buffer
+    def __downloadStream(self, totalbytes, chunksize):
+        # download stage, until the end of stream or enough data decompressed
+        while totalbytes == 0 or self.mResult['bytes_read'] < totalbytes:
+            buf = self.mPool.acquire()
+            size = self.mIOs[0].ReadInto(0, buf[:chunksize])
+            if not size:
+                self.mPool.release(buf)
+                break
+            self.mResult['bytes_downloaded'] += size
+            yield buf[:size]
+
+    def __decodeStream(self, rawdata, totalbytes):
+        # decompress stage, drops data beyond totalbytes
+        for data in self.mIOs[0].DecompressBlocks(rawdata):
+            yield self.__clipStream(data, totalbytes)
+
+    def __flushStream(self, totalbytes):
+        # decompress stage, the decoded data held back at the end
+        return self.__clipStream(self.mIOs[0].FlushBlocks(), totalbytes)
+
+    def __clipStream(self, data, totalbytes):
+        # drops data beyond totalbytes
+        if isinstance(data, list):
+            if totalbytes > 0:
+                data = self._clipExtents(data, totalbytes)
+        elif totalbytes > 0 and self.mResult['bytes_read'] + len(data) > totalbytes:
+            data = data[:totalbytes - self.mResult['bytes_read']]
+        self.mResult['bytes_read'] += self._decodedSize(data)
+        return data
+
+    def __loadBlockMap(self, srcpath, dlhost, username, password):
+        # optional bmap file next to the image on the host
+        if not (self.mParam['use_bmap'] if ('use_bmap' in self.mParam) else True):
+            return None
+        for name in self._getBlockMapNames(srcpath):
+            try:
+                bmapio = WebInputOutput(0, name, host=dlhost, username=username, password=password, optional=True)
+                try:
+                    bmap = BlockMap(bmapio.Read(0, 0))
+                finally:
+                    bmapio._close()
+                _logger.info('{} bmap {}: {} of {} bytes mapped'.format(type(self).__name__, name, bmap.getMappedSize(), bmap.getImageSize()))
+                return bmap
+            except Exception as ex:
+                _logger.debug('{} no bmap {}: {}'.format(type(self).__name__, name, ex))
+        return None
+
+    def __loadHashFile(self, srcpath, dlhost, username, password):
+        # optional hash file next to the image on the host, of a whole image only
+        if 'src_total_sectors' in self.mParam and self.mParam['src_total_sectors'] > 0:
+            return None
+        for name in self._getHashNames(srcpath):
+            try:
+                hashio = WebInputOutput(0, name, host=dlhost, username=username, password=password, optional=True)
+                try:
+                    digest = self._parseHash(hashio.Read(0, 0))
+                finally:
+                    hashio._close()
+                _logger.info('{} hash {}: {}'.format(type(self).__name__, name, digest))
+                return digest
+            except Exception as ex:
+                _logger.debug('{} no hash {}: {}'.format(type(self).__name__, name, ex))
+        return None
 
-    def __ddChunk(self, wgetcmd, decompcmd, ddcmd):
-        def read_stream(fd):
+    def __loadDeltaMap(self, srcpath, dlhost, username, password):
+        """
+        returns the block map of the segments of the target to flash by the
+        manifest next to the image on the host, i.e. the ones not matching and
+        the held back 1st boot partition, or None to flash as a whole
+        """
+        if not (self.mParam['delta_flash'] if ('delta_flash' in self.mParam) else False) or \
+           ('src_total_sectors' in self.mParam and self.mParam['src_total_sectors'] > 0):
+            return None
+        for name in self._getManifestNames(srcpath):
             try:
-                # set non-blocking flag while preserving old flags
-                fl = fcntl.fcntl(fd, fcntl.F_GETFL)
-                fcntl.fcntl(fd, fcntl.F_SETFL, fl | os.O_NONBLOCK)
-                fd.seek(0)
-                line = fd.readlines()
-                if line is not None:
-                    lastline = '{}-{}'.format(line[-2].strip(), line[-1].strip())
-                    _logger.debug('last progress line: {}'.format(lastline))
-                    self.__parseProgress(self.__pddpid, lastline, '(.*)\+(.*) records in-(.*)\+(.*) records out')
+                manifestio = WebInputOutput(0, name, host=dlhost, username=username, password=password, optional=True)
+                try:
+                    manifest = SegmentManifest(manifestio.Read(0, 0))
+                finally:
+                    manifestio._close()
             except Exception as ex:
-                # waiting for data to be available on stderr
-                _logger.error('read_stream exception: {}'.format(ex))
-                return False
-            return True
+                _logger.debug('{} no manifest {}: {}'.format(type(self).__name__, name, ex))
+                continue
+            return self._planDelta(manifest, self.mParam['tgt_filename'], self.mParam['src_start_sector'] * 512)
+        return None
+
+    def __getImageSize(self):
+        # size of the whole image hashed, of the bmap or of the sparse image
+        if self.mIOs[0].getSparseImage():
+            return self.mIOs[0].getSparseImage().getImageSize()
+        if self.mBMap is not None:
+            return self.mBMap.getImageSize()
+        return 0
+
+    def __streamMapped(self, headsize, chunksize):
+        """
+        downloads, decodes, verifies and writes only the mapped ranges of the
+        bmap, with a xz block index the blocks without mapped data are not
+        downloaded at all
+        """
+        reader = self.__getMappedReader()
+        if reader is not None:
+            pieces = self.__readMappedBlocks(reader, chunksize)
+        else:
+            pieces = self.mBMap.split(self.__decodeMapped(chunksize))
+        pipeline = CopyPipeline(pieces, self.__verifyMapped, \
+                                lambda item: self.__writeStream(memoryview(item[1]), headsize, item[0]), \
+                                self.__getQueueDepth(), self.checkInterruptAndExit)
+        pipeline.run()
+        self._extendTarget(self.mIOs[1], self.mBMap.getImageSize())
+        _logger.info('mapped: downloaded {} decompressed {} written {}'.format(self.mResult['bytes_downloaded'], self.mResult['bytes_read'], self.mResult['bytes_written']))
+        return True
 
-        ret = False
-        timeout_counter = 0
-        last_written =  0
-        fd = open('/tmp/progress.log', 'w+')
-        _logger.info('ddChunk: {}, {}, {}'.format(wgetcmd, decompcmd, ddcmd))
-        pwget = subprocess.Popen(
-            [wgetcmd],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            shell=True,
-        )
-        pxz = subprocess.Popen(
-            [decompcmd],
-            stdin=pwget.stdout,
-            stdout=subprocess.PIPE,
-            shell=True,
-        )
-        pdd = subprocess.Popen(
-            [ddcmd],
-            stdin=pxz.stdout,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            shell=True,
-        )
-        fd.flush()
-        ptee = subprocess.Popen(
-            ['tee'],
-            stdin=pdd.stderr,
-            stdout=fd,
-            shell=True,
-        )
-        self.__pddpid = pdd.pid
+    def __getMappedReader(self):
+        # seekable reader, if it skips at least a quarter of the xz file
+        index = self.mIOs[0].getXZIndex()
+        if index is None:
+            return None
+        blocks = set()
+        for start, end, _ in self.mBMap.getRanges():
+            blocks.update(range(index.findBlock(start), index.findBlock(end - 1) + 1))
+        if sum(index.getBlocks()[num][2] for num in blocks) * 4 > self.mIOs[0].getFileSize() * 3:
+            return None
+        return self.mIOs[0].getSeekableReader()
+
+    def __readMappedBlocks(self, reader, chunksize):
+        # download stage of the mapped ranges only, yields (offset, data)
+        for offset, size in self.mBMap.pieces(chunksize):
+            reader.seek(offset)
+            yield offset, reader.read(size)
+        self.mResult['bytes_downloaded'] = reader.getBytesRead()
+
+    def __decodeMapped(self, chunksize):
+        # download and decompress stage of the whole image
         while True:
-            try:
-                out, err = ptee.communicate(timeout=1)
-                ret = True
+            rawdata = self.mIOs[0].ReadRaw(0, chunksize)
+            if not rawdata:
                 break
-            except subprocess.TimeoutExpired as ex:
-                self.__signal_subproc(pdd)
-                if self.checkInterruptAndExit():
-                    self.__kill_subproc([pwget, pxz, pdd, ptee])
-                    # Work around for failing to catch exception at _mainAction when flashing android images
-                    for ioobj in self.mIOs:
-                        ioobj._close()
-                    raise InterruptedError('User Interrupt to cancel dd chunk process')
-                elif timeout_counter > 180: # timed out after 3 minutes
-                    self.__kill_subproc([pwget, pxz, pdd, ptee])
-                    raise ex
-                else:
-                    _logger.info('last written:{} bytes_written: {} timeout_counter: {}'.format(last_written, self.mResult['bytes_written'], timeout_counter))
-                    if read_stream(fd) and last_written != self.mResult['bytes_written']:
-                        last_written = self.mResult['bytes_written']
-                        timeout_counter = 0
-                    else:
-                        timeout_counter += 1
-                    continue
-            except:
-                read_stream(fd)
-                fd.close()
-                raise BlockingIOError('Subprocess Popen failed')
-        read_stream(fd)
-        fd.close()
-
-        return ret
-
-    def __signal_subproc(self, proc):
-        proc.send_signal(signal.SIGUSR1)
-
-    def __kill_subproc(self, procs):
-        for proc in procs:
-            proc.kill()
+            self.mResult['bytes_downloaded'] += len(rawdata)
+            yield from self.mIOs[0].DecompressBlocks(rawdata)
+        yield self.mIOs[0].FlushBlocks()
+
+    def __verifyMapped(self, item):
+        # verify stage, against the range checksums of the bmap
+        self.mBMap.verify(item[0], item[1])
+        self.mResult['bytes_read'] += len(item[1])
+        return item
+
+    def __writeData(self, data, headsize):
+        # write stage, of the decoded data or of the extents of a sparse image
+        if isinstance(data, list):
+            # no checkpoints, as the bytes written are not the target offset
+            self.mBlocks = []
+            self.__writeExtents(data, headsize)
+        else:
+            self.__writeStream(memoryview(data), headsize)
+
+    def __writeExtents(self, extents, headsize):
+        # write stage of the extents of an android sparse image
+        for kind, offset, length, data in extents:
+            if kind == SparseImageFile.CHUNK_RAW:
+                self.__writeStream(memoryview(data), headsize, offset)
+            elif kind == SparseImageFile.CHUNK_FILL:
+                if offset < headsize:
+                    # the held back 1st boot partition gets the fill as data
+                    size = min(length, headsize - offset)
+                    self.__writeStream(memoryview(bytes(data) * (size // len(data))), headsize, offset)
+                    offset += size
+                    length -= size
+                if length > 0:
+                    self._hashData([(kind, offset, length, data)])
+                    self.mResult['bytes_written'] += self.mIOs[1].Fill(offset, length, data)
+
+    def __writeStream(self, view, headsize, offset=None):
+        # write stage, at the exact byte offset of the target
+        if offset is None:
+            offset = self.mResult['bytes_written']
+        self._hashData(view, offset)
+        written = 0
+        if offset < headsize:
+            # hold back the 1st boot partition in /tmp/p1.img, and write it
+            # to the target at the end, i.e. in _postAction()
+            written = self.mIOs[2].Write(view[:headsize - offset], offset)
+            self.mPartWritten = max(self.mPartWritten, offset + written)
+        if len(view) > written:
+            written += self.mIOs[1].Write(view[written:], offset + written)
+        if written != len(view):
+            raise IOError('Failed to write {} bytes at {}'.format(len(view), offset))
+        self.mResult['bytes_written'] += written
+        self.__saveCheckpoint()
+
+    def __getCheckpointFile(self):
+        return self.mParam['resume_file'] if ('resume_file' in self.mParam) else '/tmp/download.resume'
+
+    def __getJobIdentity(self):
+        # identifies the same image download to the same target, on any host
+        return {'src_filename': self.mParam['src_filename'], 'file_size': self.mIOs[0].getFileSize(), \
+                'num_blocks': len(self.mBlocks), 'tgt_filename': self.mParam['tgt_filename'], \
+                'src_start_sector': self.mParam['src_start_sector'], \
+                'src_total_sectors': self.mParam['src_total_sectors'] if ('src_total_sectors' in self.mParam) else -1}
+
+    def __loadCheckpoint(self):
+        """
+        returns the checkpoint of a previous failed download of the same job,
+        or None, i.e. start over from the beginning
+        """
+        checkpoint = None
+        if len(self.mBlocks) > 1 and os.path.isfile(self.__getCheckpointFile()):
+            try:
+                with open(self.__getCheckpointFile(), 'r') as f:
+                    checkpoint = json.load(f)
+                if checkpoint['job'] != self.__getJobIdentity() or \
+                   not (0 < checkpoint['block'] < len(self.mBlocks)) or \
+                   (self.mParam['src_start_sector'] > 0 and not os.path.isfile('/tmp/p1.img')):
+                    checkpoint = None
+            except (OSError, ValueError, KeyError, TypeError) as ex:
+                _logger.warning('{} cannot load checkpoint: {}'.format(type(self).__name__, ex))
+                checkpoint = None
+            if checkpoint is None:
+                self.__removeCheckpoint()
+        _logger.info('{} resume checkpoint: {}'.format(type(self).__name__, checkpoint))
+        return checkpoint
+
+    def __saveCheckpoint(self):
+        """
+        records the last xz block boundary written to the target, about every
+        sync_size MiB, so a failed download can be resumed from that block
+        """
+        if len(self.mBlocks) < 2:
+            return
+        block = self.mBlock
+        while block + 1 < len(self.mBlocks) and self.mBlocks[block + 1][1] <= self.mResult['bytes_written']:
+            block += 1
+        interval = (self.mParam['sync_size'] if ('sync_size' in self.mParam and self.mParam['sync_size'] > 0) else 32) * 1048576
+        if self.mBlocks[block][1] - self.mBlocks[self.mBlock][1] >= interval:
+            # everything before the block boundary has to be on disk first
+            for ioobj in self.mIOs[1:]:
+                ioobj.Sync(True)
+            checkpoint = {'job': self.__getJobIdentity(), 'block': block, \
+                          'compressed_offset': self.mBlocks[block][0], 'uncompressed_offset': self.mBlocks[block][1]}
+            tmpfile = self.__getCheckpointFile() + '.tmp'
+            try:
+                with open(tmpfile, 'w') as f:
+                    json.dump(checkpoint, f)
+                    f.flush()
+                    os.fsync(f)
+                os.replace(tmpfile, self.__getCheckpointFile())
+            except OSError as ex:
+                # the download carries on, but cannot be resumed from this block
+                _logger.warning('{} cannot save checkpoint: {}'.format(type(self).__name__, ex))
+            self.mBlock = block
+            _logger.debug('{} checkpoint: {}'.format(type(self).__name__, checkpoint))
+
+    def __removeCheckpoint(self):
+        if os.path.isfile(self.__getCheckpointFile()):
+            os.remove(self.__getCheckpointFile())
+
+    def __resumeDownload(self):
+        """
+        continues the download from the checkpointed xz block with a byte range
+        request, the decompressor is primed with the stream header, and the
+        range stops before the xz index, which does not match partial streams
+        """
+        self.mBlock = self.mResume['block']
+        coffset, uoffset = self.mBlocks[self.mBlock][:2]
+        stream = self.mIOs[0].getXZIndex().getStreams()[self.mBlocks[self.mBlock][4]]
+        if not self.mIOs[0].setDecodeThreads(self._getDecodeThreads(self.mIOs[0]), coffset, self._getDecodeBudget()):
+            self.mIOs[0].Decompress(stream['header'])
+        self.mIOs[0].openRange(coffset, stream['index_offset'])
+        self.mResult['bytes_downloaded'] = coffset
+        self.mResult['bytes_read'] = uoffset
+        self.mResult['bytes_written'] = uoffset
+        self.mPartWritten = min(self.mParam['src_start_sector'] * 512, uoffset)
+        _logger.info('{} resume download from {} to target {}'.format(type(self).__name__, coffset, uoffset))
 
 
 
@@ -1089,7 +2278,8 @@ class QueryWebFileActionModeller(BaseActionModeller):
         # setup the web input output
         ret = False
         try:
-            webIO = WebInputOutput(0, self.mSrcPath, host=self.mWebHost, username=self.mUsername, password=self.mPassword)
+            # header only request, the web page content is downloaded on Read()
+            webIO = WebInputOutput(0, self.mSrcPath, mode='hd', host=self.mWebHost, username=self.mUsername, password=self.mPassword)
             if webIO:
                 _logger.debug('{} Host: {} Path: {} File Type: {}'.format(type(self).__name__, self.mWebHost, self.mSrcPath, webIO.getFileType()))
                 if 'html' in webIO.getFileType():
@@ -1570,23 +2760,31 @@ class DriverActionModeller(BaseActionModeller):
 
 
 class CheckBlockActionModeller(BaseActionModeller):
+    # read back hashed in flight per thread at most, of a compressed source
+    SEGMENTS_INFLIGHT = 2
+
     def __init__(self):
         super().__init__()
         self.mIOs = []
+        self.mSegmented = False
 
     def _preAction(self):
         # setup the input/output objects
         # chunk_size in bytes default 1MB, i.e. 1048576
         if 'chunk_size' not in self.mParam or int(self.mParam['chunk_size']) < 0:
             self.mParam['chunk_size'] = 1048576 # 1MB
+        # md5 of the whole range, or hashes of the segments of a manifest
+        self.mSegmented = (self.mParam['verify_mode'] if ('verify_mode' in self.mParam) else 'md5') == 'segments'
 
+        # regular files are hashed by memoryview slices of mmap
+        usemmap = self.mParam['use_mmap'] if ('use_mmap' in self.mParam) else True
         if all(s in self.mParam for s in ['src_filename', 'tgt_filename']):
             if 'http://' in self.mParam['src_filename']:
                 o = urlparse(self.mParam['src_filename'])
                 self.mIOs.append(WebInputOutput(0, o.path))
             elif stat.S_ISBLK(os.stat(self.mParam['src_filename']).st_mode) or \
                 stat.S_ISREG(os.stat(self.mParam['src_filename']).st_mode):
-                self.mIOs.append(BlockInputOutput(self.mParam['chunk_size'], self.mParam['src_filename'], 'rb'))
+                self.mIOs.append(BlockInputOutput(self.mParam['chunk_size'], self.mParam['src_filename'], 'rb', use_mmap=usemmap))
             elif stat.S_ISCHR(os.stat(self.mParam['src_filename']).st_mode):
                 _logger.error("cannot checksum on char device")
 
@@ -1595,7 +2793,12 @@ class CheckBlockActionModeller(BaseActionModeller):
                 self.mIOs.append(WebInputOutput(0, o.path))
             elif stat.S_ISBLK(os.stat(self.mParam['tgt_filename']).st_mode) or \
                 stat.S_ISREG(os.stat(self.mParam['tgt_filename']).st_mode):
-                self.mIOs.append(BlockInputOutput(self.mParam['chunk_size'], self.mParam['tgt_filename'], 'rb'))
+                # target read by O_DIRECT is hashed from the storage, not the page
+                # cache, by default of the segments verification
+                directio = self.mParam['direct_io'] if ('direct_io' in self.mParam) else self.mSegmented
+                self.mIOs.append(BlockInputOutput(self.mParam['chunk_size'], self.mParam['tgt_filename'], 'rb', use_mmap=usemmap and not directio))
+                if directio:
+                    self.mIOs[-1].setDirectIO(True)
             elif stat.S_ISCHR(os.stat(self.mParam['tgt_filename']).st_mode):
                 _logger.error("cannot checksum on char device")
         else:
@@ -1606,6 +2809,15 @@ class CheckBlockActionModeller(BaseActionModeller):
         return False
 
     def _mainAction(self):
+        if self.mSegmented:
+            try:
+                return self.__checkSegments()
+            finally:
+                # close the block device again
+                for ioobj in self.mIOs:
+                    _logger.warn('close mIO: {} mHandle: {}'.format(ioobj, ioobj.mHandle))
+                    ioobj._close()
+                del self.mIOs
         # copy specified address range from src file to target file
         ret = False
         for ioobj in self.mIOs:
@@ -1643,9 +2855,40 @@ class CheckBlockActionModeller(BaseActionModeller):
                         startaddr = 0
 
                 totalchunks = -(-totalsize // chunksize)
+                # xz file from a start address decodes from the block holding it,
+                # i.e. hashes the uncompressed data from startaddr
+                reader = ioobj.getSeekableReader() if (startaddr > 0) else None
+                if reader is not None:
+                    if not ('total_sectors' in self.mParam and int(self.mParam['total_sectors']) > 0):
+                        totalsize = max(reader.seek(0, 2) - startaddr, 0)
+                    reader.seek(startaddr)
+                    totalchunks = 0
+                    while totalsize > 0:
+                        data = reader.read(min(chunksize, totalsize))
+                        if not data:
+                            break
+                        totalsize -= len(data)
+                        self.mResult['bytes_read'] += len(data)
+                        hasher.update(data)
+                if ioobj.mCFHandle is not None and totalchunks > 0:
+                    # compressed file decodes into bounded blocks
+                    ioobj.setDecodeBlockSize(chunksize)
+                    rawchunks = (ioobj.ReadRaw(startaddr + (addr * chunksize), chunksize) for addr in range(0, totalchunks))
+                    for data in self._decodeBlocks(ioobj, rawchunks):
+                        self.mResult['bytes_read'] += len(data)
+                        hasher.update(data)
+                    totalchunks = 0
+                # reuse one buffer pool slot for uncompressed, not memory mapped files
+                pool = None
+                if ioobj.mCFHandle is None and not ioobj.mUseMmap and totalchunks > 0:
+                    pool = BufferPool(chunksize, 1)
+                    buf = pool.acquire()
                 # loop through the range of sectors and read from Block IO
                 for addr in range (0, totalchunks):
-                    data = ioobj.Read(startaddr + (addr * chunksize), 1)
+                    if pool is not None:
+                        data = buf[:ioobj.ReadInto(startaddr + (addr * chunksize), buf)]
+                    else:
+                        data = ioobj.Read(startaddr + (addr * chunksize), 1)
                     #_logger.debug('ioobj:{} addr:{:#x} data len:{}'.format(ioobj.mFilename, startaddr + (addr * chunksize), len(data)))
                     self.mResult['bytes_read'] += len(data)
                     hasher.update(data)
@@ -1660,6 +2903,98 @@ class CheckBlockActionModeller(BaseActionModeller):
         del self.mIOs
         return ret
 
+    def __checkSegments(self):
+        """
+        segmented read back verification, the target is hashed by segments on
+        a pool of threads, as hashlib releases the GIL, and the root of their
+        hash tree is compared with the manifest of the source, i.e. published
+        next to the image, or made of the source image hashed the same way.
+        The ranges of the segments not matching are the ones to flash again
+        """
+        if len(self.mIOs) != 2:
+            raise ValueError('mainAction: segments verification of src and tgt files only')
+        srcio, tgtio = self.mIOs
+        threads = self._getHashThreads()
+        self.mResult['bytes_read'] = 0
+        with concurrent.futures.ThreadPoolExecutor(max_workers=threads, thread_name_prefix='SegHash') as executor:
+            manifest = self.__loadManifest(srcio)
+            if manifest is None:
+                manifest = self.__hashSource(srcio, executor, threads)
+                if 'manifest_out' in self.mParam and self.mParam['manifest_out']:
+                    with open(self.mParam['manifest_out'], 'w') as f:
+                        f.write(manifest.dumps())
+            start = self.mParam['tgt_start_sector'] * 512 if ('tgt_start_sector' in self.mParam and self.mParam['tgt_start_sector'] > 0) else 0
+            hashes = self._hashSegments(tgtio, start, manifest.getAlgo(), list(manifest.segments()), executor, threads)
+        if len(hashes) < manifest.getNumSegments():
+            # interrupted
+            return False
+        root = SegmentManifest.hashTree(manifest.getAlgo(), hashes)
+        ranges = manifest.compare(hashes)
+        self.mResult.update({srcio.mFilename[srcio.mFilename.rfind('/') + 1:]: manifest.getRoot(), tgtio.mFilename: root})
+        self.mResult['segment_size'] = manifest.getSegmentSize()
+        self.mResult['total_segments'] = manifest.getNumSegments()
+        self.mResult['segment_match'] = (root == manifest.getRoot())
+        self.mResult['mismatch_bytes'] = sum(end - begin for begin, end in ranges)
+        # image byte ranges, in the form of the bmap ranges
+        self.mResult['mismatch_ranges'] = ' '.join('{}-{}'.format(begin, end) for begin, end in ranges)
+        _logger.info('{} segments {} of {}: {} mismatch {}'.format(type(self).__name__, manifest.getAlgo(), tgtio.mFilename, root, self.mResult['mismatch_ranges']))
+        return True
+
+    def __loadManifest(self, srcio):
+        # segment manifest on the web, or a local .segments file
+        if isinstance(srcio, WebInputOutput):
+            return SegmentManifest(srcio.Read(0, 0))
+        if srcio.mFilename.endswith(SegmentManifest.SUFFIX):
+            with open(srcio.mFilename, 'rb') as f:
+                return SegmentManifest(f.read())
+        return None
+
+    def __hashSource(self, srcio, executor, threads):
+        """
+        returns the manifest of the source image, an uncompressed source is
+        read by segments in parallel from src_start_sector, a compressed one
+        is decoded in order from its start and its segments hashed in parallel
+        """
+        algo = self.mParam['segment_hash'] if ('segment_hash' in self.mParam) else 'sha256'
+        segsize = self.mParam['segment_size'] if ('segment_size' in self.mParam and self.mParam['segment_size'] > 0) else SegmentManifest.SEGMENT_SIZE
+        limit = int(self.mParam['total_sectors']) * 512 if ('total_sectors' in self.mParam and int(self.mParam['total_sectors']) > 0) else -1
+        if srcio.mCFHandle is None:
+            start = self.mParam['src_start_sector'] * 512 if ('src_start_sector' in self.mParam and self.mParam['src_start_sector'] > 0) else 0
+            imagesize = max(srcio.getFileSize() - start, 0)
+            imagesize = min(imagesize, limit) if limit >= 0 else imagesize
+            segments = [(offset, min(segsize, imagesize - offset)) for offset in range(0, imagesize, segsize)]
+            hashes = self._hashSegments(srcio, start, algo, segments, executor, threads)
+            return SegmentManifest(algo=algo, segsize=segsize, imagesize=imagesize, hashes=hashes)
+        srcio.setDecodeBlockSize(segsize)
+        chunksize = int(self.mParam['chunk_size'])
+        rawchunks = (srcio.ReadRaw(addr, chunksize) for addr in range(0, srcio.getFileSize(), chunksize))
+        futures = []
+        imagesize = 0
+        segment = bytearray()
+        for data in self._decodeBlocks(srcio, rawchunks):
+            if limit >= 0:
+                data = data[:max(limit - imagesize - len(segment), 0)]
+            segment += data
+            while len(segment) >= segsize:
+                futures.append(executor.submit(self.__hashData, algo, bytes(segment[:segsize])))
+                imagesize += min(len(segment), segsize)
+                del segment[:segsize]
+                # waits on the oldest segments rather than decoding any further
+                if len(futures) > threads * self.SEGMENTS_INFLIGHT:
+                    futures[-threads * self.SEGMENTS_INFLIGHT - 1].result()
+            if self.checkInterruptAndExit():
+                break
+        if segment:
+            futures.append(executor.submit(self.__hashData, algo, bytes(segment)))
+            imagesize += len(segment)
+        self.mResult['bytes_read'] += imagesize
+        return SegmentManifest(algo=algo, segsize=segsize, imagesize=imagesize, hashes=[future.result() for future in futures])
+
+    @staticmethod
+    def __hashData(algo, data):
+        # worker, hashes one decoded segment
+        return hashlib.new(algo, data).hexdigest()
+
 
 
 class QRCodeActionModeller(BaseActionModeller):
@@ -65,6 +65,7 @@ from threading import Thread
 from defconfig import DefConfig, SetupLogging, IsATargetBoard
 from ophandle import ReadWriteOperationHandler, \
                      FlashOperationHandler, \
+                     EraseOperationHandler, \
                      InfoOperationHandler, \
                      DownloadOperationHandler, \
                      ConfigOperationHandler, \
@@ -179,6 +180,7 @@ class OpController(object):
         # setup Operation Handlers from the defconfig
         self.mOpHandlers.append(ReadWriteOperationHandler(self.__sendUserRequest))
         self.mOpHandlers.append(FlashOperationHandler(self.__sendUserRequest))
+        self.mOpHandlers.append(EraseOperationHandler(self.__sendUserRequest))
         self.mOpHandlers.append(InfoOperationHandler(self.__sendUserRequest))
         self.mOpHandlers.append(DownloadOperationHandler(self.__sendUserRequest))
         self.mOpHandlers.append(ConfigOperationHandler(self.__sendUserRequest))
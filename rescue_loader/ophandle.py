@@ -52,6 +52,7 @@ import urllib.parse
 from defconfig import DefConfig
 from threading import Thread, Event, RLock
 from model import CopyBlockActionModeller, \
+                  EraseBlockActionModeller, \
                   QueryMemActionModeller, \
                   QueryFileActionModeller, \
                   QueryUDevActionModeller, \
@@ -308,6 +309,74 @@ class FlashOperationHandler(BaseOperationHandler):
                     self.mActionParam['chunk_size'] = int(OpParams['chunk_size'])
                 else:
                     self.mActionParam['chunk_size'] = -1
+                if 'queue_depth' in OpParams:
+                    self.mActionParam['queue_depth'] = int(OpParams['queue_depth'])
+                if 'decode_threads' in OpParams:
+                    self.mActionParam['decode_threads'] = int(OpParams['decode_threads'])
+                if 'sync_policy' in OpParams:
+                    self.mActionParam['sync_policy'] = '{}'.format(OpParams['sync_policy'])
+                if 'sparse_mode' in OpParams:
+                    self.mActionParam['sparse_mode'] = '{}'.format(OpParams['sparse_mode'])
+                if 'write_combine' in OpParams:
+                    self.mActionParam['write_combine'] = int(OpParams['write_combine'])
+                if 'direct_io' in OpParams:
+                    self.mActionParam['direct_io'] = '{}'.format(OpParams['direct_io']).lower() in ['1', 'true', 'yes', 'on']
+                if 'bmap' in OpParams:
+                    self.mActionParam['use_bmap'] = ('{}'.format(OpParams['bmap']) != 'off')
+                if 'stream_hash' in OpParams:
+                    self.mActionParam['stream_hash'] = '{}'.format(OpParams['stream_hash']).lower()
+                if 'delta' in OpParams:
+                    self.mActionParam['delta_flash'] = '{}'.format(OpParams['delta']).lower() in ['1', 'true', 'yes', 'on']
+                if 'manifest_file' in OpParams and len(OpParams['manifest_file']) > 0:
+                    self.mActionParam['manifest_file'] = '{}'.format(OpParams['manifest_file'])
+                if 'sync_size' in OpParams:
+                    self.mActionParam['sync_size'] = int(OpParams['sync_size'])
+                _logger.debug('{}: __parseParam: mActionParam:{}'.format(type(self).__name__, self.mActionParam))
+                return True
+        else:
+            return False
+
+
+
+class EraseOperationHandler(BaseOperationHandler):
+    def __init__(self, UserRequestCB):
+        super().__init__(UserRequestCB)
+        self.mArgs = ['tgt_filename']
+
+    def isOpSupported(self, OpParams):
+        # Check if cmd is supported
+        if isinstance(OpParams, dict) and 'cmd' in OpParams:
+            if OpParams['cmd'] == 'erase':
+                return True
+        return False
+
+    def _setupActions(self):
+        # setup "erase" cmd operations
+        if self.mActionParam:
+            self.mActionModellers.append(EraseBlockActionModeller())
+            self.mActionModellers[-1].setActionParam(self.mActionParam)
+            return True
+        return False
+
+    def _parseParam(self, OpParams):
+        _logger.debug('{}: __parseParam: OpParams: {}'.format(self, OpParams))
+        # Parse the OpParams and Setup mActionParams
+        if isinstance(OpParams, dict):
+            if all(s in OpParams for s in self.mArgs):
+                # check for erasing the range of the target file
+                self.mActionParam['tgt_filename'] = str(OpParams['tgt_filename'])
+                if 'tgt_start_sector' in OpParams:
+                    self.mActionParam['tgt_start_sector'] = int(OpParams['tgt_start_sector'])
+                else:
+                    self.mActionParam['tgt_start_sector'] = 0
+                if 'total_sectors' in OpParams:
+                    self.mActionParam['total_sectors'] = int(OpParams['total_sectors'])
+                else:
+                    self.mActionParam['total_sectors'] = -1
+                if 'chunk_size' in OpParams:
+                    self.mActionParam['chunk_size'] = int(OpParams['chunk_size'])
+                if 'erase_mode' in OpParams:
+                    self.mActionParam['erase_mode'] = '{}'.format(OpParams['erase_mode'])
                 _logger.debug('{}: __parseParam: mActionParam:{}'.format(type(self).__name__, self.mActionParam))
                 return True
         else:
@@ -543,15 +612,38 @@ class DownloadOperationHandler(BaseOperationHandler):
                 self.mActionParam['src_total_sectors'] = -1 # default to the whole src file size
             if 'chunk_size' in OpParams:
                 self.mActionParam['chunk_size'] = int(OpParams['chunk_size'])
+            if 'queue_depth' in OpParams:
+                self.mActionParam['queue_depth'] = int(OpParams['queue_depth'])
+            if 'dl_connections' in OpParams:
+                self.mActionParam['dl_connections'] = int(OpParams['dl_connections'])
+            if 'decode_threads' in OpParams:
+                self.mActionParam['decode_threads'] = int(OpParams['decode_threads'])
+            if 'sync_policy' in OpParams:
+                self.mActionParam['sync_policy'] = '{}'.format(OpParams['sync_policy'])
+            if 'sparse_mode' in OpParams:
+                self.mActionParam['sparse_mode'] = '{}'.format(OpParams['sparse_mode'])
+            if 'write_combine' in OpParams:
+                self.mActionParam['write_combine'] = int(OpParams['write_combine'])
+            if 'direct_io' in OpParams:
+                self.mActionParam['direct_io'] = '{}'.format(OpParams['direct_io']).lower() in ['1', 'true', 'yes', 'on']
+            if 'bmap' in OpParams:
+                self.mActionParam['use_bmap'] = ('{}'.format(OpParams['bmap']) != 'off')
+            if 'stream_hash' in OpParams:
+                self.mActionParam['stream_hash'] = '{}'.format(OpParams['stream_hash']).lower()
+            if 'delta' in OpParams:
+                self.mActionParam['delta_flash'] = '{}'.format(OpParams['delta']).lower() in ['1', 'true', 'yes', 'on']
+            if 'manifest_file' in OpParams and len(OpParams['manifest_file']) > 0:
+                self.mActionParam['manifest_file'] = '{}'.format(OpParams['manifest_file'])
+            if 'sync_size' in OpParams:
+                self.mActionParam['sync_size'] = int(OpParams['sync_size'])
             if 'dl_username' in OpParams and len(OpParams['dl_username']) > 0:
                 self.mActionParam['host_username'] = '{}'.format(OpParams['dl_username'])
             if 'dl_password' in OpParams and len(OpParams['dl_password']) > 0:
                 self.mActionParam['host_password'] = '{}'.format(OpParams['dl_password'])
-            # use dd cmd when free mem > 200
-            if 'mem_free' in OpParams and int(OpParams['mem_free']) < (700 * 1024 * 1024):
-                self.mActionParam['use_dd'] = True
-            else:
-                self.mActionParam['use_dd'] = True
+            # the memory governor of the download picks the streaming (dd) or
+            # chunked engine from the available memory, unless use_dd is given
+            if 'use_dd' in OpParams:
+                self.mActionParam['use_dd'] = '{}'.format(OpParams['use_dd']).lower() in ['1', 'true', 'yes', 'on']
 
             if all(s in OpParams for s in self.mArgs):
                 # check for download from web and flash to target file
@@ -728,6 +820,18 @@ class CheckOperationHandler(BaseOperationHandler):
                     self.mActionParam['tgt_start_sector'] = int(OpParams['tgt_start_sector'])
                 if 'total_sectors' in OpParams:
                     self.mActionParam['total_sectors'] = int(OpParams['total_sectors'])
+                if 'direct_io' in OpParams and '{}'.format(OpParams['direct_io']).lower() != 'auto':
+                    self.mActionParam['direct_io'] = '{}'.format(OpParams['direct_io']).lower() in ['1', 'true', 'yes', 'on']
+                if 'verify_mode' in OpParams:
+                    self.mActionParam['verify_mode'] = '{}'.format(OpParams['verify_mode']).lower()
+                if 'segment_size' in OpParams:
+                    self.mActionParam['segment_size'] = int(OpParams['segment_size'])
+                if 'segment_hash' in OpParams:
+                    self.mActionParam['segment_hash'] = '{}'.format(OpParams['segment_hash']).lower()
+                if 'hash_threads' in OpParams:
+                    self.mActionParam['hash_threads'] = int(OpParams['hash_threads'])
+                if 'manifest_out' in OpParams and len(OpParams['manifest_out']) > 0:
+                    self.mActionParam['manifest_out'] = '{}'.format(OpParams['manifest_out'])
                 _logger.debug('{}: __parseParam: mActionParam:{}'.format(type(self).__name__, self.mActionParam))
                 return True
         else:
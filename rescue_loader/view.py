@@ -468,6 +468,63 @@ if __name__ == "__main__":
     flash_parser.add_argument('-c', '--chunk-size', dest='chunk_size', \
                               action='store', default='-1', \
                               help='Specify the chunk size (sector size) in bytes to copy')
+    flash_parser.add_argument('-q', '--queue-depth', dest='queue_depth', \
+                              action='store', default='4', \
+                              help='Specify the number of chunks queued between read, decompress and write stages, 0 to run them serially')
+    flash_parser.add_argument('-x', '--decode-threads', dest='decode_threads', \
+                              action='store', default='0', \
+                              help='Specify the number of threads decoding the blocks of a xz image, 0 for all the cpu cores')
+    flash_parser.add_argument('-w', '--sync-policy', dest='sync_policy', \
+                              choices=('chunk', 'size', 'checkpoint', 'close'), \
+                              action='store', default='size', \
+                              help='Specify when written data are synced to the target storage media')
+    flash_parser.add_argument('-z', '--sync-size', dest='sync_size', \
+                              action='store', default='32', \
+                              help='Specify the size in MiB written between syncs, for the size sync policy')
+    flash_parser.add_argument('-k', '--sparse-mode', dest='sparse_mode', \
+                              choices=('off', 'zeroout', 'discard', 'skip'), \
+                              action='store', default='off', \
+                              help='Specify how all-zero blocks are written, zeroed/discarded as ranges, or skipped on an erased target; discard punches holes in files, but zeroes block devices, as a discarded eMMC/SD range may read back stale data')
+    flash_parser.add_argument('-g', '--write-combine', dest='write_combine', \
+                              action='store', default='4', \
+                              help='Specify the size in MiB of adjacent writes combined into one vectored write, 0 to write every chunk at once')
+    flash_parser.add_argument('-r', '--direct-io', dest='direct_io', \
+                              choices=('on', 'off'), \
+                              action='store', default='off', \
+                              help='Specify whether the target is written with O_DIRECT, bypassing the page cache')
+    flash_parser.add_argument('-a', '--bmap', dest='bmap', \
+                              choices=('auto', 'off'), \
+                              action='store', default='auto', \
+                              help='Specify whether only the ranges mapped by the .bmap file next to the source are written')
+    flash_parser.add_argument('-i', '--stream-hash', dest='stream_hash', \
+                              choices=('off', 'md5', 'sha256', 'blake2b'), \
+                              action='store', default='off', \
+                              help='Specify the hash of the image computed as it is written, checked against the .<hash>.txt file next to the source')
+    flash_parser.add_argument('-l', '--delta', dest='delta', \
+                              choices=('on', 'off'), \
+                              action='store', default='off', \
+                              help='Specify whether only the segments of the target not matching the .segments manifest next to the source are written')
+    ############################################################################
+    # erase commands
+    # 'tgt_filename', tgt_start_sector, total_sectors, erase_mode
+    ############################################################################
+    erase_parser = subparsers.add_parser('erase', help='erase local storage media or file')
+    erase_parser.add_argument('-t', '--target-filename', dest='tgt_filename', \
+                              action='store', metavar='FILENAME', \
+                              help='Specify target storage media')
+    erase_parser.add_argument('-b', '--target-start-sector', dest='tgt_start_sector', \
+                              action='store', default='0', \
+                              help='Specify starting locations on the target storage media')
+    erase_parser.add_argument('-n', '--total-sectors', dest='total_sectors', \
+                              action='store', default='-1', \
+                              help='Specify total number of sectors (512 bytes/sector) to erase')
+    erase_parser.add_argument('-c', '--chunk-size', dest='chunk_size', \
+                              action='store', default='-1', \
+                              help='Specify the size in bytes erased between progress updates')
+    erase_parser.add_argument('-m', '--erase-mode', dest='erase_mode', \
+                              choices=('zeroout', 'discard'), \
+                              action='store', default='zeroout', \
+                              help='Specify whether the range is zeroed, or discarded (hole punched in a file); a discarded block device range may read back stale data instead of zeros')
     ############################################################################
     # qrcode commands
     # 'dl_url', 'tgt_filename', receiver, lvl, mode
@@ -566,6 +623,27 @@ if __name__ == "__main__":
     check_parser.add_argument('-c', '--chunk-size', dest='chunk_size', \
                               action='store', default='-1', \
                               help='Specify the chunk size (sector size) in bytes to check')
+    check_parser.add_argument('-r', '--direct-io', dest='direct_io', \
+                              choices=('auto', 'on', 'off'), \
+                              action='store', default='auto', \
+                              help='Specify whether the target is read with O_DIRECT, bypassing the page cache, auto for the segments verification only')
+    check_parser.add_argument('-m', '--verify-mode', dest='verify_mode', \
+                              choices=('md5', 'segments'), \
+                              action='store', default='md5', \
+                              help='Specify the md5 of the whole range, or the hashes of the segments of a .segments manifest given as the source')
+    check_parser.add_argument('-z', '--segment-size', dest='segment_size', \
+                              action='store', default='4194304', \
+                              help='Specify the segment size in bytes, of a source image hashed by segments')
+    check_parser.add_argument('-a', '--segment-hash', dest='segment_hash', \
+                              choices=('md5', 'sha1', 'sha256', 'blake2b'), \
+                              action='store', default='sha256', \
+                              help='Specify the hash of the segments, of a source image hashed by segments')
+    check_parser.add_argument('-j', '--hash-threads', dest='hash_threads', \
+                              action='store', default='0', \
+                              help='Specify the number of threads hashing the segments, 0 for all the cpu cores')
+    check_parser.add_argument('-o', '--manifest-out', dest='manifest_out', \
+                              action='store', default='', metavar='FILENAME', \
+                              help='Specify the .segments manifest to write, of a source image hashed by segments')
 
     ############################################################################
     # connect commands
@@ -657,6 +735,45 @@ if __name__ == "__main__":
     dl_parser.add_argument('-c', '--chunk-size', dest='chunk_size', type=str, \
                            action='store', default='65536', \
                            help='Specify the block size to read/write per I/O')
+    dl_parser.add_argument('-q', '--queue-depth', dest='queue_depth', type=str, \
+                           action='store', default='4', \
+                           help='Specify the number of chunks queued between download, decompress and write stages, 0 to run them serially')
+    dl_parser.add_argument('-j', '--connections', dest='dl_connections', type=str, \
+                           action='store', default='4', \
+                           help='Specify the number of parallel connections to download byte ranges, if the host supports it')
+    dl_parser.add_argument('-x', '--decode-threads', dest='decode_threads', type=str, \
+                           action='store', default='0', \
+                           help='Specify the number of threads decoding the blocks of a xz image, 0 for all the cpu cores')
+    dl_parser.add_argument('-w', '--sync-policy', dest='sync_policy', type=str, \
+                           choices=('chunk', 'size', 'checkpoint', 'close'), \
+                           action='store', default='size', \
+                           help='Specify when written data are synced to the target storage media')
+    dl_parser.add_argument('-z', '--sync-size', dest='sync_size', type=str, \
+                           action='store', default='32', \
+                           help='Specify the size in MiB written between syncs, for the size sync policy')
+    dl_parser.add_argument('-k', '--sparse-mode', dest='sparse_mode', type=str, \
+                           choices=('off', 'zeroout', 'discard', 'skip'), \
+                           action='store', default='off', \
+                           help='Specify how all-zero blocks are written, zeroed/discarded as ranges, or skipped on an erased target; discard punches holes in files, but zeroes block devices, as a discarded eMMC/SD range may read back stale data')
+    dl_parser.add_argument('-g', '--write-combine', dest='write_combine', type=str, \
+                           action='store', default='4', \
+                           help='Specify the size in MiB of adjacent writes combined into one vectored write, 0 to write every chunk at once')
+    dl_parser.add_argument('-r', '--direct-io', dest='direct_io', type=str, \
+                           choices=('on', 'off'), \
+                           action='store', default='off', \
+                           help='Specify whether the target is written with O_DIRECT, bypassing the page cache')
+    dl_parser.add_argument('-a', '--bmap', dest='bmap', type=str, \
+                           choices=('auto', 'off'), \
+                           action='store', default='auto', \
+                           help='Specify whether only the ranges mapped by the .bmap file next to the image are downloaded and written')
+    dl_parser.add_argument('-i', '--stream-hash', dest='stream_hash', type=str, \
+                           choices=('off', 'md5', 'sha256', 'blake2b'), \
+                           action='store', default='md5', \
+                           help='Specify the hash of the image computed as it is written, checked against the .<hash>.txt file next to the image')
+    dl_parser.add_argument('-l', '--delta', dest='delta', type=str, \
+                           choices=('on', 'off'), \
+                           action='store', default='off', \
+                           help='Specify whether only the segments of the target not matching the .segments manifest next to the image are downloaded and written')
     dl_parser.add_argument('-u', '--url', dest='dl_url', default=argparse.SUPPRESS, \
                            action='store', metavar='DOWNLOAD_URL', \
                            help='Specify the proper URL of the download file')
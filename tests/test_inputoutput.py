@@ -0,0 +1,142 @@
+import errno
+import http.server
+import os
+import sys
+import tempfile
+import threading
+import unittest
+import urllib.error
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'rescue_loader'))
+import inputoutput
+from inputoutput import BlockInputOutput, HTTPConnectionPool
+
+
+
+class DirectWriteFallbackTest(unittest.TestCase):
+    """
+    O_DIRECT rejected with EINVAL partway through an extent, the rest of the
+    extent and the later writes go through the page cache
+    """
+    def setUp(self):
+        fd, self.mFilename = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(__file__)))
+        os.close(fd)
+        self.mIO = BlockInputOutput(512, self.mFilename, 'wb+')
+        self.mIO.setDirectIO(True)
+        if self.mIO.mDirectFd is None:
+            self.mIO._close()
+            os.remove(self.mFilename)
+            self.skipTest('O_DIRECT not supported on {}'.format(self.mFilename))
+
+    def tearDown(self):
+        os.remove(self.mFilename)
+
+    def test_einval_partway(self):
+        # 10MB from an unaligned offset, the 2nd bounce buffer write fails
+        data = os.urandom(10485760)
+        start = 1000
+        directfd = self.mIO.mDirectFd
+        pwrite = os.pwrite
+        calls = []
+
+        def failing(fd, view, offset):
+            if fd == directfd:
+                calls.append(offset)
+                if len(calls) == 2:
+                    raise OSError(errno.EINVAL, os.strerror(errno.EINVAL))
+            return pwrite(fd, view, offset)
+
+        with mock.patch.object(inputoutput.os, 'pwrite', side_effect=failing):
+            self.assertEqual(self.mIO.Write(data, start), len(data))
+            self.assertIsNone(self.mIO.mDirectFd)
+            self.assertEqual(self.mIO.Write(data[:4096], start + len(data)), 4096)
+        self.mIO._close()
+        self.assertEqual(len(calls), 2)
+        with open(self.mFilename, 'rb') as f:
+            written = f.read()
+        self.assertEqual(written[:start], bytes(start))
+        self.assertEqual(written[start:start + len(data)], data)
+        self.assertEqual(written[start + len(data):], data[:4096])
+
+
+
+class RedirectHandler(http.server.BaseHTTPRequestHandler):
+    # /go<code>?to=<url> redirects, /missing is a 404 with a body, the rest 200
+    protocol_version = 'HTTP/1.1'
+    mSeen = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.mSeen.append((self.server.server_port, self.command, self.headers.get('Authorization')))
+        if self.path.startswith('/go'):
+            self.send_response(int(self.path[3:6]))
+            self.send_header('Location', self.path.split('to=', 1)[1])
+            body = b''
+        elif self.path == '/missing':
+            self.send_response(404)
+            body = b'missing body'
+        else:
+            self.send_response(200)
+            body = b'ok'
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_POST = do_GET
+
+
+
+class RedirectTest(unittest.TestCase):
+    """
+    credentials stay with the origin they were given for, on redirections
+    """
+    @classmethod
+    def setUpClass(cls):
+        cls.mServers = [http.server.ThreadingHTTPServer(('127.0.0.1', 0), RedirectHandler) for i in range(2)]
+        for server in cls.mServers:
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+        cls.mUrls = ['http://127.0.0.1:{}'.format(server.server_port) for server in cls.mServers]
+
+    @classmethod
+    def tearDownClass(cls):
+        for server in cls.mServers:
+            server.shutdown()
+            server.server_close()
+
+    def setUp(self):
+        RedirectHandler.mSeen.clear()
+        self.mPool = HTTPConnectionPool()
+        self.mAuth = {'authorization': 'Basic dTpw'}
+
+    def test_same_origin(self):
+        url = '{}/go302?to={}/file'.format(self.mUrls[0], self.mUrls[0])
+        with self.mPool.request(url, self.mAuth) as response:
+            self.assertEqual(response.read(), b'ok')
+        self.assertEqual([auth for port, method, auth in RedirectHandler.mSeen], ['Basic dTpw', 'Basic dTpw'])
+
+    def test_other_origin(self):
+        url = '{}/go302?to={}/file'.format(self.mUrls[0], self.mUrls[1])
+        with self.mPool.request(url, self.mAuth) as response:
+            self.assertEqual(response.read(), b'ok')
+        self.assertEqual(RedirectHandler.mSeen[-1], (self.mServers[1].server_port, 'GET', None))
+
+    def test_see_other(self):
+        url = '{}/go303?to={}/file'.format(self.mUrls[0], self.mUrls[0])
+        with self.mPool.request(url, method='POST') as response:
+            self.assertEqual(response.read(), b'ok')
+        self.assertEqual([method for port, method, auth in RedirectHandler.mSeen], ['POST', 'GET'])
+
+    def test_error_body(self):
+        with self.assertRaises(urllib.error.HTTPError) as cm:
+            self.mPool.request(self.mUrls[0] + '/missing')
+        self.assertEqual(cm.exception.code, 404)
+        self.assertEqual(cm.exception.read(), b'missing body')
+        cm.exception.close()
+
+
+
+if __name__ == '__main__':
+    unittest.main()